@@ -0,0 +1,335 @@
+"""Benchmark harness for the scraper and indexer stages.  Generates seeded
+synthetic dumps and keyword files (see `fixtures`), then times the real code
+for each stage:
+
+    filter      read_json.process_zip over an RC and an RS dump
+    sql_load    read_json.read_to_sql of the filtered output
+    tokenize    language_tools.tokenize over the filtered posts
+    match       build_index.find_card_keywords with a compiled matcher
+    populate    build_index.populate_card_db and populate_keyword_db, and
+                populate_mention_db for the long-format tables
+
+SQL stages run through the `storage` backend, against a scratch MySQL
+database or a SQLite file when no server is at hand.  Each run is appended as one
+JSON line to a results file, tagged with the current commit, and `compare`
+lines runs up side by side so regressions show across commits.
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import tempfile
+import platform
+import subprocess
+import contextlib
+import argparse
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(_ROOT)
+sys.path.append(os.path.join(_ROOT,'scraper'))
+sys.path.append(os.path.join(_ROOT,'entity_index'))
+
+import pymysql as pms
+from reddit_common import storage as st
+import read_json as r
+import language_tools as lt
+import catalog as cat
+import build_index as bi
+import fixtures
+
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'results.jsonl')
+
+# scratch MySQL database for the SQL stages, dropped after each run
+BENCH_DB = 'reddit_bench'
+
+
+@contextlib.contextmanager
+def _database(kind,workdir):
+    """points the storage backend at a scratch database, with empty post 
+    tables, for the duration.
+
+    ARGS:
+        kind: string.
+            'mysql' for the `BENCH_DB` database on the local server, or 
+            'sqlite' for a SQLite file in `workdir`.
+        workdir: string.
+            scratch directory.
+    """
+    previous = os.environ.get(st.BACKEND_ENV,None)
+    if kind == 'sqlite':
+        st.configure('sqlite:///'+os.path.join(workdir,'bench.sqlite'))
+    elif kind == 'mysql':
+        conn = pms.connect(host='localhost',user='root',passwd='',
+                           charset='utf8mb4')
+        conn.cursor().execute("DROP DATABASE IF EXISTS {}".format(BENCH_DB))
+        conn.cursor().execute("CREATE DATABASE {} CHARACTER SET utf8mb4"
+                              .format(BENCH_DB))
+        conn.close()
+        st.configure('mysql:///'+BENCH_DB)
+    else:
+        raise ValueError("unknown database {}".format(kind))
+
+    st.create_tables(r.COMMENT_FIELDS,r.SUBMISSION_FIELDS)
+    try:
+        yield
+    finally:
+        st.get_pool().close()
+        if previous is None:
+            os.environ.pop(st.BACKEND_ENV,None)
+        else:
+            os.environ[st.BACKEND_ENV] = previous
+        if kind == 'mysql':
+            conn = pms.connect(host='localhost',user='root',passwd='')
+            conn.cursor().execute("DROP DATABASE IF EXISTS {}"
+                                  .format(BENCH_DB))
+            conn.close()
+
+
+def _timed(fn,repeat,setup=None):
+    """best of `repeat` timings of `fn()`, running `setup()` untimed before
+    each.
+
+    RETURNS:
+        result: tuple.
+            tuple of (best seconds,result of the last call).
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best,elapsed)
+    return (best,result)
+
+
+def _stage(seconds,items,unit,**extra):
+    """result entry for one stage.
+    """
+    result = {'seconds': seconds, 'items': items, 'unit': unit,
+              'per_sec': items/seconds if seconds > 0 else 0.}
+    result.update(extra)
+    return result
+
+
+def _commit():
+    """current commit hash, marked '-dirty' with uncommitted changes, or None
+    outside a git checkout.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git','rev-parse','--short','HEAD'],cwd=_ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(
+            ['git','status','--porcelain','--untracked-files=no'],cwd=_ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if status else '')
+
+
+def run(n_lines=100000,db='sqlite',repeat=3,seed=0,mix=None,write_batch=500,
+        decompress_jobs=1,results_file=RESULTS_FILE,tmp_dir=None):
+    """generates the fixtures, times every stage, and appends the run to
+    `results_file`.
+
+    KWARGS:
+        n_lines: int.
+            posts per synthetic dump (one RC, one RS).  Default 100000.
+        db: string.
+            'sqlite' or 'mysql', see `_database`.  Default 'sqlite'.
+        repeat: int.
+            timed runs per stage, keeping the best.  Default 3.
+        seed: int.
+            fixture random seed.  Default 0.
+        mix: dict or None.
+            target subreddit to share of posts, see `fixtures.write_dump`.
+            Default None, uses `fixtures.SUBREDDIT_MIX`.
+        write_batch: int.
+            rows per bulk upsert in the populate stage.  Kept under SQLite's
+            limit on statement parameters.  Default 500.
+        decompress_jobs: int.
+            passed to `read_json.process_zip`.  Default 1.
+        results_file: string or None.
+            JSON-lines file to append the run to.  Default `RESULTS_FILE`.
+        tmp_dir: string or None.
+            parent of the scratch directory.  Default None, the system temp
+            directory.
+
+    RETURNS:
+        result: dict.
+            the run, as appended to `results_file`.
+    """
+    mix = fixtures.SUBREDDIT_MIX if mix is None else mix
+    stages = {}
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as workdir:
+        os.chdir(workdir)
+        try:
+            catalog_data = fixtures.write_catalog(workdir,seed=seed)
+            dumps = {}
+            for kind,comments in [('RC',True),('RS',False)]:
+                source = os.path.join(workdir,'{}_2017-01.bz2'.format(kind))
+                size = fixtures.write_dump(source+'.fixture',n_lines,
+                                           comments=comments,mix=mix,
+                                           catalog=catalog_data,seed=seed)
+                dumps[kind] = (source,size)
+
+            with _database(db,workdir):
+                # decompress + filter
+                scraped = {}
+                for kind,(source,size) in dumps.items():
+                    def setup():
+                        for old in glob.glob(source[:-4]+'_scraped_*'):
+                            os.remove(old)
+                        shutil.copyfile(source+'.fixture',source)
+                    seconds,_ = _timed(
+                        lambda: r.process_zip(source,list(mix),
+                                              decompress_jobs=decompress_jobs),
+                        repeat,setup)
+                    scraped[kind] = glob.glob(source[:-4]+'_scraped_*')[0]
+                    stages['filter_'+kind] = _stage(
+                        seconds,n_lines,'lines',
+                        mb_per_sec=size/1024**2/seconds,
+                        compressed_mb=os.path.getsize(source+'.fixture')
+                                      /1024**2)
+
+                # SQL load
+                posts = []
+                for kind,file in scraped.items():
+                    table = 'Comments' if kind == 'RC' else 'Submissions'
+                    conn = st.connect()
+                    def setup():
+                        conn.cursor().execute("DELETE FROM {}".format(table))
+                        conn.commit()
+                    seconds,count = _timed(
+                        lambda: r.read_to_sql(file,conn),repeat,setup)
+                    conn.close()
+                    stages['sql_load_'+kind] = _stage(seconds,count,'rows')
+
+                    for data in r._read_records(file):
+                        if kind == 'RC':
+                            posts.append((data['id'],data['body']))
+                        else:
+                            posts.append((data['id'],"{} {}".format(
+                                data['title'],data['selftext'])))
+
+                # tokenize and match
+                seconds,_ = _timed(
+                    lambda: [lt.tokenize(body) for _,body in posts],repeat)
+                stages['tokenize'] = _stage(seconds,len(posts),'docs')
+
+                catalog = cat.EntityCatalog(workdir)
+                matcher = bi.build_matcher(catalog=catalog)
+                seconds,results = _timed(
+                    lambda: [result for result in
+                             (bi.find_card_keywords(post,None,matcher=matcher)
+                              for post in posts) if result is not None],
+                    repeat)
+                stages['match'] = _stage(seconds,len(posts),'docs',
+                                         matched=len(results))
+
+                # populate
+                setup = lambda: bi.reset_index_tables(catalog=catalog)
+                for name,populate in [('populate_card',bi.populate_card_db),
+                                      ('populate_keyword',
+                                       bi.populate_keyword_db)]:
+                    seconds,_ = _timed(
+                        lambda: populate(results,batch_size=write_batch,
+                                         catalog=catalog),
+                        repeat,setup)
+                    stages[name] = _stage(seconds,len(results),'rows')
+
+                setup = lambda: bi.reset_index_tables(catalog=catalog,
+                                                      layout='long')
+                seconds,_ = _timed(
+                    lambda: bi.populate_mention_db(results,
+                                                   batch_size=write_batch,
+                                                   catalog=catalog),
+                    repeat,setup)
+                stages['populate_mention'] = _stage(seconds,len(results),
+                                                    'rows')
+        finally:
+            os.chdir(cwd)
+
+    result = {'commit': _commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'db': db,
+              'params': {'n_lines': n_lines, 'repeat': repeat, 'seed': seed,
+                         'mix': mix, 'write_batch': write_batch,
+                         'decompress_jobs': decompress_jobs},
+              'stages': stages}
+    if results_file is not None:
+        with open(results_file,'a') as writefile:
+            writefile.write(json.dumps(result)+'\n')
+    return result
+
+
+def compare(results_file=RESULTS_FILE,last=5):
+    """prints the throughput of each stage over the last `last` runs side by
+    side, with the change of the newest run against the one before.  Runs
+    with different parameters or databases are not directly comparable;
+    their settings are printed above the table.
+
+    KWARGS:
+        results_file: string.
+            JSON-lines results file.  Default `RESULTS_FILE`.
+        last: int.
+            number of runs to show.  Default 5.
+    """
+    with open(results_file,'r') as readfile:
+        runs = [json.loads(line) for line in readfile][-last:]
+    if not runs:
+        return
+
+    for i,run in enumerate(runs):
+        print("[{}] {} {} db={} {}".format(i,run['commit'],run['time'],
+                                           run['db'],
+                                           json.dumps(run['params'])))
+
+    names = []
+    for run in runs:
+        names += [name for name in run['stages'] if name not in names]
+
+    print("{:<18}".format('stage') +
+          ''.join("{:>14}".format('[{}]'.format(i)) for i in range(len(runs)))
+          + "{:>10}".format('change'))
+    for name in names:
+        rates = [run['stages'].get(name,{}).get('per_sec',None)
+                 for run in runs]
+        row = "{:<18}".format(name)
+        row += ''.join("{:>14}".format('-' if rate is None
+                                       else "{:.0f}".format(rate))
+                       for rate in rates)
+        if len(rates) > 1 and rates[-1] and rates[-2]:
+            row += "{:>+9.1f}%".format((rates[-1]/rates[-2]-1)*100)
+        print(row)
+    print("(items per second; higher is better)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="time the scraper and indexer stages on synthetic data")
+    parser.add_argument('--lines',type=int,default=100000,
+                        help="posts per synthetic dump")
+    parser.add_argument('--db',choices=['sqlite','mysql'],default='sqlite')
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--decompress-jobs',type=int,default=1)
+    parser.add_argument('--results',default=RESULTS_FILE)
+    parser.add_argument('--compare',action='store_true',
+                        help="only print the last runs in the results file")
+    args = parser.parse_args()
+
+    if not args.compare:
+        run(n_lines=args.lines,db=args.db,repeat=args.repeat,seed=args.seed,
+            decompress_jobs=args.decompress_jobs,results_file=args.results)
+    compare(args.results)
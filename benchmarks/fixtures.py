@@ -0,0 +1,265 @@
+"""Synthetic, seeded fixtures for the benchmarks -- monthly RC/RS bz2 dumps with
+a configurable subreddit mix, and banks/cards/keywords JSON in the same shape
+as the files in entity_index.
+"""
+
+import os
+import json
+import bz2
+import random
+
+
+# target subreddits and the share of posts each gets in a synthetic dump
+SUBREDDIT_MIX = {'churning': 0.04, 'creditcards': 0.03,
+                 'personalfinance': 0.03}
+
+# number of filler subreddits sharing the rest of the posts
+TAIL_SUBREDDITS = 2000
+
+# base timestamp of synthetic posts, 2017-01-01 UTC
+_EPOCH = 1483228800
+
+_SYLLABLES = ['ka','lo','ri','zan','mer','tu','vex','oni','pra','dul','sha',
+              'gor','nim','qua','bel','tor','xi','mon','ept','ura']
+
+
+def _word(rng,n_syllables):
+    return ''.join(rng.choice(_SYLLABLES) for _ in range(n_syllables))
+
+
+def make_catalog(n_banks=8,cards_per_bank=4,terms_per_tag=4,seed=0):
+    """builds synthetic banks, cards and keywords definitions.  Every bank
+    and card gets a mix of single- and multi-word alternate names, and the
+    keyword tags include the REWARDS, FEE and INTEREST tags the catalog
+    treats specially.
+
+    KWARGS:
+        n_banks: int.
+            number of banks, each also a card issuer.  Default 8.
+        cards_per_bank: int.
+            number of cards per issuer.  Default 4.
+        terms_per_tag: int.
+            number of terms per keyword tag.  Default 4.
+        seed: int.
+            random seed.  Default 0.
+
+    RETURNS:
+        catalog: tuple.
+            tuple of (banks,cards,keywords) dicts, as parsed from banks.json,
+            cards.json and keywords.json.
+    """
+    rng = random.Random(seed)
+    used = set()
+
+    def name():
+        while True:
+            word = _word(rng,rng.randint(2,3)).upper()
+            if word not in used:
+                used.add(word)
+                return word
+
+    banks = []
+    issuers = []
+    for _ in range(n_banks):
+        bank = {'name': name()}
+        if rng.random() < 0.6:
+            bank['alts'] = [name()+' '+name()]
+        banks.append(bank)
+
+        cards = []
+        for _ in range(cards_per_bank):
+            card = {'name': name()}
+            if rng.random() < 0.5:
+                card['alts'] = [name(),card['name']+' '+name()]
+            cards.append(card)
+        issuers.append({'name': bank['name'], 'cards': cards})
+
+    tags = []
+    for tag in ['REWARDS','FEE','INTEREST',name()]:
+        terms = []
+        for _ in range(terms_per_tag):
+            term = {'term': name()}
+            if rng.random() < 0.7:
+                term['alts'] = [name()+' '+name()]
+            terms.append(term)
+        tags.append({'tag': tag, 'terms': terms})
+
+    return ({'banks': banks},{'issuer': issuers},{'keywords': tags})
+
+
+def write_catalog(path,seed=0,**kwargs):
+    """writes synthetic banks.json, cards.json and keywords.json to `path`.
+
+    ARGS:
+        path: string.
+            target directory, created if missing.
+
+    KWARGS:
+        seed: int.
+            random seed.  Default 0.
+        **kwargs:
+            passed to `make_catalog`.
+
+    RETURNS:
+        catalog: tuple.
+            tuple of (banks,cards,keywords) dicts, as written.
+    """
+    os.makedirs(path,exist_ok=True)
+    catalog = make_catalog(seed=seed,**kwargs)
+    for filename,data in zip(['banks.json','cards.json','keywords.json'],
+                             catalog):
+        with open(os.path.join(path,filename),'w') as writefile:
+            json.dump(data,writefile)
+    return catalog
+
+
+def mention_terms(catalog):
+    """surface forms of every bank, card and keyword, for seeding post text.
+
+    ARGS:
+        catalog: tuple.
+            tuple of (banks,cards,keywords) dicts, from `make_catalog`.
+
+    RETURNS:
+        terms: list.
+            list of upper-case strings.
+    """
+    banks,cards,other = catalog
+    terms = []
+    for bank in banks['banks']:
+        terms += [bank['name']] + bank.get('alts',[])
+    for issuer in cards['issuer']:
+        for card in issuer['cards']:
+            terms.append(issuer['name']+' '+card['name'])
+            terms += card.get('alts',[])
+    for tag in other['keywords']:
+        for term in tag['terms']:
+            terms += [term['term']] + term.get('alts',[])
+            if tag['tag'] in ['REWARDS','FEE']:
+                terms.append(term['term']+' '+tag['tag'])
+    return terms
+
+
+class _TextMaker(object):
+    """random post text -- filler words, with catalog terms mixed in.
+    """
+    def __init__(self,rng,terms,vocabulary=3000):
+        self.rng = rng
+        self.terms = [term.lower() for term in terms]
+        self.words = [_word(rng,rng.randint(1,4)) for _ in range(vocabulary)]
+
+    def text(self,n_words,mention_rate):
+        words = self.rng.choices(self.words,k=n_words)
+        if self.terms and self.rng.random() < mention_rate:
+            for _ in range(self.rng.randint(1,3)):
+                words.insert(self.rng.randrange(len(words)+1),
+                             self.rng.choice(self.terms))
+        return ' '.join(words)
+
+
+def _subreddit_picker(rng,mix):
+    """returns a function drawing a subreddit name from `mix`, with the
+    remaining share spread over `TAIL_SUBREDDITS` filler subreddits.
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    rest = max(0.,1.-sum(weights))
+    tail = ['sub_'+_word(rng,3) for _ in range(TAIL_SUBREDDITS)]
+    names += tail
+    weights += [rest/len(tail)]*len(tail)
+    return lambda: rng.choices(names,weights)[0]
+
+
+def _comment(rng,i,subreddit,body,created):
+    return {'id': 'c{:x}'.format(i),
+            'author': 'user_{}'.format(rng.randrange(100000)),
+            'subreddit': subreddit,
+            'subreddit_id': 't5_'+subreddit[:6],
+            'link_id': 't3_{:x}'.format(rng.randrange(10**6)),
+            'parent_id': 't1_{:x}'.format(rng.randrange(10**6)),
+            'body': body,
+            'score': rng.randint(-5,200),
+            'gilded': 0,
+            'controversiality': int(rng.random() < 0.05),
+            'distinguished': None,
+            'edited': False,
+            'stickied': False,
+            'created_utc': created,
+            'retrieved_on': created + 86400}
+
+
+def _submission(rng,i,subreddit,title,selftext,created):
+    return {'id': 's{:x}'.format(i),
+            'author': 'user_{}'.format(rng.randrange(100000)),
+            'subreddit': subreddit,
+            'subreddit_id': 't5_'+subreddit[:6],
+            'title': title,
+            'selftext': selftext,
+            'url': 'https://www.reddit.com/r/{}/s{:x}/'.format(subreddit,i),
+            'domain': 'self.'+subreddit,
+            'permalink': '/r/{}/comments/s{:x}/'.format(subreddit,i),
+            'score': rng.randint(0,500),
+            'num_comments': rng.randint(0,80),
+            'gilded': 0,
+            'over_18': False,
+            'is_self': True,
+            'distinguished': None,
+            'edited': False,
+            'stickied': False,
+            'created_utc': created,
+            'retrieved_on': created + 86400}
+
+
+def write_dump(filepath,n_lines,comments=True,mix=None,catalog=None,
+               mention_rate=0.3,seed=0):
+    """writes a synthetic monthly dump as bzip2-compressed JSON lines.
+
+    ARGS:
+        filepath: string.
+            output path, e.g. '.../RC_2017-01.bz2'.
+        n_lines: int.
+            number of posts.
+
+    KWARGS:
+        comments: boolean.
+            True for a comment (RC) dump, False for submissions (RS).
+            Default True.
+        mix: dict or None.
+            target subreddit to share of posts.  Default None, uses
+            `SUBREDDIT_MIX`.
+        catalog: tuple or None.
+            catalog from `make_catalog`, whose terms are mentioned in posts.
+            Default None, no mentions.
+        mention_rate: float.
+            share of target-subreddit posts mentioning catalog terms; other
+            posts mention them a tenth as often.  Default 0.3.
+        seed: int.
+            random seed.  Default 0.
+
+    RETURNS:
+        size: int.
+            decompressed size in bytes.
+    """
+    rng = random.Random(seed)
+    mix = SUBREDDIT_MIX if mix is None else mix
+    texts = _TextMaker(rng,mention_terms(catalog) if catalog else [])
+    subreddit = _subreddit_picker(rng,mix)
+
+    size = 0
+    with bz2.BZ2File(filepath,'w') as writefile:
+        for i in range(n_lines):
+            sub = subreddit()
+            rate = mention_rate if sub in mix else mention_rate/10.
+            created = _EPOCH + i*(31*86400//max(n_lines,1))
+            if comments:
+                post = _comment(rng,i,sub,
+                                texts.text(rng.randint(5,80),rate),created)
+            else:
+                post = _submission(rng,i,sub,
+                                   texts.text(rng.randint(3,15),rate),
+                                   texts.text(rng.randint(0,150),rate),
+                                   created)
+            line = (json.dumps(post)+'\n').encode()
+            size += len(line)
+            writefile.write(line)
+    return size
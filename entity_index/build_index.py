@@ -2,114 +2,296 @@
 """
 
 
-import pymysql as pms
 import language_tools as lt
+import catalog as cat
+import ordinals as od
+import postings as ps
+import match_cache as mc
 import json
 import itertools
-
-
-def get_texts(limit=None):
-    """getter method for pulling comment and submission texts.
+import os
+import multiprocessing as mp
+import threading
+import queue
+import collections
+import functools
+import time
+from reddit_common import metrics as mx
+from reddit_common import storage as st
+
+
+def get_texts(limit=None,batch_size=10000,resume=None,ledger=None,
+              meta=False):
+    """getter method for pulling comment and submission texts.  Streams rows 
+    with keyset pagination on `id`, so only one batch is held in client 
+    memory at a time.
 
     KWARGS:
         limit: int or None.
             optional cap on number of posts to pull.
+        batch_size: int.
+            number of rows fetched per query.  Default 10000.
+        resume: tuple or None.
+            optional (table,id) of the last post processed by an earlier run, 
+            e.g. ('Comments','d1x9k2a'), as saved by `run_index` under 
+            'position' in its state file.  Rows up to and including that id 
+            are skipped, as is the Comments table when resuming in 
+            Submissions.
+        ledger: int or None.
+            optional run number; posts the processed-ids ledger records as 
+            indexed by that run or an earlier one are skipped, see 
+            `build_ledger_db`.  Used by incremental runs, see `run_index`.
+        meta: boolean.
+            also yield the table and `created_utc` of each post.  Default 
+            False.
 
     YIELDS:
         texts: tuple.
-            tuple of (id,body) for comments and submissions
+            tuple of (id,body) for comments and submissions, or 
+            (id,body,table,created_utc) with `meta`.
     """
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8mb4',
-                       init_command='SET NAMES UTF8MB4')
-    cur = conn.cursor(pms.cursors.DictCursor)
-
-    if limit is not None:
-        limtext = " LIMIT {}".format(limit)
-    else:
-        limtext = ""
-
-    # exclude indexing comments already in the index
-    #query = """SELECT c.id, c.body FROM Comments c 
-    #            WHERE NOT EXISTS (
-    #                SELECT NULL FROM Mentions m 
-    #                    WHERE m.id=c.id;
-    #                ){};
-    #        """.format(limtext)
-    query = "SELECT c.id,c.body FROM Comments c{};".format(limtext)
-    cur.execute(query)
-    for row in cur:
-        yield (row['id'],row['body'])
-
-    #query = """SELECT s.id, s.title, s.selftext FROM Submissions s 
-    #            WHERE NOT EXISTS (
-    #                SELECT NULL FROM Mentions m 
-    #                    WHERE m.id=s.id;
-    #                ){};
-    #        """.format(limtext)
-    query = "SELECT s.id,s.title,s.selftext FROM Submissions s{}".format(limtext)
-    cur.execute(query)
-    for row in cur:
-        yield (row['id'],"{} {}".format(row['title'],row['selftext']))
+    conn = st.connect()
+    cur = conn.cursor()
 
+    tables = [('Comments','c',"SELECT c.id,c.body FROM Comments c"),
+              ('Submissions','s',
+               "SELECT s.id,s.title,s.selftext FROM Submissions s")]
+    if meta:
+        tables = [('Comments','c',
+                   "SELECT c.id,c.body,c.created_utc FROM Comments c"),
+                  ('Submissions','s',
+                   "SELECT s.id,s.title,s.selftext,s.created_utc "
+                   "FROM Submissions s")]
+
+    if resume is not None:
+        names = [table for table,_,_ in tables]
+        tables = tables[names.index(resume[0]):]
+
+    try:
+        for table,alias,query in tables:
+            last_id = ''
+            if resume is not None and resume[0] == table:
+                last_id = resume[1]
+
+            query += " WHERE {}.id > %s".format(alias)
+            args = ()
+            if ledger is not None:
+                query += (" AND NOT EXISTS (SELECT NULL FROM {} i "
+                          "WHERE i.id = {}.id AND i.run <= %s)"
+                          .format(LEDGER_TABLES[table],alias))
+                args = (ledger,)
+            query += " ORDER BY {}.id LIMIT %s;".format(alias)
+
+            count = 0
+            while limit is None or count < limit:
+                size = batch_size
+                if limit is not None:
+                    size = min(size,limit - count)
+
+                cur.execute(query,(last_id,) + args + (size,))
+                rows = cur.fetchall()
+                for row in rows:
+                    if meta:
+                        created,row = row[-1],row[:-1]
+                    if len(row) == 2:
+                        text = tuple(row)
+                    else:
+                        text = (row[0],"{} {}".format(row[1],row[2]))
+                    yield text + (table,created) if meta else text
+
+                count += len(rows)
+                if len(rows) < size:
+                    break
+                last_id = rows[-1][0]
+    finally:
+        conn.close()
+
+
+# processed-ids ledger of incremental runs, one table per text table since 
+# comment and submission ids overlap
+LEDGER_TABLES = {'Comments': 'Indexed_Comments',
+                 'Submissions': 'Indexed_Submissions'}
+
+
+def build_ledger_db():
+    """initializes the processed-ids ledger, recording each post an 
+    incremental run has indexed (matched or not) with the run's number.  A 
+    run's entries only count once a later run starts from it as complete, so 
+    posts recorded by a run that failed part-way are indexed again.
+    """
+    conn = st.connect()
+    cur = conn.cursor()
+    for table in LEDGER_TABLES.values():
+        cur.execute("CREATE TABLE IF NOT EXISTS {} ("
+                    "id VARCHAR(10) PRIMARY KEY NOT NULL, "
+                    "run INT NOT NULL);".format(table))
+    conn.commit()
+    conn.close()
 
-def build_keywords():
-    """builds master list of keywords to check.
+
+def populate_ledger(posts,run,batch_size=1000,commit_every=10):
+    """records posts as indexed by run `run` in the processed-ids ledger.  
+    Posts already recorded keep their earlier run.
+
+    ARGS:
+        posts: iterable.
+            list or stream of (id,table) tuples.
+        run: int.
+            number of the incremental run.
+
+    KWARGS:
+        batch_size: int.
+            number of rows per INSERT statement.  Default 1000.
+        commit_every: int.
+            commit after this many batches.  Default 10.
+    """
+    conn = st.connect()
+    cur = conn.cursor()
+
+    def write(table,batch):
+        query = ("INSERT IGNORE INTO {} (id,run) VALUES {};"
+                 .format(LEDGER_TABLES[table],
+                         ','.join(['(%s,%s)']*len(batch))))
+        cur.execute(query,[value for index in batch for value in (index,run)])
+
+    batches = dict((table,[]) for table in LEDGER_TABLES)
+    n_batches = 0
+    for index,table in posts:
+        batch = batches[table]
+        batch.append(index)
+        if len(batch) >= batch_size:
+            write(table,batch)
+            batches[table] = []
+            n_batches += 1
+            if n_batches % commit_every == 0:
+                conn.commit()
+
+    for table,batch in batches.items():
+        if batch:
+            write(table,batch)
+    conn.commit()
+    conn.close()
+
+
+def load_state(state_file='index_state.json'):
+    """reads persisted incremental-indexing state.
+
+    KWARGS:
+        state_file: string.
+            path to state file.  Default 'index_state.json'.
 
     RETURNS:
-        keywords: list.
-            List of strings of individual keyword terms.
+        state: dict.
+            dict with 'keyword_hash', 'layout' (see `run_index`), 'run' 
+            (number of the last complete run, see `build_ledger_db`) and 
+            'position' (last (table,id) committed, see `save_position`).  
+            Empty if no state file exists.
+    """
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file,'r') as f:
+        return json.load(f)
+
+
+def save_state(state,state_file='index_state.json'):
+    """atomically writes incremental-indexing state.
+
+    ARGS:
+        state: dict.
+            state dict as returned by `load_state`.
+
+    KWARGS:
+        state_file: string.
+            path to state file.  Default 'index_state.json'.
     """
-    with open('banks.json','r') as f:
-        banks = json.load(f)['banks']
+    tmpfile = state_file + '.tmp'
+    with open(tmpfile,'w') as f:
+        json.dump(state,f)
+    os.replace(tmpfile,state_file)
+
+
+def save_position(position,state_file='index_state.json'):
+    """records the last post committed by a run in the state file, keeping 
+    the rest of the state.  An interrupted run restarts after it with 
+    `run_index(resume=tuple(load_state()['position']))`.
 
-    with open('cards.json','r') as f:
-        cards = json.load(f)['issuer']
+    ARGS:
+        position: tuple.
+            (table,id) of the last post written by every write stage.
+
+    KWARGS:
+        state_file: string.
+            path to state file.  Default 'index_state.json'.
+    """
+    state = load_state(state_file)
+    state['position'] = list(position)
+    save_state(state,state_file)
+
+
+def reset_index_tables(catalog=None,layout='wide'):
+    """drops and recreates the Card_Mentions and Keywords tables, along with 
+    the processed-ids ledger, for a full rebuild after the keyword 
+    definitions or the layout change.
+
+    KWARGS:
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
+        layout: string.
+            'wide' for Card_Mentions and Keywords, or 'long' for Mentions, 
+            which is emptied while the Entities ids are kept.  Default 
+            'wide'.
+    """
+    conn = st.connect()
+    cur = conn.cursor()
+    if layout == 'long':
+        cur.execute("DROP TABLE IF EXISTS Mentions;")
+    else:
+        cur.execute("DROP TABLE IF EXISTS Card_Mentions;")
+        cur.execute("DROP TABLE IF EXISTS Keywords;")
+    for table in LEDGER_TABLES.values():
+        cur.execute("DROP TABLE IF EXISTS {};".format(table))
+    conn.commit()
+    conn.close()
 
-    with open('keywords.json','r') as f:
-        other = json.load(f)['keywords']
+    build_ledger_db()
 
-    keywords = []
+    if layout == 'long':
+        build_mention_db(catalog=catalog)
+    else:
+        build_card_db(catalog=catalog)
+        build_keyword_db(catalog=catalog)
 
-    for bank in banks:
-        keywords.append(bank['name'])
-        alts = bank.get('alts',None)
-        if alts is not None:
-            keywords += alts
 
-    for card in cards:
-        for instance in card['cards']:
-            keywords.append(instance['name'])
-            alts = instance.get('alts',None)
-            if alts is not None:
-                keywords += alts
+def build_keywords():
+    """builds master list of keywords to check.
 
-    for tag in other:
-        for term in tag['terms']:
-            keywords.append(term['term'])
-            alts = term.get('alts',None)
-            if alts is not None:
-                keywords += alts
+    RETURNS:
+        keywords: list.
+            List of strings of individual keyword terms.
+    """
+    return cat.EntityCatalog().keywords
 
-    for mwe in lt.multi_word_entities():
-        term = ' '.join(mwe)
-        keywords.append(term)
 
-    keywords = set(keywords)
+def build_matcher(stopwords=None,catalog=None):
+    """compiles a `language_tools.KeywordMatcher` over the full keyword set, 
+    for reuse across calls to `find_card_keywords`.
 
-    # hack -- remove common single-word entities to avoid false positives
-    removals = ['CARD','DC','FREEDOM','GOLD','GREEN','INFINITE','IT','OPEN',
-                'JOURNEY','SPARK','AF FEE','INTEREST INTEREST',
-                'GRACE PERIOD FEE','MINIMUM PAYMENT PAYMENT']
-    keywords.difference_update(set(removals))
+    KWARGS:
+        stopwords: set or None.
+            set of upper-case stopwords to strip.  Default None.
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
 
-    return keywords
+    RETURNS:
+        matcher: language_tools.KeywordMatcher.
+            compiled matcher.
+    """
+    if catalog is None:
+        catalog = cat.EntityCatalog()
+    return catalog.matcher(stopwords=stopwords)
 
 
-def find_card_keywords(text,keys,stopwords=None):
+def find_card_keywords(text,keys,stopwords=None,matcher=None,cache=None):
     """Checks text body for keywords associated with banks/cards, generates map 
     of mentioned keywords.  Lightweight output to allow for parallelization 
     before SQL write.
@@ -120,18 +302,40 @@ def find_card_keywords(text,keys,stopwords=None):
         keys: set.
             set of keywords constructed by `build_keywords`.
 
+    KWARGS:
+        stopwords: set or None.
+            set of upper-case stopwords to strip.  Default None.
+        matcher: language_tools.KeywordMatcher or None.
+            precompiled matcher from `build_matcher`.  If supplied, `keys` and 
+            `stopwords` are ignored in favor of the matcher's own.
+        cache: match_cache.MatchCache or None.
+            cache of keywords by body, for skipping repeated bodies.  Must 
+            only be used with one keyword set.  Default None.
+
     RETURNS:
         map: tuple or None.
             tuple of (id,[keywords]).  If no keyword matches are found, 
             returns None.
     """
     index,body = text
-    body = lt.tokenize(body,stopwords=stopwords)
 
-    keywords = []
-    for token in body:
-        if token in keys:
-            keywords.append(token)
+    if cache is not None:
+        keywords = cache.get(body)
+        if keywords is None:
+            keywords = find_card_keywords((index,body),keys,
+                                          stopwords=stopwords,
+                                          matcher=matcher)
+            keywords = [] if keywords is None else keywords[1]
+            cache.put(body,keywords)
+    elif matcher is not None:
+        keywords = matcher.match(body)
+    else:
+        body = lt.tokenize(body,stopwords=stopwords)
+
+        keywords = []
+        for token in body:
+            if token in keys:
+                keywords.append(token)
 
     if len(keywords) > 0:
         return (index,keywords)
@@ -139,134 +343,261 @@ def find_card_keywords(text,keys,stopwords=None):
         return None
 
 
-def build_card_db():
+def build_card_db(catalog=None):
     """wrapper script to initialize credit-card database.
+
+    KWARGS:
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
     """
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8mb4',
-                       init_command='SET NAMES UTF8MB4')
+    conn = st.connect()
     cur = conn.cursor()
 
-    with open('cards.json','r') as f:
-        cards = json.load(f)['issuer']
+    if catalog is None:
+        catalog = cat.EntityCatalog()
 
     query = "CREATE TABLE Card_Mentions (\n"
     query += "id VARCHAR(7) PRIMARY KEY NOT NULL UNIQUE, \n"
 
-    for issuer in cards:
-        query += "{} tinyint(1) UNSIGNED DEFAULT 0, \n".format(issuer['name'])
-        for card in issuer['cards']:
-            query += ("{}_{} tinyint(1) UNSIGNED DEFAULT 0, \n"
-                    .format(issuer['name'],card['name']))
+    for column in catalog.card_columns:
+        query += "{} tinyint(1) UNSIGNED DEFAULT 0, \n".format(column)
 
     query = query[:-3] + ");"
     cur.execute(query)
     conn.commit()
+    conn.close()
 
 
-def build_keyword_db():
+def build_keyword_db(catalog=None):
     """wrapper script to initialize keyword mentions.
+
+    KWARGS:
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
     """
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8mb4',
-                       init_command='SET NAMES UTF8MB4')
+    conn = st.connect()
     cur = conn.cursor()
 
-    with open('keywords.json','r') as f:
-        keywords = json.load(f)['keywords']
+    if catalog is None:
+        catalog = cat.EntityCatalog()
 
     query = "CREATE TABLE Keywords (\n"
     query += "id VARCHAR(7) PRIMARY KEY NOT NULL UNIQUE, \n"
 
-    for tag in keywords:
-        for term in tag['terms']:
-            if tag['tag'] in ['REWARDS','FEE']:
-                query += ("{}_{} VARCHAR(150) DEFAULT NULL, \n"
-                          .format(term['term'],tag['tag']))
-            elif tag['tag'] == 'INTEREST':
-                pass
-            else:
-                query += "{} VARCHAR(150) DEFAULT NULL, \n".format(term['term'])
+    for column in catalog.keyword_columns:
+        query += "{} VARCHAR(150) DEFAULT NULL, \n".format(column)
 
-    query += "INTEREST VARCHAR(150) DEFAULT NULL);"
+    query = query[:-3] + ");"
 
     cur.execute(query)
+    conn.commit()
+    conn.close()
+
+
+# long-format tables, per dialect.  The Mentions primary key serves lookups by 
+# post, and the entity_post index by entity, each without touching the table 
+# rows.
+_MENTION_DDL = {
+    'mysql': [
+        "CREATE TABLE IF NOT EXISTS Entities ("
+        "entity_id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, "
+        "kind VARCHAR(10) NOT NULL, name VARCHAR(150) NOT NULL, "
+        "UNIQUE KEY kind_name (kind,name));",
+        "CREATE TABLE IF NOT EXISTS Mentions ("
+        "post_id VARCHAR(10) NOT NULL, entity_id INT UNSIGNED NOT NULL, "
+        "matched_term VARCHAR(150) NOT NULL, "
+        "PRIMARY KEY (post_id,entity_id,matched_term), "
+        "KEY entity_post (entity_id,post_id));"
+    ],
+    'sqlite': [
+        "CREATE TABLE IF NOT EXISTS Entities ("
+        "entity_id INTEGER PRIMARY KEY, "
+        "kind VARCHAR(10) NOT NULL, name VARCHAR(150) NOT NULL, "
+        "UNIQUE (kind,name));",
+        "CREATE TABLE IF NOT EXISTS Mentions ("
+        "post_id VARCHAR(10) NOT NULL, entity_id INTEGER NOT NULL, "
+        "matched_term VARCHAR(150) NOT NULL, "
+        "PRIMARY KEY (post_id,entity_id,matched_term)) WITHOUT ROWID;",
+        "CREATE INDEX IF NOT EXISTS entity_post ON Mentions "
+        "(entity_id,post_id);"
+    ]
+}
+
+
+def build_mention_db(catalog=None):
+    """initializes the long-format index: an Entities dictionary with one row 
+    per Card_Mentions or Keywords column (kind 'card' or 'keyword'), and a 
+    Mentions table of (post_id,entity_id,matched_term) rows.  Tables are only 
+    created if missing, and entities new to the catalog are added, so 
+    vocabulary changes never rebuild the table.
 
+    KWARGS:
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
 
-def populate_card_db(results):
-    """reads through list of results, populates flags in card DB.
+    RETURNS:
+        entities: dict.
+            map of (kind,name) to entity_id, see `sync_entities`.
+    """
+    conn = st.connect()
+    cur = conn.cursor()
+    for query in _MENTION_DDL[st.dialect()]:
+        cur.execute(query)
+    conn.commit()
+    conn.close()
 
-    ARGS:
-        results: list.
-            list of (id,[keywords]) from `find_card_keywords`.
+    return sync_entities(catalog=catalog)
+
+
+def sync_entities(catalog=None):
+    """adds any catalog entities missing from the Entities table.  Existing 
+    entities keep their ids, and entities dropped from the catalog are left 
+    in place, along with their mentions.
+
+    KWARGS:
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
+
+    RETURNS:
+        entities: dict.
+            map of (kind,name) to entity_id, for every entity in the table.
     """
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8mb4',
-                       init_command='SET NAMES UTF8MB4')
+    if catalog is None:
+        catalog = cat.EntityCatalog()
+
+    rows = [('card',name) for name in catalog.card_columns]
+    rows += [('keyword',name) for name in catalog.keyword_columns]
+
+    conn = st.connect()
     cur = conn.cursor()
+    cur.executemany("INSERT IGNORE INTO Entities (kind,name) VALUES (%s,%s);",
+                    rows)
+    conn.commit()
+    cur.execute("SELECT kind,name,entity_id FROM Entities;")
+    entities = {(kind,name): entity_id 
+                for kind,name,entity_id in cur.fetchall()}
+    conn.close()
+    return entities
 
-    # first, construct bank name remap - point any alt name of banks to 
-    # the tagname used in the DB
-    with open('banks.json','r') as f:
-        banks = json.load(f)['banks']
-
-    bank_remap = {}
-    bank_lookup = {}
-    for bank in banks:
-        name = bank['name']
-        alts = bank.get('alts',None)
-        bank_lookup[name] = alts
-        bank_remap[name] = name
-        if alts is not None:
-            for alt in alts:
-                bank_remap[alt] = name
-
-    with open('cards.json','r') as f:
-        cards = json.load(f)['issuer']
-
-    card_remap = {}
-    for issuer in cards:
-        issuer_name = issuer['name']
-        issuer_alt_names = bank_lookup[issuer_name]
-        if issuer_alt_names is not None:
-            issuer_names = [issuer_name] + issuer_alt_names
-        else:
-            issuer_names = [issuer_name]
 
-        for card in issuer['cards']:
-            card_name = card['name']
-            card_alts = card.get('alts',None)
-            tagname = "{}_{}".format(issuer_name,card_name)
+def entity_counts(kind=None):
+    """number of posts mentioning each entity in the long-format index.  
+    Counted from the entity_post index alone.
 
-            if card_alts is not None:
-                card_names = [card_name] + card_alts
-            else:
-                card_names = [card_name]
+    KWARGS:
+        kind: string or None.
+            'card' or 'keyword' to restrict to one kind.  Default None, all.
 
-            card_keywords = itertools.product(issuer_names,card_names)
-            card_keywords = ["{} {}".format(i,c) for i,c in card_keywords]
+    RETURNS:
+        counts: dict.
+            map of entity name to number of posts, for entities with any 
+            mentions.
+    """
+    query = ("SELECT e.name,c.posts FROM Entities e JOIN "
+             "(SELECT entity_id,COUNT(DISTINCT post_id) AS posts "
+             "FROM Mentions GROUP BY entity_id) c "
+             "ON c.entity_id = e.entity_id")
+    args = ()
+    if kind is not None:
+        query += " WHERE e.kind = %s"
+        args = (kind,)
+
+    conn = st.connect()
+    cur = conn.cursor()
+    cur.execute(query + ";",args)
+    counts = dict(cur.fetchall())
+    conn.close()
+    return counts
 
-            for c in card_keywords:
-                card_remap[c] = tagname
 
-            for c in card_names:
-                card_remap[c] = tagname
+# ON DUPLICATE KEY clauses for `_bulk_upsert`.  Flags are only ever raised, and 
+# keyword lists only overwritten where the incoming row has a value, matching 
+# a per-row UPDATE of just the mentioned columns.
+_flag_update = "`{0}`=GREATEST(`{0}`,VALUES(`{0}`))"
+_text_update = "`{0}`=COALESCE(VALUES(`{0}`),`{0}`)"
 
-    # TESTING
-    #for key in build_keywords():
-    #    bank = bank_remap.get(key,None)
-    #    card = card_remap.get(key,None)
-    #    print("{}\t{}\t{}".format(key,bank,card))
 
+def _bulk_upsert(cur,table,rows,default,update):
+    """writes a batch of rows as a single parameterized multi-row 
+    INSERT ... ON DUPLICATE KEY UPDATE.
+
+    ARGS:
+        cur: pymysql.Cursor object.
+            cursor to execute on.
+        table: string.
+            target table name.
+        rows: list.
+            list of (id,{column: value}) tuples.
+        default:
+            value written for columns a row does not mention.
+        update: string.
+            format template for each column's ON DUPLICATE KEY assignment.
+    """
+    columns = set()
+    for _,tags in rows:
+        columns.update(tags)
+    columns = sorted(columns)
+
+    rows = [(index,[tags.get(col,default) for col in columns]) 
+            for index,tags in rows]
+    _bulk_upsert_columns(cur,table,columns,rows,update)
+
+
+def _bulk_upsert_columns(cur,table,columns,rows,update):
+    """as `_bulk_upsert`, for rows already laid out against a column list.
+
+    ARGS:
+        cur: pymysql.Cursor object.
+            cursor to execute on.
+        table: string.
+            target table name.
+        columns: list.
+            column names, in the order of each row's values.
+        rows: list.
+            list of (id,[values]) tuples.
+        update: string.
+            format template for each column's ON DUPLICATE KEY assignment.
+    """
+    placeholders = "({})".format(','.join(['%s']*(len(columns)+1)))
+    query = ("INSERT INTO {} (`id`,{}) VALUES {} ON DUPLICATE KEY UPDATE {};"
+             .format(table,
+                     ','.join(['`{}`'.format(col) for col in columns]),
+                     ','.join([placeholders]*len(rows)),
+                     ','.join([update.format(col) for col in columns])))
+
+    args = []
+    for index,values in rows:
+        args.append(index)
+        args += values
+    cur.execute(query,args)
+
+
+def populate_card_db(results,batch_size=1000,commit_every=10,catalog=None):
+    """reads through list of results, populates flags in card DB.  Rows are 
+    written in batches, as one multi-row upsert per batch.
+
+    ARGS:
+        results: iterable.
+            list or stream of (id,[keywords]) from `find_card_keywords`.
+
+    KWARGS:
+        batch_size: int.
+            number of rows per INSERT statement.  Default 1000.
+        commit_every: int.
+            commit after this many batches.  Default 10.
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
+    """
+    conn = st.connect()
+    cur = conn.cursor()
+
+    if catalog is None:
+        catalog = cat.EntityCatalog()
+    bank_remap = catalog.bank_remap
+    card_remap = catalog.card_remap
+
+    batch = []
+    n_batches = 0
     for index,keywords in results:
         tags = []
         for key in keywords:
@@ -280,72 +611,45 @@ def populate_card_db(results):
         tags = set(tags)
 
         if len(tags) > 0:
-            # write into SQL db
-            # create empty row, or ignore if already exists
-            cur.execute("INSERT INTO Card_Mentions (`id`) VALUES (%s) "
-                        "ON DUPLICATE KEY UPDATE `id`=`id`",(index))
-
-            query = "UPDATE Card_Mentions SET \n"
-            for tag in tags:
-                query += "{}=True,\n".format(tag)
-            query = query[:-2] + " WHERE `id`='{}';".format(index)
-            cur.execute(query)
-
+            batch.append((index,dict.fromkeys(tags,1)))
+            if len(batch) >= batch_size:
+                _bulk_upsert(cur,'Card_Mentions',batch,0,_flag_update)
+                batch = []
+                n_batches += 1
+                if n_batches % commit_every == 0:
+                    conn.commit()
+
+    if batch:
+        _bulk_upsert(cur,'Card_Mentions',batch,0,_flag_update)
     conn.commit()
+    conn.close()
 
 
-def populate_keyword_db(results):
-    """reads through list of results, populates keyword db.
+def populate_keyword_db(results,batch_size=1000,commit_every=10,catalog=None):
+    """reads through list of results, populates keyword db.  Rows are 
+    written in batches, as one multi-row upsert per batch.
 
     ARGS:
-        results: list.
-            list of (id,[keywords]) from `find_card_keywords`.
+        results: iterable.
+            list or stream of (id,[keywords]) from `find_card_keywords`.
+
+    KWARGS:
+        batch_size: int.
+            number of rows per INSERT statement.  Default 1000.
+        commit_every: int.
+            commit after this many batches.  Default 10.
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
     """
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8mb4',
-                       init_command='SET NAMES UTF8MB4')
+    conn = st.connect()
     cur = conn.cursor()
 
-    # construct keyword remap:
-    with open('keywords.json','r') as f:
-        keywords = json.load(f)['keywords']
-
-    tag_remap = {}
-    for tag in keywords:
-        name = tag['tag']
-        for term in tag['terms']:
-            alts = term.get('alts',None)
-            if name in ['REWARDS','FEE']:
-                tagname = "{}_{}".format(term['term'],name)
-                kws = ["{} {}".format(term['term'],name)]
-                kws.append(term['term'])
-                if alts is not None:
-                    kws += [alt+" "+name for alt in alts]
-                    kws += alts
-            elif name == "INTEREST":
-                tagname = "INTEREST"
-                kws = [tagname]
-                kws.append(term['term'])
-                if alts is not None:
-                    kws += alts
-                    kws += [alt+" "+name for alt in alts]
-            else:
-                tagname = term['term']
-                kws = [tagname]
-                if alts is not None:
-                    kws += alts
-
-            for kw in kws:
-                tag_remap[kw] = tagname
-
-    # TESTING
-    #for key in build_keywords():
-    #    tag = tag_remap.get(key,None)
-    #    print("{}\t{}".format(key,tag))
+    if catalog is None:
+        catalog = cat.EntityCatalog()
+    tag_remap = catalog.tag_remap
 
+    batch = []
+    n_batches = 0
     for index,keywords in results:
         tags = {}
         for key in keywords:
@@ -361,16 +665,577 @@ def populate_keyword_db(results):
             tags[tag] = ','.join(tags[tag])
 
         if len(tags) > 0:
-            # write into SQL db
-            # create empty row, or ignore if already exists
-            cur.execute("INSERT INTO Keywords (`id`) VALUES (%s) "
-                        "ON DUPLICATE KEY UPDATE `id`=`id`",(index))
+            batch.append((index,tags))
+            if len(batch) >= batch_size:
+                _bulk_upsert(cur,'Keywords',batch,None,_text_update)
+                batch = []
+                n_batches += 1
+                if n_batches % commit_every == 0:
+                    conn.commit()
+
+    if batch:
+        _bulk_upsert(cur,'Keywords',batch,None,_text_update)
+    conn.commit()
+    conn.close()
+
+
+def _merged_batches(batches,batch_size):
+    """groups a stream of `ordinals.OrdinalBatch` into merged, deduplicated 
+    batches of at least `batch_size` posts (bar the last).
+    """
+    pending = []
+    rows = 0
+    for batch in batches:
+        pending.append(batch)
+        rows += len(batch.ids)
+        if rows >= batch_size:
+            yield od.merge(pending)
+            pending = []
+            rows = 0
+    if pending:
+        yield od.merge(pending)
+
+
+def populate_card_ordinals(batches,batch_size=1000,commit_every=10,
+                           catalog=None):
+    """as `populate_card_db`, for results in the ordinal format.  Each merged 
+    batch is expanded to a flag matrix and written as one upsert over just 
+    the columns it touches.
+
+    ARGS:
+        batches: iterable.
+            list or stream of `ordinals.OrdinalBatch`.
+
+    KWARGS:
+        batch_size: int.
+            minimum number of posts per INSERT statement.  Default 1000.
+        commit_every: int.
+            commit after this many batches.  Default 10.
+        catalog: catalog.EntityCatalog or None.
+            catalog the batches were encoded against.  Default None, 
+            compiles a fresh one.
+    """
+    conn = st.connect()
+    cur = conn.cursor()
 
-            query = "UPDATE Keywords SET \n"
-            for tag in tags:
-                query += "{}='{}',\n".format(tag,tags[tag])
+    if catalog is None:
+        catalog = cat.EntityCatalog()
 
-            query = query[:-2] + " WHERE `id`='{}';".format(index)
-            cur.execute(query)
+    n_batches = 0
+    for batch in _merged_batches(batches,batch_size):
+        ids,matrix = od.card_matrix(batch,catalog)
+        if len(ids) == 0:
+            continue
 
-    conn.commit()
\ No newline at end of file
+        used = matrix.any(axis=0)
+        columns = [c for c,u in zip(catalog.card_columns,used) if u]
+        rows = list(zip(ids.tolist(),matrix[:,used].tolist()))
+        _bulk_upsert_columns(cur,'Card_Mentions',columns,rows,_flag_update)
+
+        n_batches += 1
+        if n_batches % commit_every == 0:
+            conn.commit()
+
+    conn.commit()
+    conn.close()
+
+
+def populate_keyword_ordinals(batches,batch_size=1000,commit_every=10,
+                              catalog=None):
+    """as `populate_keyword_db`, for results in the ordinal format.
+
+    ARGS:
+        batches: iterable.
+            list or stream of `ordinals.OrdinalBatch`.
+
+    KWARGS:
+        batch_size: int.
+            minimum number of posts per INSERT statement.  Default 1000.
+        commit_every: int.
+            commit after this many batches.  Default 10.
+        catalog: catalog.EntityCatalog or None.
+            catalog the batches were encoded against.  Default None, 
+            compiles a fresh one.
+    """
+    conn = st.connect()
+    cur = conn.cursor()
+
+    if catalog is None:
+        catalog = cat.EntityCatalog()
+
+    n_batches = 0
+    for batch in _merged_batches(batches,batch_size):
+        rows = od.keyword_values(batch,catalog)
+        if len(rows) == 0:
+            continue
+
+        _bulk_upsert(cur,'Keywords',rows,None,_text_update)
+
+        n_batches += 1
+        if n_batches % commit_every == 0:
+            conn.commit()
+
+    conn.commit()
+    conn.close()
+
+
+def _mention_lookup(catalog,entities):
+    """map of keyword to the entity_ids it mentions, from the catalog remaps 
+    and the Entities ids of `sync_entities`.
+    """
+    lookup = {}
+    for term in catalog.keywords:
+        ids = set()
+        for kind,remap in [('card',catalog.bank_remap),
+                           ('card',catalog.card_remap),
+                           ('keyword',catalog.tag_remap)]:
+            name = remap.get(term,None)
+            if (kind,name) in entities:
+                ids.add(entities[(kind,name)])
+        if ids:
+            lookup[term] = sorted(ids)
+    return lookup
+
+
+def populate_mention_db(results,batch_size=1000,commit_every=10,
+                        catalog=None):
+    """reads through list of results, appends a Mentions row for every 
+    (post,entity,keyword) triple.  Rows are written in batches, as one 
+    multi-row INSERT IGNORE per batch, so re-indexing a post is a no-op.  
+    Entities new to the catalog are added first, see `sync_entities`.
+
+    ARGS:
+        results: iterable.
+            list or stream of (id,[keywords]) from `find_card_keywords`, or 
+            of `ordinals.OrdinalBatch`.
+
+    KWARGS:
+        batch_size: int.
+            number of rows per INSERT statement.  Default 1000.
+        commit_every: int.
+            commit after this many batches.  Default 10.
+        catalog: catalog.EntityCatalog or None.
+            precompiled entity catalog.  Default None, compiles a fresh one.
+    """
+    if catalog is None:
+        catalog = cat.EntityCatalog()
+    lookup = _mention_lookup(catalog,sync_entities(catalog=catalog))
+
+    conn = st.connect()
+    cur = conn.cursor()
+
+    def write(batch):
+        query = ("INSERT IGNORE INTO Mentions (post_id,entity_id,matched_term) "
+                 "VALUES {};".format(','.join(['(%s,%s,%s)']*len(batch))))
+        cur.execute(query,[value for row in batch for value in row])
+
+    batch = []
+    n_batches = 0
+    for result in results:
+        if isinstance(result,od.OrdinalBatch):
+            chunk = od.decode(result,catalog)
+        else:
+            chunk = [result]
+
+        for index,keywords in chunk:
+            rows = set()
+            for key in keywords:
+                for entity_id in lookup.get(key,()):
+                    rows.add((index,entity_id,key))
+            batch += sorted(rows)
+
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = []
+                n_batches += 1
+                if n_batches % commit_every == 0:
+                    conn.commit()
+
+    if batch:
+        write(batch)
+    conn.commit()
+    conn.close()
+
+
+# per-process matcher, installed by `_init_worker` in pool workers
+_matcher = None
+_catalog = None
+_cache = None
+
+
+def _init_worker(matcher,catalog=None,cache=None):
+    """pool initializer, installs the compiled matcher in the worker process, 
+    plus the catalog if results are to be ordinal-encoded.  `cache` is a dict 
+    of `match_cache.MatchCache` arguments, for a per-worker match cache.
+    """
+    global _matcher, _catalog, _cache
+    _matcher = matcher
+    _catalog = catalog
+    _cache = mc.MatchCache(**cache) if cache is not None else None
+
+
+def _match_chunk(chunk):
+    """runs `find_card_keywords` over a chunk of (id,body) tuples in a worker.
+
+    RETURNS:
+        result: tuple.
+            tuple of (rows read, [(id,[keywords])], cache counts) with 
+            non-matches dropped, or (rows read, `ordinals.OrdinalBatch`, 
+            cache counts) if the worker holds a catalog.  Cache counts are 
+            the chunk's {'cache_hits','cache_misses','cache_shared_hits'}, 
+            empty without a cache.
+    """
+    results = []
+    counts = {}
+    with mx.Stage('match') as stage:
+        if _cache is not None:
+            before = _cache.stats()
+        for text in chunk:
+            result = find_card_keywords(text,None,matcher=_matcher,
+                                        cache=_cache)
+            if result is not None:
+                results.append(result)
+        if _cache is not None:
+            _cache.flush()
+            after = _cache.stats()
+            for key in ['hits','misses','shared_hits']:
+                counts['cache_'+key] = after[key] - before[key]
+        stage.add(docs=len(chunk),matched=len(results),**counts)
+
+    if _catalog is not None:
+        results = od.encode(results,_catalog)
+    return (len(chunk),results,counts)
+
+
+def _drain(q,stats,flatten=True):
+    """generator over results from a write-stage queue, until the `None` 
+    sentinel is reached.  Counts rows handed to the stage in `stats`, and 
+    sets `stats['drained']` once the sentinel is taken.  With `flatten` 
+    False, yields whole `ordinals.OrdinalBatch` items instead.
+    """
+    while True:
+        chunk = q.get()
+        if chunk is None:
+            stats['drained'] = True
+            return
+        if not flatten:
+            stats['rows'] += len(chunk.ids)
+            yield chunk
+            continue
+        for result in chunk:
+            stats['rows'] += 1
+            yield result
+
+
+def _write_stage(name,populate,q,stats,flatten=True):
+    """thread target for a write stage -- runs `populate` over the queue, 
+    recorded as metrics stage `name`.  On error, keeps draining the queue 
+    (unless the sentinel was already taken, e.g. when the final commit 
+    fails) so the producer is never blocked.
+    """
+    stats['start'] = time.time()
+    try:
+        with mx.Stage(name) as stage:
+            try:
+                populate(_drain(q,stats,flatten))
+            finally:
+                stage.add(rows=stats['rows'])
+    except Exception as e:
+        stats['error'] = e
+        if not stats.get('drained'):
+            while q.get() is not None:
+                pass
+    stats['end'] = time.time()
+
+
+def _raise_errors(stages):
+    """re-raises the first error recorded by a write stage.
+    """
+    for stats in stages.values():
+        if 'error' in stats:
+            raise stats['error']
+
+
+def _rate(stats):
+    """formats a stage's row count and throughput.
+    """
+    elapsed = stats.get('end',time.time()) - stats['start']
+    rate = stats['rows']/elapsed if elapsed > 0 else 0.
+    return "{} rows in {:.1f}s ({:.0f} rows/sec)".format(stats['rows'],
+                                                         elapsed,rate)
+
+
+def run_index(limit=None,n_jobs=None,chunksize=1000,queue_depth=8,
+              stopwords=None,report_every=100,batch_size=10000,resume=None,
+              incremental=False,rebuild=False,
+              state_file='index_state.json',write_batch=1000,commit_every=10,
+              catalog_cache=None,ordinal=False,layout='wide',postings=None,
+              match_cache=100000,match_cache_file=None,metrics=None,
+              profile=None):
+    """streaming driver for the full indexer.  Rows from `get_texts` are 
+    chunked and matched in a process pool, and matched results are fed to 
+    `populate_card_db` and `populate_keyword_db` through bounded queues, each 
+    running in its own thread with its own connection.  At most `queue_depth` 
+    chunks are in flight in the pool and in each write queue, so memory stays 
+    flat regardless of corpus size.  With `layout` 'long', a single 
+    `populate_mention_db` stage writes the Mentions table instead.  With 
+    `postings`, matches are also 
+    written to an on-disk inverted index, see `postings`.
+
+    KWARGS:
+        limit: int or None.
+            optional cap on number of posts to pull, passed to `get_texts`.
+        n_jobs: int or None.
+            number of matcher processes.  Default None, uses all cores.
+        chunksize: int.
+            number of posts per chunk sent to a worker.  Default 1000.
+        queue_depth: int.
+            max chunks in flight in the pool and in each write queue.  
+            Default 8.
+        stopwords: set or None.
+            set of upper-case stopwords to strip.  Default None.
+        report_every: int or None.
+            print progress every `report_every` chunks.  Default 100.
+        batch_size: int.
+            rows per query in `get_texts`.  Default 10000.
+        resume: tuple or None.
+            optional (table,id) to resume from, passed to `get_texts`.  The 
+            last (table,id) committed, including by a run that failed or was 
+            interrupted, is printed and saved to `state_file`, see 
+            `save_position`.
+        incremental: boolean.
+            only index posts missing from the processed-ids ledger (see 
+            `build_ledger_db`), i.e. those added since the last incremental 
+            run, including older months loaded since.  The run number and 
+            layout are kept in `state_file`.  If the keyword JSON files or 
+            `layout` have changed since that run, the index tables are 
+            rebuilt from scratch instead.  Default False.
+        rebuild: boolean.
+            with `incremental`, force a full rebuild of the index tables.  
+            Default False.
+        state_file: string.
+            path to the incremental state file, which also keeps the last 
+            position.  Default 'index_state.json'.
+        write_batch: int.
+            rows per bulk INSERT in the write stages.  Default 1000.
+        commit_every: int.
+            batches per commit in the write stages.  Default 10.  On SQLite 
+            with more than one write stage, every batch is committed, see 
+            `storage`.
+        catalog_cache: string or None.
+            path to a pickled entity catalog, see `catalog.load_catalog`.  
+            Default None, compiles the catalog from the JSON files.
+        ordinal: boolean.
+            pass results from the workers to the write stages in the 
+            vectorized `ordinals` format.  Default False.
+        layout: string.
+            'wide' to write the Card_Mentions and Keywords tables, or 'long' 
+            to write the Mentions and Entities tables, see 
+            `build_mention_db`.  Default 'wide'.
+        postings: string or None.
+            directory of a `postings` index to add this run's matches to, as 
+            a new segment.  Cleared along with the index tables on a rebuild.  
+            Default None, no postings index.
+        match_cache: int or None.
+            bodies kept in each worker's match cache, so repeated bodies 
+            ("[deleted]", boilerplate) are matched once, see `match_cache`.  
+            Default 100000.  None or 0 disables the cache.
+        match_cache_file: string or None.
+            SQLite file for a match cache shared by the workers and kept 
+            across runs.  Default None, per-worker memory only.
+        metrics: string or None.
+            JSON-lines file to record stage metrics in ('read', 'match', 
+            'write_card', 'write_keyword' or 'write_mention', 'write_ledger', 
+            and queue depths under 'index'), 
+            see `metrics.configure`.  Default None, leaves the current 
+            setting.
+        profile: iterable or None.
+            stage names to profile, see `metrics.configure`.  Default None, 
+            leaves the current setting.
+    """
+    if metrics is not None or profile is not None:
+        mx.configure(path=metrics,profile=profile)
+
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    catalog = cat.load_catalog(cache_file=catalog_cache)
+    matcher = build_matcher(stopwords=stopwords,catalog=catalog)
+
+    run = None
+    if incremental:
+        state = load_state(state_file)
+        current_hash = catalog.source_hash
+        # the ledger covers one layout's tables, so switching layouts 
+        # rebuilds the new layout's tables from scratch
+        if (rebuild or state.get('keyword_hash') != current_hash or 
+                state.get('layout','wide') != layout):
+            print("keyword definitions or layout changed, or no index state, "
+                  "rebuilding index tables")
+            reset_index_tables(catalog=catalog,layout=layout)
+            if postings is not None:
+                ps.clear(postings)
+            state = {}
+
+        build_ledger_db()
+        run = state.get('run',0) + 1
+
+    # write stages, each fed by its own queue
+    if layout == 'long':
+        build_mention_db(catalog=catalog)
+        populate = collections.OrderedDict([('mention',populate_mention_db)])
+    elif ordinal:
+        populate = collections.OrderedDict([
+            ('card',populate_card_ordinals),
+            ('keyword',populate_keyword_ordinals)])
+    else:
+        populate = collections.OrderedDict([('card',populate_card_db),
+                                            ('keyword',populate_keyword_db)])
+
+    if st.dialect() == 'sqlite' and len(populate) + incremental > 1:
+        # a SQLite writer holds the database lock until it commits, so one 
+        # waiting on its queue with batches uncommitted would stall the 
+        # others, and through their full queues the whole run
+        commit_every = 1
+
+    write_kwargs = {'batch_size': write_batch, 'commit_every': commit_every,
+                    'catalog': catalog}
+    targets = collections.OrderedDict(
+        (name,(functools.partial(fn,**write_kwargs),not ordinal))
+        for name,fn in populate.items())
+    if incremental:
+        # every post read, matched or not, is recorded in the ledger
+        targets['ledger'] = (functools.partial(populate_ledger,run=run,
+                                               batch_size=write_batch,
+                                               commit_every=commit_every),
+                             True)
+
+    stages = collections.OrderedDict()
+    for name in ['read','match'] + list(targets):
+        stages[name] = {'rows': 0, 'start': time.time()}
+
+    queues = collections.OrderedDict(
+        (name,queue.Queue(maxsize=queue_depth)) for name in targets)
+    with_meta = postings is not None or incremental
+    # always read with the table, for the resume position
+    texts = get_texts(limit=limit,batch_size=batch_size,resume=resume,
+                      ledger=run-1 if incremental else None,meta=True)
+    postings_writer = None
+    if postings is not None:
+        postings_writer = ps.PostingsWriter(postings,catalog)
+
+    cache_args = None
+    if match_cache:
+        cache_args = {'max_entries': match_cache, 'path': match_cache_file,
+                      'namespace': matcher.fingerprint}
+    worker_args = (matcher,catalog if ordinal else None,cache_args)
+
+    writers = [
+        threading.Thread(target=_write_stage,
+                         args=('write_'+name,fn,queues[name],stages[name],
+                               flatten))
+        for name,(fn,flatten) in targets.items()
+    ]
+    for writer in writers:
+        writer.start()
+
+    def forward(pending):
+        result,table,meta,position = pending.popleft()
+        rows,results,counts = result.get()
+        stages['match']['rows'] += rows
+        for key,value in counts.items():
+            cache_counts[key] += value
+        if postings_writer is not None:
+            postings_writer.add(results,table,meta)
+        for name,q in queues.items():
+            if name == 'ledger':
+                q.put([(index,table) for _,index in meta])
+            else:
+                q.put(results)
+        progress['position'] = position
+        # a failed writer is only draining, so stop reading and matching
+        _raise_errors(stages)
+
+    pending = collections.deque()
+    progress = {'position': None}
+    finished = False
+    cache_counts = collections.Counter()
+    n_chunks = 0
+    try:
+        with mp.Pool(n_jobs,initializer=_init_worker,
+                     initargs=worker_args) as pool:
+            while True:
+                chunk = list(itertools.islice(texts,chunksize))
+                if not chunk:
+                    break
+                stages['read']['rows'] += len(chunk)
+                n_chunks += 1
+
+                # one match job per table, since comment and submission ids 
+                # overlap and results carry only the id
+                for table,group in itertools.groupby(chunk,
+                                                     key=lambda t: t[2]):
+                    group = list(group)
+                    meta = None
+                    if with_meta:
+                        meta = {(table,text[0]): text[3] for text in group}
+                    job = [text[:2] for text in group]
+                    pending.append((pool.apply_async(_match_chunk,(job,)),
+                                    table,meta,(table,group[-1][0])))
+                while len(pending) >= queue_depth:
+                    forward(pending)
+                depths = [(name+'_queue',q.qsize())
+                          for name,q in queues.items()]
+                mx.gauge('index',pending=len(pending),**dict(depths))
+
+                if report_every and n_chunks % report_every == 0:
+                    print("read {}, matched {}, queued {} {}"
+                          .format(_rate(stages['read']),
+                                  _rate(stages['match']),
+                                  '/'.join(queues),
+                                  '/'.join(str(d) for _,d in depths)))
+
+            stages['read']['end'] = time.time()
+            mx.record('read',rows=stages['read']['rows'],
+                      seconds=stages['read']['end']-stages['read']['start'])
+            while pending:
+                forward(pending)
+            stages['match']['end'] = time.time()
+            finished = True
+    finally:
+        for q in queues.values():
+            q.put(None)
+        for writer in writers:
+            writer.join()
+        # everything forwarded is committed once the writers finish cleanly
+        position = progress['position']
+        if position is not None and not any('error' in stats 
+                                            for stats in stages.values()):
+            if not finished and postings_writer is not None:
+                postings_writer.write()
+            save_position(position,state_file)
+            print("last committed: {} {}, saved to {}"
+                  .format(position[0],position[1],state_file))
+
+    for name,stats in stages.items():
+        print("{}: {}".format(name,_rate(stats)))
+    if cache_args is not None:
+        lookups = cache_counts['cache_hits'] + cache_counts['cache_misses']
+        print("match cache: {} hits ({} shared), {} misses ({:.1%} hit rate)"
+              .format(cache_counts['cache_hits'],
+                      cache_counts['cache_shared_hits'],
+                      cache_counts['cache_misses'],
+                      cache_counts['cache_hits']/lookups if lookups else 0.))
+
+    _raise_errors(stages)
+
+    if postings_writer is not None:
+        with mx.Stage('write_postings') as stage:
+            stage.add(postings=postings_writer.count)
+            postings_writer.write()
+
+    if incremental:
+        state = {'keyword_hash': current_hash, 'layout': layout, 'run': run}
+        if progress['position'] is not None:
+            state['position'] = list(progress['position'])
+        save_state(state,state_file)
@@ -0,0 +1,299 @@
+"""compiled catalog of bank, card and keyword entities.  Parses banks.json, 
+cards.json and keywords.json once and precomputes everything the tokenizer, 
+matcher and index writers derive from them.
+"""
+
+
+import language_tools as lt
+import json
+import itertools
+import hashlib
+import os
+import pickle
+
+
+SOURCES = ['banks.json','cards.json','keywords.json']
+
+# hack -- remove common single-word entities to avoid false positives
+REMOVALS = ['CARD','DC','FREEDOM','GOLD','GREEN','INFINITE','IT','OPEN',
+            'JOURNEY','SPARK','AF FEE','INTEREST INTEREST',
+            'GRACE PERIOD FEE','MINIMUM PAYMENT PAYMENT']
+
+
+def source_hash(path='.'):
+    """content hash of the keyword definition files.
+
+    KWARGS:
+        path: string.
+            directory containing the JSON files.  Default '.'.
+
+    RETURNS:
+        digest: string.
+            hex SHA-1 digest over banks.json, cards.json and keywords.json.
+    """
+    digest = hashlib.sha1()
+    for filename in SOURCES:
+        with open(os.path.join(path,filename),'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _keywords(banks,cards,other,mwes):
+    """master set of keywords to check, see `build_index.build_keywords`.
+    """
+    keywords = []
+
+    for bank in banks:
+        keywords.append(bank['name'])
+        alts = bank.get('alts',None)
+        if alts is not None:
+            keywords += alts
+
+    for card in cards:
+        for instance in card['cards']:
+            keywords.append(instance['name'])
+            alts = instance.get('alts',None)
+            if alts is not None:
+                keywords += alts
+
+    for tag in other:
+        for term in tag['terms']:
+            keywords.append(term['term'])
+            alts = term.get('alts',None)
+            if alts is not None:
+                keywords += alts
+
+    for mwe in mwes:
+        keywords.append(' '.join(mwe))
+
+    keywords = set(keywords)
+    keywords.difference_update(set(REMOVALS))
+    return keywords
+
+
+def _card_remaps(banks,cards):
+    """maps every bank and card keyword to its Card_Mentions column.
+
+    RETURNS:
+        remaps: tuple.
+            tuple of (bank_remap,card_remap) dicts.
+    """
+    # point any alt name of banks to the tagname used in the DB
+    bank_remap = {}
+    bank_lookup = {}
+    for bank in banks:
+        name = bank['name']
+        alts = bank.get('alts',None)
+        bank_lookup[name] = alts
+        bank_remap[name] = name
+        if alts is not None:
+            for alt in alts:
+                bank_remap[alt] = name
+
+    card_remap = {}
+    for issuer in cards:
+        issuer_name = issuer['name']
+        issuer_alt_names = bank_lookup[issuer_name]
+        if issuer_alt_names is not None:
+            issuer_names = [issuer_name] + issuer_alt_names
+        else:
+            issuer_names = [issuer_name]
+
+        for card in issuer['cards']:
+            card_name = card['name']
+            card_alts = card.get('alts',None)
+            tagname = "{}_{}".format(issuer_name,card_name)
+
+            if card_alts is not None:
+                card_names = [card_name] + card_alts
+            else:
+                card_names = [card_name]
+
+            card_keywords = itertools.product(issuer_names,card_names)
+            card_keywords = ["{} {}".format(i,c) for i,c in card_keywords]
+
+            for c in card_keywords:
+                card_remap[c] = tagname
+
+            for c in card_names:
+                card_remap[c] = tagname
+
+    return (bank_remap,card_remap)
+
+
+def _tag_remap(other):
+    """maps every other keyword to its Keywords column.
+    """
+    tag_remap = {}
+    for tag in other:
+        name = tag['tag']
+        for term in tag['terms']:
+            alts = term.get('alts',None)
+            if name in ['REWARDS','FEE']:
+                tagname = "{}_{}".format(term['term'],name)
+                kws = ["{} {}".format(term['term'],name)]
+                kws.append(term['term'])
+                if alts is not None:
+                    kws += [alt+" "+name for alt in alts]
+                    kws += alts
+            elif name == "INTEREST":
+                tagname = "INTEREST"
+                kws = [tagname]
+                kws.append(term['term'])
+                if alts is not None:
+                    kws += alts
+                    kws += [alt+" "+name for alt in alts]
+            else:
+                tagname = term['term']
+                kws = [tagname]
+                if alts is not None:
+                    kws += alts
+
+            for kw in kws:
+                tag_remap[kw] = tagname
+
+    return tag_remap
+
+
+def _card_columns(cards):
+    """Card_Mentions flag columns, in DDL order.
+    """
+    columns = []
+    for issuer in cards:
+        columns.append(issuer['name'])
+        for card in issuer['cards']:
+            columns.append("{}_{}".format(issuer['name'],card['name']))
+    return columns
+
+
+def _keyword_columns(other):
+    """Keywords text columns, in DDL order.
+    """
+    columns = []
+    for tag in other:
+        for term in tag['terms']:
+            if tag['tag'] in ['REWARDS','FEE']:
+                columns.append("{}_{}".format(term['term'],tag['tag']))
+            elif tag['tag'] != 'INTEREST':
+                columns.append(term['term'])
+    columns.append('INTEREST')
+    return columns
+
+
+class EntityCatalog(object):
+    """compiled entity catalog.  All derived lookups are plain lists, sets and 
+    dicts, so a catalog pickles to a small cache file that worker processes 
+    can load in milliseconds.
+
+    KWARGS:
+        path: string.
+            directory containing banks.json, cards.json and keywords.json.  
+            Default '.'.
+
+    ATTRIBUTES:
+        source_hash: string.
+            `source_hash` of the files the catalog was built from.
+        keywords: set.
+            keyword strings, as from `build_index.build_keywords`.
+        mwes: list.
+            multi-word entities, as from `language_tools.multi_word_entities`.
+        bank_remap, card_remap: dict.
+            keyword to Card_Mentions column.
+        tag_remap: dict.
+            keyword to Keywords column.
+        card_columns, keyword_columns: list.
+            column names of Card_Mentions and Keywords, in DDL order.
+        terms: list.
+            sorted keywords, giving each keyword its term ordinal.
+        term_index: dict.
+            keyword to term ordinal.
+        term_card_columns: list.
+            per term ordinal, tuple of the Card_Mentions column ordinals it 
+            flags.
+        term_keyword_column: list.
+            per term ordinal, the Keywords column ordinal it fills, or -1.
+    """
+    def __init__(self,path='.'):
+        self.source_hash = source_hash(path)
+        raw = {}
+        for filename in SOURCES:
+            with open(os.path.join(path,filename),'rb') as f:
+                raw[filename] = json.load(f)
+        banks = raw['banks.json']
+        cards = raw['cards.json']
+        other = raw['keywords.json']
+
+        self.mwes = lt.multi_word_entities(banks=banks,cards=cards,
+                                           other=other)
+        self.keywords = _keywords(banks['banks'],cards['issuer'],
+                                  other['keywords'],self.mwes)
+        self.bank_remap,self.card_remap = _card_remaps(banks['banks'],
+                                                       cards['issuer'])
+        self.tag_remap = _tag_remap(other['keywords'])
+        self.card_columns = _card_columns(cards['issuer'])
+        self.keyword_columns = _keyword_columns(other['keywords'])
+
+        # ordinal lookup tables, for the vectorized result format in 
+        # `ordinals`
+        self.terms = sorted(self.keywords)
+        self.term_index = {term: i for i,term in enumerate(self.terms)}
+        card_ordinals = {c: i for i,c in enumerate(self.card_columns)}
+        keyword_ordinals = {c: i for i,c in enumerate(self.keyword_columns)}
+        self.term_card_columns = []
+        self.term_keyword_column = []
+        for term in self.terms:
+            columns = [self.bank_remap.get(term),self.card_remap.get(term)]
+            columns = [card_ordinals[c] for c in columns 
+                       if c in card_ordinals]
+            self.term_card_columns.append(tuple(columns))
+            self.term_keyword_column.append(
+                keyword_ordinals.get(self.tag_remap.get(term),-1))
+
+    def matcher(self,stopwords=None):
+        """compiles a keyword matcher over the catalog.
+
+        KWARGS:
+            stopwords: set or None.
+                set of upper-case stopwords to strip.  Default None.
+
+        RETURNS:
+            matcher: language_tools.KeywordMatcher.
+                compiled matcher.
+        """
+        return lt.KeywordMatcher(self.keywords,mwes=self.mwes,
+                                 stopwords=stopwords)
+
+    def save(self,cache_file):
+        """pickles the catalog to `cache_file`, atomically.
+        """
+        tmpfile = cache_file + '.tmp'
+        with open(tmpfile,'wb') as f:
+            pickle.dump(self,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile,cache_file)
+
+
+def load_catalog(cache_file=None,path='.'):
+    """loads the entity catalog, from `cache_file` if it is present and was 
+    built from the current JSON files, otherwise by compiling it fresh (and 
+    writing the cache).
+
+    KWARGS:
+        cache_file: string or None.
+            path to pickled catalog cache.  Default None, no caching.
+        path: string.
+            directory containing the JSON files.  Default '.'.
+
+    RETURNS:
+        catalog: EntityCatalog.
+            compiled catalog.
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file,'rb') as f:
+            catalog = pickle.load(f)
+        if catalog.source_hash == source_hash(path):
+            return catalog
+
+    catalog = EntityCatalog(path)
+    if cache_file is not None:
+        catalog.save(cache_file)
+    return catalog
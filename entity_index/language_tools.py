@@ -7,10 +7,24 @@ from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
 import string
 import json
+import re
+import os
+import collections
+import functools
+import hashlib
 
 
 _lemmatizer = WordNetLemmatizer()
 
+# lemma table to warm-start each process's `Lemmatizer`, see `lemmatizer`
+LEMMA_TABLE_ENV = 'REDDIT_LEMMAS'
+
+# same pattern/flags as nltk.RegexpTokenizer(r'\w+')
+_word_pattern = re.compile(r'\w+', re.UNICODE | re.MULTILINE | re.DOTALL)
+
+# end-of-entity marker in the token trie, matches nltk.util.Trie.LEAF
+_LEAF = True
+
 def stop_words():
     """wrapper to return expanded set of stopwords.
 
@@ -37,22 +51,30 @@ def stop_words():
     return set(stops)
 
 
-def multi_word_entities():
+def multi_word_entities(banks=None,cards=None,other=None):
     """generates set of multi-word entities to be passed to the tokenizer
 
+    KWARGS:
+        banks, cards, other: dict or None.
+            already-parsed contents of banks.json, cards.json and 
+            keywords.json.  Any left as None are read from disk.
+
     RETURNS:
         MWE: list.
             List of multi-word entities, with each entity expressed as a tuple 
             of tokens.
     """
-    with open('banks.json','r') as f:
-        banks = json.load(f)
+    if banks is None:
+        with open('banks.json','r') as f:
+            banks = json.load(f)
 
-    with open('cards.json','r') as f:
-        cards = json.load(f)
+    if cards is None:
+        with open('cards.json','r') as f:
+            cards = json.load(f)
 
-    with open('keywords.json','r') as f:
-        other = json.load(f)
+    if other is None:
+        with open('keywords.json','r') as f:
+            other = json.load(f)
 
     # include keywords.json here
 
@@ -122,7 +144,8 @@ def tokenize(text,lemma=False,stopwords=None):
 
     KWARGS:
         lemma: boolean.
-            Flag to lemmatize the terms.  Default False.
+            Flag to lemmatize the terms, memoized by `lemmatizer`.  Default 
+            False.
         stopwords: boolean.
             Flag to remove stopwords from tokens.  Default True.
 
@@ -131,14 +154,272 @@ def tokenize(text,lemma=False,stopwords=None):
             List of upper-case tokens, represented as strings.
     """
     tokens = nltk.RegexpTokenizer(r'\w+').tokenize(text.upper())
-    tokens = nltk.MWETokenizer(mwes=multi_word_entities(),
-                               separator=' ').tokenize(tokens)
+    tokens = _mwe_tokenizer().tokenize(tokens)
 
     if stopwords is not None:
         tokens = [word for word in tokens if word not in stopwords]
 
     if lemma:
-        tokens = [_lemmatizer.lemmatize(word,pos='v') for word in tokens]
-        tokens = [_lemmatizer.lemmatize(word,pos='n') for word in tokens]
+        tokens = lemmatizer().lemmatize_all(tokens)
+
+    return tokens
+
+
+class Lemmatizer(object):
+    """memoized WordNet lemmatization.  Each token is lemmatized as a verb, 
+    then the result as a noun, as `tokenize` always has; since the token 
+    vocabulary is heavily skewed, nearly every lookup after warm-up is a 
+    cache hit.  The learned table can be saved and loaded, so new worker 
+    processes start warm.
+
+    KWARGS:
+        max_entries: int.
+            tokens kept, least recently used evicted first.  Default 500000.
+        path: string or None.
+            lemma table to load, see `save`.  Default None.
+    """
+    def __init__(self,max_entries=500000,path=None):
+        self.max_entries = max_entries
+        self.table = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def _lemma(self,word):
+        verb = _lemmatizer.lemmatize(word,pos='v')
+        return _lemmatizer.lemmatize(verb,pos='n')
+
+    def lemmatize(self,word):
+        """lemma of a single token.
+        """
+        return self.lemmatize_all([word])[0]
+
+    def lemmatize_all(self,tokens):
+        """lemmas of a document's tokens.  Each unique token is looked up 
+        once, and only tokens missing from the table go to WordNet.
+
+        ARGS:
+            tokens: list.
+                list of token strings.
+
+        RETURNS:
+            lemmas: list.
+                list of lemmas, one per token.
+        """
+        table = self.table
+        lemmas = {}
+        for word in set(tokens):
+            lemma = table.get(word,None)
+            if lemma is None:
+                lemma = self._lemma(word)
+                table[word] = lemma
+                self.misses += 1
+            else:
+                table.move_to_end(word)
+                self.hits += 1
+            lemmas[word] = lemma
+
+        while len(table) > self.max_entries:
+            table.popitem(last=False)
+        return [lemmas[word] for word in tokens]
+
+    def save(self,path):
+        """writes the lemma table to `path` as JSON, atomically.
+        """
+        tmpfile = path + '.tmp'
+        with open(tmpfile,'w') as f:
+            json.dump(self.table,f)
+        os.replace(tmpfile,path)
+
+    def load(self,path):
+        """adds the lemma table saved at `path`, up to `max_entries`.
+        """
+        with open(path,'r') as f:
+            table = json.load(f)
+        for word,lemma in table.items():
+            self.table[word] = lemma
+        while len(self.table) > self.max_entries:
+            self.table.popitem(last=False)
+
+    def stats(self):
+        """cache hit/miss counts, over unique tokens per document.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits/lookups if lookups else 0.,
+                'entries': len(self.table)}
+
+
+# this process's lemmatizer.  Forked workers inherit a copy of the table.
+_default_lemmatizer = None
+
+
+def lemmatizer():
+    """this process's shared `Lemmatizer`, as used by `tokenize`.  On first 
+    use it is warm-started from the table named by the REDDIT_LEMMAS 
+    environment variable, if any, so worker processes pick it up.
+
+    RETURNS:
+        lemmatizer: Lemmatizer.
+    """
+    global _default_lemmatizer
+    if _default_lemmatizer is None:
+        _default_lemmatizer = Lemmatizer(
+            path=os.environ.get(LEMMA_TABLE_ENV))
+    return _default_lemmatizer
+
+
+def configure_lemmas(path):
+    """selects the lemma table that this process and the worker processes 
+    it starts afterwards warm-start from, and loads it into this process's 
+    lemmatizer.
+
+    ARGS:
+        path: string or None.
+            lemma table written by `save_lemmas`, or None to stop 
+            warm-starting.
+    """
+    if path is None:
+        os.environ.pop(LEMMA_TABLE_ENV,None)
+        return
+    os.environ[LEMMA_TABLE_ENV] = os.path.abspath(path)
+    if os.path.exists(path):
+        lemmatizer().load(path)
+
+
+def save_lemmas(path):
+    """saves this process's learned lemma table to `path`, see 
+    `configure_lemmas`.
+    """
+    lemmatizer().save(path)
+
+
+@functools.lru_cache(maxsize=None)
+def _mwe_tokenizer():
+    """builds the multi-word entity tokenizer once per process, rather than 
+    re-reading the JSON files on every call to `tokenize`.
+
+    RETURNS:
+        tokenizer: nltk.MWETokenizer.
+            tokenizer merging the entities from `multi_word_entities`.
+    """
+    return nltk.MWETokenizer(mwes=multi_word_entities(),separator=' ')
+
+
+class KeywordMatcher(object):
+    """compiled keyword matcher.  Builds the multi-word entity trie, keyword 
+    set and stopword set once, then matches text bodies in a single pass over 
+    the word tokens.  Output is identical to running `tokenize` (without 
+    lemmatization) and filtering the tokens against the keyword set.
+
+    Matchers hold only plain dicts, sets and a compiled regex, so they pickle 
+    cleanly and can be shipped to worker processes.  `fingerprint` is a hex 
+    SHA-1 digest of the keywords, entities and stopwords, so matchers with 
+    the same fingerprint match identically.
+
+    ARGS:
+        keywords: iterable.
+            keyword strings to report, e.g. output of 
+            `build_index.build_keywords`.
+
+    KWARGS:
+        mwes: iterable or None.
+            multi-word entities as tuples of tokens.  Default None, which 
+            loads `multi_word_entities`.
+        stopwords: iterable or None.
+            upper-case stopwords to strip before keyword filtering.  
+            Default None.
+    """
+    def __init__(self,keywords,mwes=None,stopwords=None):
+        if mwes is None:
+            mwes = multi_word_entities()
+        mwes = [tuple(mwe) for mwe in mwes]
+
+        self.keywords = frozenset(keywords)
+        if stopwords is not None:
+            stopwords = frozenset(stopwords)
+        self.stopwords = stopwords
+
+        digest = hashlib.sha1()
+        for part in (sorted(self.keywords),sorted(mwes),
+                     sorted(stopwords or ())):
+            digest.update(json.dumps(part).encode('utf-8'))
+        self.fingerprint = digest.hexdigest()
+
+        # token trie of dicts, with `_LEAF` marking a complete entity -- same 
+        # layout and longest-match semantics as nltk.MWETokenizer
+        self._trie = {}
+        for mwe in mwes:
+            node = self._trie
+            for token in mwe:
+                node = node.setdefault(token,{})
+            node[_LEAF] = None
+
+    def _merged_tokens(self,text):
+        """generator over upper-case word tokens with multi-word entities 
+        merged, following nltk.MWETokenizer's longest-match rules.
+        """
+        words = _word_pattern.findall(text.upper())
+        trie = self._trie
+
+        i = 0
+        n = len(words)
+        while i < n:
+            word = words[i]
+            node = trie.get(word)
+            if node is None:
+                i += 1
+                yield word
+                continue
+
+            # walk the trie as far as it goes, keep the longest entity
+            j = i + 1
+            last_match = j if _LEAF in node else -1
+            while j < n and words[j] in node:
+                node = node[words[j]]
+                j += 1
+                if _LEAF in node:
+                    last_match = j
+
+            if last_match > -1:
+                yield ' '.join(words[i:last_match])
+                i = last_match
+            else:
+                i += 1
+                yield word
+
+    def tokenize(self,text):
+        """splits text into upper-case tokens, merging multi-word entities.
+
+        ARGS:
+            text: string.
+                raw text to be tokenized.
+
+        RETURNS:
+            tokens: list.
+                list of upper-case tokens, with stopwords removed.
+        """
+        stops = self.stopwords
+        if stops is None:
+            return list(self._merged_tokens(text))
+        return [t for t in self._merged_tokens(text) if t not in stops]
+
+    def match(self,text):
+        """finds keyword mentions in text in a single pass.
+
+        ARGS:
+            text: string.
+                raw text body to check.
 
-    return tokens
\ No newline at end of file
+        RETURNS:
+            keywords: list.
+                keywords found in the text, in order of occurrence and with 
+                repeats, matching `build_index.find_card_keywords`.
+        """
+        keys = self.keywords
+        stops = self.stopwords
+        if stops is None:
+            return [t for t in self._merged_tokens(text) if t in keys]
+        return [t for t in self._merged_tokens(text) 
+                if t in keys and t not in stops]
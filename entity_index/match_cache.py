@@ -0,0 +1,173 @@
+"""dedupe cache for keyword matching.  Many comment bodies repeat exactly
+("[deleted]", "[removed]", bot boilerplate, pasted referral text), so matches
+are cached by a hash of the normalized body and repeats skip tokenization.
+
+Each process keeps a bounded LRU in memory.  Optionally, bodies seen more than
+once are also written to a SQLite file shared by every worker of a run (and by
+later runs), so a repeat found by one worker is a hit in all of them.
+"""
+
+
+import collections
+import hashlib
+import sqlite3
+
+
+def body_key(text):
+    """cache key of a text body.  Bodies differing only in case or whitespace
+    tokenize identically, so they share a key.
+
+    ARGS:
+        text: string.
+            raw text body.
+
+    RETURNS:
+        key: bytes.
+            16-byte BLAKE2b digest of the normalized body.
+    """
+    normalized = ' '.join(text.upper().split())
+    return hashlib.blake2b(normalized.encode('utf-8','surrogatepass'),
+                           digest_size=16).digest()
+
+
+class MatchCache(object):
+    """bounded LRU of body key to matched keywords.  A cache is only valid for
+    one matcher configuration (keywords and stopwords), so pass the matcher's
+    `fingerprint` as `namespace` when sharing a cache file; a file written
+    under another namespace is cleared.
+
+    For example,
+
+    cache = MatchCache(max_entries=100000)
+    keywords = cache.get(body)
+    if keywords is None:
+        keywords = matcher.match(body)
+        cache.put(body,keywords)
+
+    KWARGS:
+        max_entries: int.
+            bodies kept in memory, least recently used evicted first.  Each
+            entry is roughly 200 bytes.  Default 100000.
+        path: string or None.
+            shared SQLite cache file.  Default None, memory only.
+        namespace: string or None.
+            matcher configuration the cached matches belong to.  Default
+            None.
+        flush_every: int.
+            pending shared entries written per transaction.  Default 1000.
+    """
+    def __init__(self,max_entries=100000,path=None,namespace=None,
+                 flush_every=1000):
+        self.max_entries = max_entries
+        self.path = path
+        self.namespace = namespace
+        self.flush_every = flush_every
+        self.entries = collections.OrderedDict()
+        self.shared = set()
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.evictions = 0
+        self.conn = None
+        if path is not None:
+            self._open_shared()
+
+    def _open_shared(self):
+        """opens the shared cache file, clearing it if it belongs to another
+        namespace.
+        """
+        self.conn = sqlite3.connect(self.path,timeout=60,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                          "(name TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS matches "
+                          "(key BLOB PRIMARY KEY, keywords TEXT) WITHOUT ROWID")
+        namespace = '' if self.namespace is None else self.namespace
+        row = self.conn.execute("SELECT value FROM meta WHERE name = "
+                                "'namespace'").fetchone()
+        if row is None or row[0] != namespace:
+            self.conn.execute("DELETE FROM matches")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES "
+                              "('namespace',?)",(namespace,))
+        self.conn.commit()
+
+    def get(self,text):
+        """cached keywords for `text`, or None on a miss.
+
+        RETURNS:
+            keywords: list or None.
+        """
+        key = body_key(text)
+        keywords = self.entries.get(key,None)
+        if keywords is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if self.conn is not None and key not in self.shared:
+                # a proven repeat, worth sharing with the other workers
+                self.shared.add(key)
+                self.pending.append((key,'\n'.join(keywords)))
+                if len(self.pending) >= self.flush_every:
+                    self.flush()
+            return list(keywords)
+
+        if self.conn is not None:
+            row = self.conn.execute("SELECT keywords FROM matches WHERE "
+                                    "key = ?",(key,)).fetchone()
+            if row is not None:
+                keywords = tuple(row[0].split('\n')) if row[0] else ()
+                self.shared.add(key)
+                self._store(key,keywords)
+                self.hits += 1
+                self.shared_hits += 1
+                return list(keywords)
+
+        self.misses += 1
+        return None
+
+    def put(self,text,keywords):
+        """caches the keywords matched in `text`.
+        """
+        self._store(body_key(text),tuple(keywords))
+
+    def _store(self,key,keywords):
+        self.entries[key] = keywords
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            old,_ = self.entries.popitem(last=False)
+            self.shared.discard(old)
+            self.evictions += 1
+
+    def flush(self):
+        """writes pending shared entries to the cache file.
+        """
+        if self.conn is None or not self.pending:
+            return
+        self.conn.executemany("INSERT OR IGNORE INTO matches VALUES (?,?)",
+                              self.pending)
+        self.conn.commit()
+        self.pending = []
+
+    def close(self):
+        """flushes and closes the shared cache file.
+        """
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+    def stats(self):
+        """hit/miss statistics, for sizing the cache.
+
+        RETURNS:
+            stats: dict.
+                'hits' (including 'shared_hits' served from the cache file),
+                'misses', 'hit_rate', 'evictions' and 'entries'.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'hit_rate': self.hits/lookups if lookups else 0.,
+                'evictions': self.evictions, 'entries': len(self.entries)}
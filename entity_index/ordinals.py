@@ -0,0 +1,171 @@
+"""vectorized result format for the indexer.  Rather than (id,[keywords]) 
+tuples, a batch of matched posts is encoded as compressed rows of keyword term 
+ordinals (see `catalog.EntityCatalog.terms`), which are cheap to pickle between 
+processes and can be merged, deduplicated and expanded to `Card_Mentions` / 
+`Keywords` columns with array operations.
+"""
+
+
+import numpy as np
+import collections
+
+
+OrdinalBatch = collections.namedtuple('OrdinalBatch',['ids','indptr','terms'])
+OrdinalBatch.__doc__ = """batch of matched posts in compressed-row form.  The 
+term ordinals for post `ids[i]` are `terms[indptr[i]:indptr[i+1]]`.
+"""
+
+
+def encode(results,catalog):
+    """encodes keyword results as an `OrdinalBatch`.
+
+    ARGS:
+        results: iterable.
+            iterable of (id,[keywords]) from `build_index.find_card_keywords`.
+        catalog: catalog.EntityCatalog.
+            catalog the keywords were matched against.
+
+    RETURNS:
+        batch: OrdinalBatch.
+            encoded batch, with repeated keywords per post dropped.
+    """
+    lookup = catalog.term_index
+
+    ids = []
+    lengths = []
+    terms = []
+    for index,keywords in results:
+        ordinals = set([lookup[key] for key in keywords])
+        ids.append(index)
+        lengths.append(len(ordinals))
+        terms += sorted(ordinals)
+
+    indptr = np.zeros(len(ids)+1,dtype=np.int64)
+    np.cumsum(lengths,out=indptr[1:])
+    return OrdinalBatch(np.array(ids,dtype=object),indptr,
+                        np.array(terms,dtype=np.uint16))
+
+
+def decode(batch,catalog):
+    """expands an `OrdinalBatch` back into (id,[keywords]) tuples.
+
+    RETURNS:
+        results: list.
+            list of (id,[keywords]), keywords in ordinal order.
+    """
+    terms = catalog.terms
+    results = []
+    for i,index in enumerate(batch.ids):
+        ordinals = batch.terms[batch.indptr[i]:batch.indptr[i+1]]
+        results.append((index,[terms[t] for t in ordinals]))
+    return results
+
+
+def merge(batches):
+    """concatenates batches, folding together any posts that appear more than 
+    once into a single row holding the union of their terms.
+
+    ARGS:
+        batches: iterable.
+            iterable of `OrdinalBatch`.
+
+    RETURNS:
+        batch: OrdinalBatch.
+            merged batch, rows sorted by id.
+    """
+    batches = list(batches)
+    ids = np.concatenate([b.ids for b in batches])
+    terms = np.concatenate([b.terms for b in batches])
+    lengths = np.concatenate([np.diff(b.indptr) for b in batches])
+    rows = np.repeat(np.arange(len(ids)),lengths)
+
+    unique_ids,inverse = np.unique(ids,return_inverse=True)
+
+    # unique (post,term) pairs, ordered by post then term
+    n_terms = int(terms.max()) + 1 if len(terms) else 1
+    pairs = np.unique(inverse[rows].astype(np.int64)*n_terms + terms)
+    owners = pairs // n_terms
+
+    indptr = np.zeros(len(unique_ids)+1,dtype=np.int64)
+    np.cumsum(np.bincount(owners,minlength=len(unique_ids)),out=indptr[1:])
+    return OrdinalBatch(unique_ids,indptr,
+                        (pairs % n_terms).astype(np.uint16))
+
+
+def card_matrix(batch,catalog):
+    """expands a batch into `Card_Mentions` flags.
+
+    ARGS:
+        batch: OrdinalBatch.
+            encoded batch.
+        catalog: catalog.EntityCatalog.
+            catalog the batch was encoded against.
+
+    RETURNS:
+        flags: tuple.
+            tuple of (ids,matrix), where `matrix` is a uint8 array of shape 
+            (len(ids),len(catalog.card_columns)).  Posts with no card or 
+            bank flags are dropped.
+    """
+    term_columns = _card_lookup(catalog)
+    rows = np.repeat(_row_index(batch),term_columns.shape[1])
+    columns = term_columns[batch.terms].ravel()
+    mask = columns >= 0
+
+    matrix = np.zeros((len(batch.ids),len(catalog.card_columns)),
+                      dtype=np.uint8)
+    matrix[rows[mask],columns[mask]] = 1
+
+    keep = matrix.any(axis=1)
+    return (batch.ids[keep],matrix[keep])
+
+
+def keyword_values(batch,catalog):
+    """expands a batch into `Keywords` column values.
+
+    ARGS:
+        batch: OrdinalBatch.
+            encoded batch.
+        catalog: catalog.EntityCatalog.
+            catalog the batch was encoded against.
+
+    RETURNS:
+        values: list.
+            list of (id,{column: 'keyword,keyword'}) for posts with at least 
+            one keyword column.
+    """
+    term_column = np.array(catalog.term_keyword_column,dtype=np.int16)
+    columns = term_column[batch.terms]
+    mask = columns >= 0
+    rows = _row_index(batch)[mask]
+    columns = columns[mask]
+    terms = batch.terms[mask]
+
+    values = collections.OrderedDict()
+    for row,column,term in zip(rows.tolist(),columns.tolist(),terms.tolist()):
+        tags = values.setdefault(row,{})
+        name = catalog.keyword_columns[column]
+        term = catalog.terms[term]
+        if name in tags:
+            tags[name] += ',' + term
+        else:
+            tags[name] = term
+
+    return [(batch.ids[row],tags) for row,tags in values.items()]
+
+
+def _row_index(batch):
+    """row number of each entry in `batch.terms`.
+    """
+    return np.repeat(np.arange(len(batch.ids)),np.diff(batch.indptr))
+
+
+def _card_lookup(catalog):
+    """(n_terms,width) array of Card_Mentions column ordinals per term, 
+    padded with -1.
+    """
+    width = max([len(c) for c in catalog.term_card_columns] + [1])
+    lookup = np.full((len(catalog.terms),width),-1,dtype=np.int16)
+    for i,columns in enumerate(catalog.term_card_columns):
+        lookup[i,:len(columns)] = columns
+    return lookup
@@ -0,0 +1,480 @@
+"""On-disk inverted index of entity mentions.  For each Card_Mentions or
+Keywords column (e.g. CHASE_SAPPHIRE, CASHBACK_REWARDS), posts mentioning it
+are kept as sorted, delta- and varint-encoded posting lists, one per month.
+
+An index is a directory of immutable segment files, one per indexing run, so
+incremental runs only ever add a segment; `compact` merges them.  Segments
+are memory-mapped and only the postings a query touches are decoded.
+
+Posts are identified by posting keys: the base-36 reddit id as an integer,
+shifted left one bit, with the low bit set for submissions.  Keys sort by id
+within each table, and `decode_keys` turns them back into (table,id).
+"""
+
+import os
+import mmap
+import json
+import time
+import array
+import struct
+import datetime as dt
+import numpy as np
+
+import ordinals as od
+
+
+_MAGIC = b'RIDX0001'
+_FOOTER = struct.Struct('<Q8s')
+
+SEGMENT_PREFIX = 'segment_'
+SEGMENT_SUFFIX = '.idx'
+
+
+def post_key(index,table):
+    """posting key of a post.
+
+    ARGS:
+        index: string.
+            base-36 reddit id.
+        table: string.
+            'Comments' or 'Submissions'.
+
+    RETURNS:
+        key: int.
+    """
+    return (int(index,36) << 1) | (table == 'Submissions')
+
+
+def _base36(value):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        value,digit = divmod(value,36)
+        out = digits[digit] + out
+        if value == 0:
+            return out
+
+
+def decode_keys(keys):
+    """turns posting keys back into posts.
+
+    ARGS:
+        keys: iterable.
+            posting keys, e.g. from `PostingsIndex.query`.
+
+    RETURNS:
+        posts: list.
+            list of (table,id) tuples.
+    """
+    return [('Submissions' if key & 1 else 'Comments',_base36(int(key) >> 1))
+            for key in keys]
+
+
+def month_of(created_utc):
+    """'YYYY-MM' bucket of a UTC timestamp.
+    """
+    return time.strftime('%Y-%m',time.gmtime(int(created_utc)))
+
+
+def _month_bound(value):
+    """'YYYY-MM' month of a query bound, given as a 'YYYY-MM' string, a date
+    or datetime, or a UTC timestamp.
+    """
+    if value is None or isinstance(value,str):
+        return value
+    if isinstance(value,(dt.date,dt.datetime)):
+        return value.strftime('%Y-%m')
+    return month_of(value)
+
+
+def _encode_varints(values):
+    """LEB128 encoding of an array of non-negative integers, vectorized.
+    """
+    values = np.asarray(values,dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    nbytes = np.ones(len(values),dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+
+    out = np.zeros(int(nbytes.sum()),dtype=np.uint8)
+    starts = np.concatenate(([0],np.cumsum(nbytes)[:-1]))
+    for k in range(int(nbytes.max())):
+        live = nbytes > k
+        chunk = (values[live] >> np.uint64(7*k)) & np.uint64(0x7f)
+        more = (nbytes[live] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[live] + k] = (chunk | more).astype(np.uint8)
+    return out.tobytes()
+
+
+def _decode_varints(data,count):
+    """inverse of `_encode_varints`, for `count` values in the uint8 array
+    `data`.
+    """
+    if count == 0:
+        return np.zeros(0,dtype=np.int64)
+    stop = (data & 0x80) == 0
+    value_index = np.concatenate(([0],np.cumsum(stop)[:-1]))
+    starts = np.flatnonzero(np.concatenate(([True],stop[:-1])))
+    shift = (np.arange(len(data)) - starts[value_index]) * 7
+    parts = (data & 0x7f).astype(np.int64) << shift
+    values = np.zeros(count,dtype=np.int64)
+    np.add.at(values,value_index,parts)
+    return values
+
+
+def _encode_postings(keys):
+    """sorted, de-duplicated keys as a delta-encoded varint blob.
+    """
+    keys = np.unique(np.asarray(keys,dtype=np.int64))
+    deltas = np.diff(keys,prepend=0)
+    return (_encode_varints(deltas),len(keys))
+
+
+class PostingsWriter(object):
+    """collects mentions during an indexing run and writes them out as
+    segments, one per run unless `max_postings` is reached.
+
+    ARGS:
+        path: string.
+            index directory, created if missing.
+        catalog: catalog.EntityCatalog.
+            catalog mapping matched keywords to index terms.
+
+    KWARGS:
+        max_postings: int or None.
+            postings held in memory before they are written out as a
+            segment of their own.  Default 10000000 (about 80MB).
+    """
+    def __init__(self,path,catalog,max_postings=10000000):
+        self.path = path
+        self.max_postings = max_postings
+        self.catalog = catalog
+        self.entities = {}
+        for term in catalog.keywords:
+            entities = [remap.get(term) for remap in
+                        (catalog.bank_remap,catalog.card_remap,
+                         catalog.tag_remap)]
+            self.entities[term] = tuple(set(e for e in entities
+                                            if e is not None))
+        self.postings = {}
+        self.count = 0
+
+    def add(self,results,table,meta):
+        """adds a chunk of matcher results, all from one table.
+
+        ARGS:
+            results: list or ordinals.OrdinalBatch.
+                (id,[keywords]) tuples from `build_index.find_card_keywords`,
+                or the same as an ordinal batch.
+            table: string.
+                'Comments' or 'Submissions'.
+            meta: dict.
+                map of (table,id) to created_utc, for the posts of the
+                chunk.  Keyed by table too, since comment and submission ids
+                overlap.
+        """
+        if isinstance(results,od.OrdinalBatch):
+            results = od.decode(results,self.catalog)
+        for index,keywords in results:
+            key = post_key(index,table)
+            month = month_of(meta[(table,index)])
+            entities = set()
+            for keyword in keywords:
+                entities.update(self.entities.get(keyword,()))
+            for entity in entities:
+                bucket = self.postings.get((entity,month),None)
+                if bucket is None:
+                    bucket = self.postings[(entity,month)] = array.array('q')
+                bucket.append(key)
+                self.count += 1
+        if self.max_postings is not None and self.count >= self.max_postings:
+            self.write()
+
+    def write(self):
+        """writes the collected postings as a new segment, atomically.
+
+        RETURNS:
+            filepath: string or None.
+                path of the segment, or None if nothing was collected.
+        """
+        if not self.postings:
+            return None
+        filepath = _new_segment_path(self.path)
+        _write_segment(filepath,self.postings)
+        self.postings = {}
+        self.count = 0
+        return filepath
+
+
+def _new_segment_path(path):
+    """unused segment path in `path`.  Names sort by creation time.
+    """
+    stamp = time.strftime('%Y%m%d%H%M%S')
+    n = 0
+    while True:
+        filepath = os.path.join(path,'{}{}_{}_{:04d}{}'.format(
+            SEGMENT_PREFIX,stamp,os.getpid(),n,SEGMENT_SUFFIX))
+        if not os.path.exists(filepath):
+            return filepath
+        n += 1
+
+
+def _write_segment(filepath,postings):
+    """writes {(term,month): keys} as a segment file.  Layout: the encoded
+    posting lists back to back, then a JSON directory of
+    {term: {month: [offset,nbytes,count]}}, then the directory offset and
+    magic.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)),exist_ok=True)
+    directory = {}
+    tmpfile = filepath + '.tmp'
+    with open(tmpfile,'wb') as writefile:
+        offset = 0
+        for (term,month) in sorted(postings):
+            blob,count = _encode_postings(postings[(term,month)])
+            writefile.write(blob)
+            directory.setdefault(term,{})[month] = [offset,len(blob),count]
+            offset += len(blob)
+        writefile.write(json.dumps(directory,sort_keys=True).encode())
+        writefile.write(_FOOTER.pack(offset,_MAGIC))
+    os.replace(tmpfile,filepath)
+
+
+class _Segment(object):
+    """memory-mapped segment file.
+    """
+    def __init__(self,filepath):
+        self.filepath = filepath
+        with open(filepath,'rb') as readfile:
+            self.map = mmap.mmap(readfile.fileno(),0,access=mmap.ACCESS_READ)
+        end = len(self.map) - _FOOTER.size
+        offset,magic = _FOOTER.unpack(self.map[end:])
+        if magic != _MAGIC:
+            raise ValueError("{} is not a postings segment".format(filepath))
+        self.directory = json.loads(self.map[offset:end].decode())
+        self.data = np.frombuffer(self.map,dtype=np.uint8,count=offset)
+
+    def postings(self,term,month):
+        entry = self.directory.get(term,{}).get(month,None)
+        if entry is None:
+            return None
+        offset,nbytes,count = entry
+        return np.cumsum(_decode_varints(self.data[offset:offset+nbytes],
+                                         count))
+
+    def close(self):
+        self.data = None
+        self.map.close()
+
+
+def segment_files(path):
+    """segment files of the index in `path`, oldest first.
+    """
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(path,f) for f in os.listdir(path)
+                  if f.startswith(SEGMENT_PREFIX) and f.endswith(SEGMENT_SUFFIX))
+
+
+def clear(path):
+    """deletes every segment of the index in `path`, for a rebuild.
+    """
+    for filepath in segment_files(path):
+        os.remove(filepath)
+
+
+class PostingsIndex(object):
+    """read-only view of an index directory, for mention lookups.  Terms are
+    Card_Mentions and Keywords column names (e.g. 'CHASE_SAPPHIRE'); with a
+    catalog, any matched keyword ('CHASE SAPPHIRE', 'CSP') is accepted and
+    resolved to its column.  Time ranges are inclusive and month-granular.
+    For example,
+
+    index = PostingsIndex('postings',catalog=cat.load_catalog())
+    keys = index.query(all_of=['CHASE SAPPHIRE','ANNUAL_FEE'],
+                       start='2017-03',end='2017-03')
+    posts = decode_keys(keys)
+
+    ARGS:
+        path: string.
+            index directory.
+
+    KWARGS:
+        catalog: catalog.EntityCatalog or None.
+            catalog for resolving keywords to terms.  Default None.
+    """
+    def __init__(self,path,catalog=None):
+        self.path = path
+        self.catalog = catalog
+        self.segments = [_Segment(f) for f in segment_files(path)]
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.close()
+        return False
+
+    def terms(self):
+        """every indexed term, sorted.
+        """
+        terms = set()
+        for segment in self.segments:
+            terms.update(segment.directory)
+        return sorted(terms)
+
+    def months(self,term):
+        """months holding postings for `term`, sorted.
+        """
+        term = self.resolve(term)
+        months = set()
+        for segment in self.segments:
+            months.update(segment.directory.get(term,{}))
+        return sorted(months)
+
+    def resolve(self,term):
+        """index term for a column name or, with a catalog, any keyword.
+        """
+        if self.catalog is None:
+            return term
+        keyword = term.upper()
+        for remap in (self.catalog.card_remap,self.catalog.bank_remap,
+                      self.catalog.tag_remap):
+            if keyword in remap:
+                return remap[keyword]
+        return term
+
+    def postings(self,term,start=None,end=None):
+        """posting keys of posts mentioning `term` between the months of
+        `start` and `end`.
+
+        ARGS:
+            term: string.
+                column name, or keyword if the index has a catalog.
+
+        KWARGS:
+            start, end: string, date, datetime, number or None.
+                first and last month to include, as 'YYYY-MM', a date or a
+                UTC timestamp.  Default None, unbounded.
+
+        RETURNS:
+            keys: numpy.ndarray.
+                sorted, unique int64 posting keys.
+        """
+        term = self.resolve(term)
+        start,end = _month_bound(start),_month_bound(end)
+        parts = []
+        for segment in self.segments:
+            for month in segment.directory.get(term,{}):
+                if ((start is None or month >= start) and
+                        (end is None or month <= end)):
+                    parts.append(segment.postings(term,month))
+        if not parts:
+            return np.zeros(0,dtype=np.int64)
+        if len(parts) == 1:
+            return parts[0]
+        return np.unique(np.concatenate(parts))
+
+    def intersect(self,terms,start=None,end=None):
+        """posting keys of posts mentioning every one of `terms`, see
+        `postings`.  Starts from the shortest list.
+        """
+        lists = sorted([self.postings(term,start,end) for term in terms],
+                       key=len)
+        if not lists:
+            return np.zeros(0,dtype=np.int64)
+        keys = lists[0]
+        for other in lists[1:]:
+            if len(keys) == 0:
+                break
+            keys = np.intersect1d(keys,other,assume_unique=True)
+        return keys
+
+    def union(self,terms,start=None,end=None):
+        """posting keys of posts mentioning any of `terms`, see `postings`.
+        """
+        lists = [self.postings(term,start,end) for term in terms]
+        if not lists:
+            return np.zeros(0,dtype=np.int64)
+        return np.unique(np.concatenate(lists))
+
+    def query(self,all_of=(),any_of=(),none_of=(),start=None,end=None):
+        """posting keys of posts mentioning all of `all_of`, at least one of
+        `any_of` (if given) and none of `none_of`, within a month range.
+
+        KWARGS:
+            all_of, any_of, none_of: iterable.
+                terms, see `postings`.
+            start, end:
+                month range, see `postings`.
+
+        RETURNS:
+            keys: numpy.ndarray.
+                sorted posting keys; see `decode_keys`.
+        """
+        if not all_of and not any_of:
+            raise ValueError("query needs all_of or any_of terms")
+        keys = None
+        if all_of:
+            keys = self.intersect(all_of,start,end)
+        if any_of:
+            either = self.union(any_of,start,end)
+            keys = either if keys is None else np.intersect1d(
+                keys,either,assume_unique=True)
+        if none_of:
+            keys = np.setdiff1d(keys,self.union(none_of,start,end),
+                                assume_unique=True)
+        return keys
+
+    def counts(self,term,start=None,end=None):
+        """posts mentioning `term` per month, without decoding postings.
+
+        RETURNS:
+            counts: dict.
+                map of 'YYYY-MM' to number of postings (summed over
+                segments, so posts re-indexed by several runs count again
+                until `compact`).
+        """
+        term = self.resolve(term)
+        start,end = _month_bound(start),_month_bound(end)
+        counts = {}
+        for segment in self.segments:
+            for month,(_,_,count) in segment.directory.get(term,{}).items():
+                if ((start is None or month >= start) and
+                        (end is None or month <= end)):
+                    counts[month] = counts.get(month,0) + count
+        return dict(sorted(counts.items()))
+
+
+def compact(path):
+    """merges every segment of the index in `path` into one.
+
+    RETURNS:
+        filepath: string or None.
+            path of the merged segment, or None if the index is empty.
+    """
+    old = segment_files(path)
+    if len(old) < 2:
+        return old[0] if old else None
+
+    with PostingsIndex(path) as index:
+        postings = {}
+        for segment in index.segments:
+            for term,months in segment.directory.items():
+                for month in months:
+                    postings[(term,month)] = index.postings(term,month,month)
+        filepath = _new_segment_path(path)
+        _write_segment(filepath,postings)
+
+    for segment in old:
+        if segment != filepath:
+            os.remove(segment)
+    return filepath
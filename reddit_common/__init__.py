@@ -0,0 +1,7 @@
+"""Modules shared by the scraper and the indexer: `storage`, the database
+backends, and `metrics`, the stage metrics and profiling hooks.
+
+Both script directories import this package, so run them with the
+repository root on the path, e.g. `PYTHONPATH=.. python process_all.py`
+from scraper/.
+"""
@@ -0,0 +1,306 @@
+"""Structured per-stage metrics and profiling hooks for the scraper and
+indexer.
+
+Events are appended as JSON lines, one per file, batch or chunk (never per
+post), to the file named by the REDDIT_METRICS environment variable.  Since
+the settings live in the environment, worker processes started by joblib or
+multiprocessing log to the same file as their parent.  `summarize` rolls a
+log up by stage, and `to_prometheus` renders it in the Prometheus text
+exposition format.
+"""
+
+import os
+import re
+import json
+import time
+import collections
+import cProfile
+
+
+METRICS_ENV = 'REDDIT_METRICS'
+PROFILE_ENV = 'REDDIT_PROFILE'
+PROFILER_ENV = 'REDDIT_PROFILER'
+PROFILE_DIR_ENV = 'REDDIT_PROFILE_DIR'
+
+# event fields that are not summed into counters
+_META_FIELDS = set(['time','pid','stage','kind'])
+
+# this process's profiler for each profiled stage, kept across runs
+_profilers = {}
+
+
+def configure(path=None,profile=None,profiler='cprofile',profile_dir='.'):
+    """turns metrics and profiling on or off for this process and the worker
+    processes it starts afterwards.
+
+    KWARGS:
+        path: string or None.
+            JSON-lines file to append events to.  Default None, metrics off.
+        profile: iterable, string or None.
+            stage names to profile (e.g. ['filter','match']), or 'all'.
+            Default None, profiling off.
+        profiler: string.
+            'cprofile' for pstats files, or 'pyinstrument' for HTML reports
+            (requires pyinstrument).  Default 'cprofile'.
+        profile_dir: string.
+            directory for profile output, written as '<stage>_<pid>.prof'
+            (or '.html') and updated after each run, so each file covers
+            every run of the stage in one process.  Default '.'.
+    """
+    if isinstance(profile,str):
+        profile = [profile]
+    _set_env(METRICS_ENV,os.path.abspath(path) if path else None)
+    _set_env(PROFILE_ENV,','.join(profile) if profile else None)
+    os.environ[PROFILER_ENV] = profiler
+    os.environ[PROFILE_DIR_ENV] = os.path.abspath(profile_dir)
+
+
+def _set_env(key,value):
+    if value is None:
+        os.environ.pop(key,None)
+    else:
+        os.environ[key] = value
+
+
+def enabled():
+    """True if events are being recorded.
+    """
+    return bool(os.environ.get(METRICS_ENV))
+
+
+def record(stage,kind='event',**values):
+    """appends one event to the metrics log, if enabled.
+
+    ARGS:
+        stage: string.
+            stage name, e.g. 'download', 'filter', 'sql_load', 'match'.
+
+    KWARGS:
+        kind: string.
+            'event' for counters and timings, summed by `summarize`, or
+            'gauge' for point-in-time levels such as queue depths.
+            Default 'event'.
+        **values:
+            fields of the event.  Numeric fields are counters (or gauge
+            levels); others, such as file names, are kept as labels.
+    """
+    path = os.environ.get(METRICS_ENV)
+    if not path:
+        return
+    event = {'time': time.time(), 'pid': os.getpid(), 'stage': stage,
+             'kind': kind}
+    event.update(values)
+    with open(path,'a') as logfile:
+        logfile.write(json.dumps(event,default=str)+'\n')
+
+
+def gauge(stage,**levels):
+    """records point-in-time levels, such as queue depths, see `record`.
+    """
+    record(stage,kind='gauge',**levels)
+
+
+class Stage(object):
+    """times one run of a stage and records it as an event on exit, along
+    with any counts added while it ran.  If the stage is selected for
+    profiling (see `configure`), the run is profiled too.  For example,
+
+    with metrics.Stage('filter',file=filepath) as stage:
+        ...
+        stage.add(lines_read=n)
+
+    ARGS:
+        name: string.
+            stage name.
+
+    KWARGS:
+        **fields:
+            extra fields for the event, e.g. the file being processed.
+    """
+    def __init__(self,name,**fields):
+        self.name = name
+        self.fields = fields
+        self.counts = collections.OrderedDict()
+
+    def add(self,**counts):
+        """adds to the run's counters.
+        """
+        for key,value in counts.items():
+            self.counts[key] = self.counts.get(key,0) + value
+
+    def __enter__(self):
+        self.profiler = _start_profile(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        seconds = time.time() - self.start
+        _stop_profile(self.profiler,self.name)
+        values = dict(self.fields)
+        values.update(self.counts)
+        values['seconds'] = seconds
+        if exc_type is not None:
+            values['error'] = repr(exc)
+        record(self.name,**values)
+        return False
+
+
+def _start_profile(name):
+    """resumes (or starts) this process's profiler for stage `name`, if the 
+    stage is selected for profiling.  Returns None otherwise, or if another 
+    profiler is already running (an enclosing profiled stage).
+    """
+    stages = os.environ.get(PROFILE_ENV)
+    if not stages or (stages != 'all' and name not in stages.split(',')):
+        return None
+
+    key = (name,os.getpid())
+    try:
+        profiler = _profilers.get(key,None)
+        if os.environ.get(PROFILER_ENV,'cprofile') == 'pyinstrument':
+            if profiler is None:
+                import pyinstrument
+                profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            if profiler is None:
+                profiler = cProfile.Profile()
+            profiler.enable()
+    except (ValueError,RuntimeError):
+        return None
+    _profilers[key] = profiler
+    return profiler
+
+
+def _stop_profile(profiler,name):
+    """pauses `profiler` and rewrites its output, covering every run so far, 
+    as '<stage>_<pid>.prof' (or '.html') in the profile directory.
+    """
+    if profiler is None:
+        return
+    path = os.path.join(os.environ.get(PROFILE_DIR_ENV,'.'),'{}_{}'
+                        .format(name,os.getpid()))
+    if isinstance(profiler,cProfile.Profile):
+        profiler.disable()
+        profiler.dump_stats(path+'.prof')
+    else:
+        profiler.stop()
+        with open(path+'.html','w') as writefile:
+            writefile.write(profiler.output_html())
+
+
+def _is_number(value):
+    return isinstance(value,(int,float)) and not isinstance(value,bool)
+
+
+def summarize(path):
+    """rolls a metrics log up by stage.  Counters and seconds are summed over
+    all events, so with parallel workers `seconds` is total worker time and
+    the rates are per worker.
+
+    ARGS:
+        path: string.
+            JSON-lines metrics log.
+
+    RETURNS:
+        stages: OrderedDict.
+            for each stage in order of first appearance, a dict with
+            'events' (number of runs), 'counters' (summed numeric fields,
+            including 'seconds'), 'rates' (each counter per second) and
+            'gauges' (dict of gauge name to its 'last' and 'max' level).
+    """
+    stages = collections.OrderedDict()
+    with open(path,'r') as logfile:
+        for line in logfile:
+            event = json.loads(line)
+            summary = stages.setdefault(event['stage'],{
+                'events': 0,
+                'counters': collections.OrderedDict(),
+                'rates': collections.OrderedDict(),
+                'gauges': collections.OrderedDict()})
+
+            values = [(key,value) for key,value in event.items()
+                      if key not in _META_FIELDS and _is_number(value)]
+            if event.get('kind') == 'gauge':
+                for key,value in values:
+                    level = summary['gauges'].get(key,{'max': value})
+                    summary['gauges'][key] = {'last': value,
+                                              'max': max(level['max'],value)}
+                continue
+
+            summary['events'] += 1
+            for key,value in values:
+                summary['counters'][key] = (summary['counters'].get(key,0) +
+                                            value)
+
+    for summary in stages.values():
+        seconds = summary['counters'].get('seconds',0)
+        if seconds > 0:
+            for key,value in summary['counters'].items():
+                if key != 'seconds':
+                    summary['rates'][key] = value/seconds
+    return stages
+
+
+def report(path):
+    """prints a per-stage summary of a metrics log, see `summarize`.
+    """
+    for name,summary in summarize(path).items():
+        print("{}: {} runs".format(name,summary['events']))
+        for key,value in summary['counters'].items():
+            rate = summary['rates'].get(key,None)
+            if rate is None:
+                print("    {}: {:.6g}".format(key,value))
+            else:
+                print("    {}: {:.6g} ({:.6g}/sec)".format(key,value,rate))
+        for key,level in summary['gauges'].items():
+            print("    {}: {:.6g} (max {:.6g})".format(key,level['last'],
+                                                     level['max']))
+
+
+def _metric_name(*parts):
+    return re.sub(r'[^a-zA-Z0-9_]','_','_'.join(parts))
+
+
+def to_prometheus(path,out=None,prefix='reddit'):
+    """renders a metrics log in the Prometheus text exposition format, e.g.
+    for the node_exporter textfile collector.  Each counter becomes
+    `<prefix>_<stage>_<counter>_total`, each gauge
+    `<prefix>_<stage>_<gauge>` (with a `_max` companion), and each stage
+    gets `<prefix>_<stage>_runs_total`.
+
+    ARGS:
+        path: string.
+            JSON-lines metrics log.
+
+    KWARGS:
+        out: string or None.
+            file to write the output to.  Default None, only returned.
+        prefix: string.
+            metric name prefix.  Default 'reddit'.
+
+    RETURNS:
+        text: string.
+            the rendered metrics.
+    """
+    lines = []
+    def add(name,kind,value):
+        lines.append("# TYPE {} {}".format(name,kind))
+        lines.append("{} {}".format(name,repr(float(value))))
+
+    for stage,summary in summarize(path).items():
+        add(_metric_name(prefix,stage,'runs_total'),'counter',
+            summary['events'])
+        for key,value in summary['counters'].items():
+            add(_metric_name(prefix,stage,key,'total'),'counter',value)
+        for key,level in summary['gauges'].items():
+            add(_metric_name(prefix,stage,key),'gauge',level['last'])
+            add(_metric_name(prefix,stage,key,'max'),'gauge',level['max'])
+
+    text = '\n'.join(lines)+'\n'
+    if out is not None:
+        tmp = out+'.tmp'
+        with open(tmp,'w') as writefile:
+            writefile.write(text)
+        os.replace(tmp,out)
+    return text
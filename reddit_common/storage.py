@@ -0,0 +1,366 @@
+"""Storage backends for the scraper and indexer.  Every module gets its
+connections from `connect`, which hands them out from a per-process pool over
+the configured backend:
+
+    mysql                   the local MySQL server (the default)
+    mysql:///<db>           another database on the local server
+    sqlite:///<path>        an embedded SQLite file
+
+The backend is chosen by the REDDIT_DB environment variable (see
+`configure`), so worker processes use the same one as their parent.  SQL is
+written in the MySQL dialect throughout; the SQLite backend translates the
+statements the pipeline issues (INSERT IGNORE, ON DUPLICATE KEY UPDATE,
+SHOW COLUMNS, FROM_UNIXTIME), so the same tables and bulk operations work on
+both.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import functools
+import pymysql as pms
+
+
+BACKEND_ENV = 'REDDIT_DB'
+POOL_SIZE_ENV = 'REDDIT_DB_POOL'
+
+# connection settings for the MySQL server
+MYSQL = {'host': 'localhost', 'user': 'root', 'passwd': '', 'db': 'reddit',
+         'charset': 'utf8mb4', 'init_command': 'SET NAMES UTF8MB4'}
+
+# column types for the post tables, by read_json field type
+_COLUMN_TYPES = {
+    'mysql': {'string': 'TEXT', 'int64': 'BIGINT', 'bool': 'TINYINT(1)'},
+    'sqlite': {'string': 'TEXT', 'int64': 'INTEGER', 'bool': 'INTEGER'}
+}
+
+# Subreddits columns, as written by subreddits.process
+_SUBREDDIT_FIELDS = [('url','string'),('title','string'),('name','string'),
+                     ('created_utc','int64'),('lang','string'),
+                     ('subreddit_type','string'),('over18','bool'),
+                     ('subscribers','int64'),('quarantine','bool')]
+
+# rewrites from the MySQL dialect used by the scraper and indexer to SQLite
+_SQLITE_REWRITES = [
+    (re.compile(r'%s'),'?'),
+    (re.compile(r'\bINSERT IGNORE\b'),'INSERT OR IGNORE'),
+    (re.compile(r'\bON DUPLICATE KEY UPDATE\b'),
+     'ON CONFLICT(id) DO UPDATE SET'),
+    (re.compile(r'\bVALUES\((`?\w+`?)\)'),r'excluded.\1'),
+    (re.compile(r'\bGREATEST\('),'MAX('),
+    (re.compile(r'\bDATE\(FROM_UNIXTIME\((\w+)\)\)'),r"DATE(\1,'unixepoch')"),
+    (re.compile(r'\btinyint\(1\) UNSIGNED\b',re.I),'INTEGER'),
+    (re.compile(r'^\s*SHOW COLUMNS FROM (\w+)'),
+     r"SELECT name FROM pragma_table_info('\1')")
+]
+
+
+@functools.lru_cache(maxsize=1024)
+def to_sqlite(query):
+    """translates a MySQL statement, as issued by the pipeline, to SQLite.
+    Translations are cached, since bulk statements repeat.
+
+    ARGS:
+        query: string.
+            MySQL statement.
+
+    RETURNS:
+        query: string.
+            SQLite statement.
+    """
+    for pattern,replacement in _SQLITE_REWRITES:
+        query = pattern.sub(replacement,query)
+    return query
+
+
+class MySQLBackend(object):
+    """connections to a MySQL server.
+
+    KWARGS:
+        **settings:
+            overrides of `MYSQL`, passed to `pymysql.connect`.
+    """
+    dialect = 'mysql'
+
+    def __init__(self,**settings):
+        self.settings = dict(MYSQL,**settings)
+
+    def url(self):
+        return 'mysql:///{}'.format(self.settings['db'])
+
+    def open(self,**kwargs):
+        """opens a new connection.  `kwargs` override the settings, e.g.
+        `local_infile=True`.
+        """
+        return pms.connect(**dict(self.settings,**kwargs))
+
+
+class SQLiteBackend(object):
+    """connections to an embedded SQLite file, in WAL mode so readers and
+    the writer threads of the indexer do not block each other.
+
+    ARGS:
+        path: string.
+            database file, created if missing.
+    """
+    dialect = 'sqlite'
+
+    def __init__(self,path):
+        self.path = os.path.abspath(path)
+
+    def url(self):
+        return 'sqlite:///{}'.format(self.path)
+
+    def open(self,**kwargs):
+        """opens a new connection.  MySQL connection options in `kwargs` are
+        ignored.
+        """
+        conn = sqlite3.connect(self.path,timeout=60,check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return _SQLiteConnection(conn)
+
+
+class _SQLiteCursor(object):
+    """DB-API cursor over SQLite accepting the pipeline's MySQL statements.
+    """
+    def __init__(self,cursor):
+        self.cursor = cursor
+
+    def execute(self,query,args=None):
+        self.cursor.execute(to_sqlite(query),args or ())
+        return self.cursor.rowcount
+
+    def executemany(self,query,args):
+        self.cursor.executemany(to_sqlite(query),args)
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class _SQLiteConnection(object):
+    """pymysql-style connection over a SQLite connection.
+    """
+    def __init__(self,conn):
+        self.conn = conn
+
+    def cursor(self):
+        return _SQLiteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def ping(self,reconnect=True):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+def backend_from_url(url):
+    """builds the backend named by `url`, see the module docstring.
+
+    ARGS:
+        url: string.
+            'mysql', 'mysql:///<db>' or 'sqlite:///<path>'.
+
+    RETURNS:
+        backend: MySQLBackend or SQLiteBackend.
+    """
+    scheme,_,rest = url.partition('://')
+    if scheme == 'mysql':
+        db = rest.strip('/')
+        return MySQLBackend(db=db) if db else MySQLBackend()
+    elif scheme == 'sqlite' and rest.startswith('/') and len(rest) > 1:
+        return SQLiteBackend(rest[1:])
+    raise ValueError("unknown storage backend {}".format(url))
+
+
+class ConnectionPool(object):
+    """pool of idle connections to one backend.  Connections are reused
+    across calls to `connect` instead of being opened per function call;
+    each is handed to one caller at a time.
+
+    ARGS:
+        backend: MySQLBackend or SQLiteBackend.
+            backend to open connections on.
+
+    KWARGS:
+        size: int.
+            idle connections kept per set of connection options.  Default 4.
+    """
+    def __init__(self,backend,size=4):
+        self.backend = backend
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connect(self,**kwargs):
+        """checks out a connection, see `connect`.
+        """
+        key = tuple(sorted(kwargs.items()))
+        conn = None
+        with self.lock:
+            if self.idle.get(key):
+                conn = self.idle[key].pop()
+        if conn is not None:
+            try:
+                conn.ping(reconnect=True)
+            except Exception:
+                conn = None
+        if conn is None:
+            conn = self.backend.open(**kwargs)
+        return _PooledConnection(self,key,conn)
+
+    def release(self,key,conn):
+        """takes back a connection, discarding any uncommitted work.
+        """
+        try:
+            conn.rollback()
+        except Exception:
+            conn.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(key,[])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """closes every idle connection.
+        """
+        with self.lock:
+            idle,self.idle = self.idle,{}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class _PooledConnection(object):
+    """connection checked out of a `ConnectionPool`.  `close` returns it to
+    the pool.
+    """
+    def __init__(self,pool,key,conn):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        if self.conn is not None:
+            self.pool.release(self.key,self.conn)
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.close()
+        return False
+
+
+# pools by (process id,backend url), so forked workers never share sockets
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def configure(url='mysql',pool_size=4):
+    """selects the backend for this process and the worker processes it
+    starts afterwards.
+
+    KWARGS:
+        url: string.
+            backend URL, see `backend_from_url`.  Default 'mysql'.
+        pool_size: int.
+            idle connections kept per pool.  Default 4.
+    """
+    os.environ[BACKEND_ENV] = backend_from_url(url).url()
+    os.environ[POOL_SIZE_ENV] = str(pool_size)
+
+
+def get_pool():
+    """this process's pool for the configured backend.
+
+    RETURNS:
+        pool: ConnectionPool.
+    """
+    url = os.environ.get(BACKEND_ENV,'mysql')
+    key = (os.getpid(),url)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                backend_from_url(url),
+                size=int(os.environ.get(POOL_SIZE_ENV,4)))
+        return _pools[key]
+
+
+def connect(**kwargs):
+    """checks out a pooled connection to the configured backend.  Close it
+    (or use it as a context manager) to return it to the pool; uncommitted
+    work is rolled back on return.
+
+    KWARGS:
+        **kwargs:
+            extra connection options, e.g. `local_infile=True` for MySQL.
+            Connections with different options are pooled separately.
+
+    RETURNS:
+        conn: connection.
+            pymysql-style connection, with `cursor`, `commit`, `rollback`
+            and `close`.
+    """
+    return get_pool().connect(**kwargs)
+
+
+def dialect():
+    """SQL dialect of the configured backend, 'mysql' or 'sqlite'.
+    """
+    return get_pool().backend.dialect
+
+
+def create_tables(comment_fields,submission_fields):
+    """creates the Comments, Submissions and Subreddits tables on the
+    configured backend, if missing.  The index tables are created by
+    `build_index.build_card_db` and `build_index.build_keyword_db`.
+
+    ARGS:
+        comment_fields, submission_fields: list.
+            post columns, as (name,type) tuples, e.g.
+            `read_json.COMMENT_FIELDS` and `read_json.SUBMISSION_FIELDS`.
+    """
+    types = _COLUMN_TYPES[dialect()]
+    tables = [('Comments',comment_fields),
+              ('Submissions',submission_fields),
+              ('Subreddits',_SUBREDDIT_FIELDS)]
+    with connect() as conn:
+        cur = conn.cursor()
+        for table,fields in tables:
+            columns = ["`id` VARCHAR(10) PRIMARY KEY NOT NULL"]
+            columns += ["`{}` {}".format(name,types[kind])
+                        for name,kind in fields if name != 'id']
+            cur.execute("CREATE TABLE IF NOT EXISTS {} ({});"
+                        .format(table,', '.join(columns)))
+        conn.commit()
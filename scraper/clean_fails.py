@@ -1,37 +1,78 @@
 """cleanup scripts for handling failed downloads, for use in rerunning script.
+Failed dumps are read from the dump manifest (see `manifest`) when there is
+one, or else from failed_downloads.log.
 """
 
 import os
+import get_files as g
+import manifest as mf
 
 
-def get_fails():
-    """extracts list of failed downloads from logfile.
+def _use_manifest(manifest):
+    """turns on the manifest `manifest`, the configured one, or the default
+    `manifest.MANIFEST_FILE` if it exists.  False if there is none.
     """
-    failed_downloads = []
-    with open('failed_downloads.log','r') as logfile:
-        for line in logfile:
-            failed_downloads.append(line)
+    if manifest is not None:
+        mf.configure(manifest)
+    elif not mf.enabled() and os.path.exists(mf.MANIFEST_FILE):
+        mf.configure(mf.MANIFEST_FILE)
+    return mf.enabled()
+
+
+def get_fails(manifest=None):
+    """lists dumps whose last download, verification or filter attempt
+    failed.
+
+    KWARGS:
+        manifest: string or None.
+            dump manifest file, see `manifest.configure`.  Default None, uses
+            the configured manifest, else `manifest.MANIFEST_FILE` if it
+            exists, else failed_downloads.log.
+
+    RETURNS:
+        fails: set.
+            names or paths of the failed dumps.
+    """
+    if _use_manifest(manifest):
+        failed_downloads = set(row['name'] for row in mf.failed())
+    elif os.path.exists('failed_downloads.log'):
+        with open('failed_downloads.log','r') as logfile:
+            failed_downloads = set(line.strip() for line in logfile
+                                   if line.strip())
+    else:
+        failed_downloads = set()
 
     print("{} bad files".format(len(failed_downloads)))
-    return set(failed_downloads)
+    return failed_downloads
 
 
-def clean_dir(dl_dir):
-    """removes bad download files from `dir`.
+def clean_dir(dl_dir,manifest=None):
+    """removes files of failed dumps (raw, partial or scraped) from `dl_dir`,
+    then resets them in the manifest so the next run starts them afresh, or
+    clears failed_downloads.log.
 
     ARGS:
         dl_dir: string.
             path to target download directory.
+
+    KWARGS:
+        manifest: string or None.
+            passed to `get_fails`.
     """
-    failed_downloads = get_fails()
-    failed_targets = set([f[4:14] for f in failed_downloads])
+    failed_downloads = get_fails(manifest)
+    failed_targets = set([g.dump_key(f) for f in failed_downloads])
+    failed_targets.discard(None)
 
     dl_files = os.listdir(dl_dir)
     for file in dl_files:
-        if file[:10] in failed_targets:
+        if g.dump_key(file) in failed_targets:
             rem = dl_dir+'/'+file
             os.remove(rem)
             print("removed {}".format(rem))
 
-    os.remove('failed_downloads.log')
-    open('failed_downloads.log','w').close()
+    if mf.enabled():
+        for f in failed_downloads:
+            mf.mark(f,'listed',path=None,failures=0)
+    elif os.path.exists('failed_downloads.log'):
+        os.remove('failed_downloads.log')
+        open('failed_downloads.log','w').close()
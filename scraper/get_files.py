@@ -5,11 +5,43 @@ available for download.
 import requests
 from bs4 import BeautifulSoup
 import datetime as dt
-import pymysql as pms
+from reddit_common import storage as st
 import os
+import re
+import time
+from reddit_common import metrics as mx
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+BASE_URL = 'http://files.pushshift.io/reddit/'
+DOWNLOAD_DIR = '/Users/john/python/reddit_scraper/raw/'
+CHUNK_SIZE = 4*1024*1024
+DOWNLOAD_JOBS = 4
+
+# published SHA-256 sums in each dump listing, in `sha256sum` output format
+CHECKSUM_FILE = 'sha256sums.txt'
+
+# compressed dump formats, by file extension
+DUMP_EXTENSIONS = ('.bz2','.xz','.zst')
+
+# suffix of a download in progress, renamed away once complete
+PART_SUFFIX = '.part'
+
+# dump type and month in a dump or scraped-output filename, e.g. 
+# './RC_2017-01.bz2', 'RS_2019-06.zst', 'RC_2017-01_scraped_...'
+_DUMP_NAME = re.compile(r'(R[CS])_(?:v\d+_)?(\d{4}-\d{2})')
+
+# identity encoding, so Range offsets line up with the bytes on disk
+HEADERS = {
+    'Accept': "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    'Accept-Encoding': "identity",
+    'Accept-Language': "en-US,en;q=0.8"
+}
 
 def list_files():
     """pulls listings of comment and submission dumps from files.pushshift.io.
+    Where a month is offered in several formats, only the fastest to decode 
+    is kept (zstd, then xz, then bzip2).
 
     RETURNS:
         coms: set.
@@ -34,32 +66,78 @@ def list_files():
     arows = subs.find_all('a',href=True)
     links = [a['href'] for a in arows]
     links = set(links)  # strip down to unique values
-    subs = set([x for x in links if 'RS' in x])   # remove checksum, donation
+    subs = set([x for x in links if 'RS' in x 
+                and x.endswith(DUMP_EXTENSIONS)])   # remove checksum, donation
+    subs = _one_per_month(subs)
 
     # pull comment links
     arows = coms.find_all('a',href=True)
     links = [a['href'] for a in arows]
     links = set(links)
-    coms = set([x for x in links if 'RC' in x])
+    coms = set([x for x in links if 'RC' in x 
+                and x.endswith(DUMP_EXTENSIONS)])
+    coms = _one_per_month(coms)
 
     return (coms,subs)
 
 
-def restrict_files(subreddits,files):
-    """checks the establishment dates for each subreddit, drops files earlier 
-    than the earliest date from the file list to save download time.
+def list_checksums(base_url=BASE_URL,session=None,timeout=60):
+    """pulls the published SHA-256 sums of the comment and submission dumps.
+
+    KWARGS:
+        base_url: string.
+            root of the dump listings.  Default `BASE_URL`.
+        session: requests.Session or None.
+            pooled session from `get_session`.  Default None, makes one.
+        timeout: float.
+            timeout in seconds.  Default 60.
+
+    RETURNS:
+        checksums: dict.
+            map of dump filename to hex digest.  Listings that cannot be 
+            fetched are skipped, leaving those dumps to be verified on size 
+            alone.
+    """
+    if session is None:
+        session = get_session(1)
+    checksums = {}
+    for folder in ['comments','submissions']:
+        try:
+            r = session.get(base_url+folder+'/'+CHECKSUM_FILE,timeout=timeout)
+            r.raise_for_status()
+        except requests.RequestException:
+            continue
+        for line in r.text.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and len(parts[0]) == 64:
+                checksums[parts[1].lstrip('*')] = parts[0].lower()
+    return checksums
+
+
+def _one_per_month(files):
+    """keeps one file per dump month, preferring the later entries of 
+    `DUMP_EXTENSIONS`.
+    """
+    rank = lambda file: DUMP_EXTENSIONS.index(os.path.splitext(file)[1])
+    chosen = {}
+    for file in sorted(files,key=rank):
+        chosen[dump_key(file)] = file
+    return set(chosen.values())
+
+
+def earliest_month(subreddits):
+    """first month with posts in any of the subreddits, from their 
+    establishment dates in the Subreddits table.
 
     ARGS:
         subreddits: iterable.
             list of strings containing subreddit names.
-        files: iterable.
-            iterable containing the names of the files to download.
+
+    RETURNS:
+        month: datetime.date.
+            the first of the month.
     """
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8')
+    conn = st.connect()
     cur = conn.cursor()
 
     dates = []
@@ -72,15 +150,25 @@ def restrict_files(subreddits,files):
 
     conn.close()
 
-    earliest_date = min(dates).date()
-    earliest_date = earliest_date.replace(day=1)
+    return min(dates).date().replace(day=1)
+
+
+def restrict_files(subreddits,files):
+    """checks the establishment dates for each subreddit, drops files earlier 
+    than the earliest date from the file list to save download time.
+
+    ARGS:
+        subreddits: iterable.
+            list of strings containing subreddit names.
+        files: iterable.
+            iterable containing the names of the files to download.
+    """
+    earliest_date = earliest_month(subreddits)
 
     subset = files.copy()
 
     for file in list(subset):
-        date = file[5:-4]
-        month = dt.datetime.strptime(date,'%Y-%m').date()
-        if month < earliest_date:
+        if file_month(file) < earliest_date:
             subset.remove(file)
 
     return subset
@@ -94,14 +182,16 @@ def restrict_files_to_dir(files,dl_dir):
         files: iterable.
             iterable containing names of files to download.
         dir: string.
-            path to download directory to check.
+            path to download directory to check.  Raw dumps and scraped 
+            outputs both count, matched on dump type and month whatever 
+            their compression format.  Partial downloads ('.part' files) 
+            do not count, so they are requeued and resumed.
     """
-    downloaded_files = os.listdir(dl_dir)
-    downloaded_files = ['./'+file[:10]+'.bz2' for file in downloaded_files]
-    downloaded_files = set(downloaded_files)
+    downloaded = set([dump_key(file) for file in os.listdir(dl_dir)
+                      if not file.endswith(PART_SUFFIX)])
+    downloaded.discard(None)
 
-    files = set(files)
-    return files.difference(downloaded_files)
+    return set([file for file in files if dump_key(file) not in downloaded])
 
 
 def restrict_files_to_db(files):
@@ -112,11 +202,7 @@ def restrict_files_to_db(files):
         files: iterable.
             iterable containing names of files to download.
     """
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8')
+    conn = st.connect()
     cur = conn.cursor()
     query = """SELECT DATE(FROM_UNIXTIME(created_utc)) 
             FROM Submissions 
@@ -124,42 +210,257 @@ def restrict_files_to_db(files):
             LIMIT 1;
             """
     cur.execute(query)
-    lastdate = cur.fetchone()[0]
+    row = cur.fetchone()
+    conn.close()
+    if row is None or row[0] is None:
+        return set(files)
+    lastdate = row[0]
+    if isinstance(lastdate,str):     # SQLite returns dates as text
+        lastdate = dt.datetime.strptime(lastdate,'%Y-%m-%d').date()
 
     subset = files.copy()
     for file in list(subset):
-        filedate = dt.datetime.strptime(file[5:-4],'%Y-%m').date()
-        if filedate <= lastdate:
+        if file_month(file) <= lastdate:
             subset.remove(file)
     return subset
 
 
-def download(filepathURL):
-    """for the given filepath URL, download the target file.
+def dump_key(filename):
+    """dump type and month of a dump or scraped-output file, regardless of 
+    compression format.
+
+    ARGS:
+        filename: string.
+            filename or relative link, e.g. './RC_2017-01.zst'.
+
+    RETURNS:
+        key: tuple or None.
+            tuple of ('RC' or 'RS','YYYY-MM'), or None if the name does not 
+            match.
+    """
+    match = _DUMP_NAME.search(os.path.basename(filename))
+    if match is None:
+        return None
+    return match.groups()
+
+
+def file_month(filename):
+    """first day of the month covered by a dump file.
+
+    ARGS:
+        filename: string.
+            filename or relative link, e.g. './RC_2017-01.zst'.
+
+    RETURNS:
+        month: datetime.date.
+            the first of the month.
+    """
+    key = dump_key(filename)
+    if key is None:
+        raise ValueError("not a dump filename: {}".format(filename))
+    return dt.datetime.strptime(key[1],'%Y-%m').date()
+
+
+def file_url(filepathURL,base_url=BASE_URL):
+    """full URL of a dump file.
 
     ARGS:
         filepathURL: string.
-            relative link on files.pushshift.io, in the form
-            './R[C,S]_[YYYY]-[MM].bz2'.  Raw output in sets produced by 
-            `list_files`.
+            relative link, in the form './R[C,S]_[YYYY]-[MM].[bz2,xz,zst]', 
+            or the bare filename.
+
+    KWARGS:
+        base_url: string.
+            root of the dump listings.  Default `BASE_URL`.
     """
-    filepathURL = filepathURL[2:]   # strip leading relative path
-    filepath = '/Users/john/python/reddit_scraper/raw/'+filepathURL
+    filepathURL = os.path.basename(filepathURL)   # strip relative path
     if filepathURL[:2] == 'RC':
-        filepathURL = 'http://files.pushshift.io/reddit/comments/'+filepathURL
-    else:
-        filepathURL = 'http://files.pushshift.io/reddit/submissions/'+filepathURL
+        return base_url+'comments/'+filepathURL
+    return base_url+'submissions/'+filepathURL
+
+
+def remote_size(filepathURL,base_url=BASE_URL,session=None,timeout=60):
+    """size of a dump file on the server, from a HEAD request.
+
+    ARGS:
+        filepathURL: string.
+            relative link, in the form './R[C,S]_[YYYY]-[MM].[bz2,xz,zst]'.
+
+    KWARGS:
+        base_url: string.
+            root of the dump listings.  Default `BASE_URL`.
+        session: requests.Session or None.
+            pooled session from `get_session`.  Default None, makes one.
+        timeout: float.
+            timeout in seconds.  Default 60.
+
+    RETURNS:
+        size: int or None.
+            size in bytes, or None if the server does not say.
+    """
+    if session is None:
+        session = get_session(1)
+    try:
+        r = session.head(file_url(filepathURL,base_url),timeout=timeout,
+                         allow_redirects=True)
+        r.raise_for_status()
+    except requests.RequestException:
+        return None
+    size = r.headers.get('Content-Length',None)
+    return int(size) if size is not None else None
+
+
+def get_session(pool_size=DOWNLOAD_JOBS):
+    """builds a pooled HTTP session, shared across downloads.
+
+    KWARGS:
+        pool_size: int.
+            connections kept per host.  Default `DOWNLOAD_JOBS`.
+
+    RETURNS:
+        session: requests.Session.
+            session with a pooled adapter mounted for http and https.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
+    session.headers.update(HEADERS)
+    return session
+
 
+def _fetch(session,url,partpath,chunk_size,timeout):
+    """fetches `url` into `partpath`, resuming from its current size with an 
+    HTTP Range request.  Raises IOError if the body comes up short.
+    """
+    offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
     headers = {}
-    headers['Accept'] = "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8"
-    headers['Accept-Encoding'] = "gzip, deflate, sdch"
-    headers['Accept-Language'] = "en-US,en;q=0.8"
-
-    r = requests.get(filepathURL,headers=headers,stream=True)
-    with open(filepath,'wb') as writefile:
-        for chunk in r.iter_content(1024):
-            if chunk:   # filter out keep-alive new chunks
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+
+    with session.get(url,headers=headers,stream=True,timeout=timeout) as r:
+        if r.status_code == 416:
+            # nothing left to fetch if the part file is already whole
+            total = r.headers.get('Content-Range','').split('/')[-1]
+            if total.isdigit() and int(total) == offset:
+                return
+            os.remove(partpath)
+            raise IOError("bad partial file for {}".format(url))
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            offset = 0      # server ignored the range, start over
+        expected = r.headers.get('Content-Length',None)
+        if expected is not None:
+            expected = int(expected) + offset
+
+        with open(partpath,'ab' if offset else 'wb') as writefile:
+            for chunk in r.iter_content(chunk_size):
                 writefile.write(chunk)
-                writefile.flush()
-            
-    r.close()
\ No newline at end of file
+
+    if expected is not None and os.path.getsize(partpath) != expected:
+        raise IOError("incomplete download of {}".format(url))
+
+
+def download(filepathURL,dl_dir=DOWNLOAD_DIR,base_url=BASE_URL,session=None,
+             chunk_size=CHUNK_SIZE,retries=5,backoff=2.,timeout=60,
+             on_fail=None):
+    """for the given filepath URL, download the target file.  Data is written 
+    to a '.part' file, which is resumed with HTTP Range requests across 
+    retries and renamed into place once complete.
+
+    ARGS:
+        filepathURL: string.
+            relative link on files.pushshift.io, in the form
+            './R[C,S]_[YYYY]-[MM].[bz2,xz,zst]'.  Raw output in sets 
+            produced by `list_files`.  The bare filename also works.
+
+    KWARGS:
+        dl_dir: string.
+            download directory.  Default `DOWNLOAD_DIR`.
+        base_url: string.
+            root of the dump listings.  Default `BASE_URL`.
+        session: requests.Session or None.
+            pooled session from `get_session`.  Default None, makes one.
+        chunk_size: int.
+            bytes per read from the response.  Default `CHUNK_SIZE`.
+        retries: int.
+            retries after a failed attempt.  Default 5.
+        backoff: float.
+            seconds to wait before the first retry, doubling after each.  
+            Default 2.
+        timeout: float.
+            connect/read timeout in seconds.  Default 60.
+        on_fail: callable or None.
+            called as `on_fail(filepath,error)` once every attempt has 
+            failed, e.g. `manifest.fail`.  Default None, notes the file in 
+            failed_downloads.log.
+
+    RETURNS:
+        filepath: string or None.
+            path of the downloaded file, or None if every attempt failed.
+    """
+    filepath = os.path.join(dl_dir,os.path.basename(filepathURL))
+    partpath = filepath + PART_SUFFIX
+    filepathURL = file_url(filepathURL,base_url)
+
+    if session is None:
+        session = get_session(1)
+
+    start = time.time()
+    for attempt in range(retries+1):
+        try:
+            _fetch(session,filepathURL,partpath,chunk_size,timeout)
+            os.replace(partpath,filepath)
+            mx.record('download',file=filepathURL,
+                      bytes=os.path.getsize(filepath),retries=attempt,
+                      seconds=time.time()-start)
+            return filepath
+        except (requests.RequestException,IOError) as e:
+            if attempt == retries:
+                mx.record('download',file=filepathURL,failed=1,
+                          retries=attempt,seconds=time.time()-start,
+                          error=repr(e))
+                print("failed to download {}: {}".format(filepathURL,e))
+                if on_fail is not None:
+                    on_fail(filepath,"download failed: {!r}".format(e))
+                else:
+                    with open('failed_downloads.log','a') as failedfile:
+                        failedfile.write(filepath)
+                        failedfile.write('\n')
+                return None
+            wait = backoff * 2**attempt
+            print("retrying {} in {:.0f}s: {}".format(filepathURL,wait,e))
+            time.sleep(wait)
+
+
+def download_many(files,n_jobs=DOWNLOAD_JOBS,**kwargs):
+    """downloads files concurrently over one pooled session.
+
+    ARGS:
+        files: iterable.
+            filenames as output by `list_files`.
+
+    KWARGS:
+        n_jobs: int.
+            number of concurrent downloads.  Default `DOWNLOAD_JOBS`.
+        **kwargs:
+            passed to `download`.
+
+    YIELDS:
+        result: tuple.
+            tuple of (filename,downloaded path or None,seconds), in order of 
+            completion.
+    """
+    if kwargs.get('session',None) is None:
+        kwargs['session'] = get_session(n_jobs)
+
+    def job(file):
+        start = time.time()
+        return (file,download(file,**kwargs),time.time()-start)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(job,file) for file in files]
+        for future in as_completed(futures):
+            yield future.result()
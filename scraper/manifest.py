@@ -0,0 +1,329 @@
+"""Local manifest of dump files and their progress through the pipeline:
+
+    listed      offered on files.pushshift.io
+    downloaded  raw archive on disk
+    verified    size and checksum checked
+    filtered    scraped output written (the raw archive is then deleted)
+    loaded      scraped output read into SQL
+
+Each dump (one per type and month, see `get_files.dump_key`) is one row of a
+SQLite file, with its sizes, checksum, timings and line counts, so pipeline
+state is read from one indexed table rather than inferred from directory
+listings, logs and the posts tables.  Like `metrics`, the manifest is chosen
+by an environment variable (REDDIT_MANIFEST, see `configure`), so worker
+processes update the same file, and every update is a no-op while it is off.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import get_files as g
+
+
+MANIFEST_ENV = 'REDDIT_MANIFEST'
+MANIFEST_FILE = 'dump_manifest.sqlite'
+
+STAGES = ('listed','downloaded','verified','filtered','loaded')
+
+# columns besides the key, stage and timestamps, settable through `mark`
+FIELDS = ['name','codec','path','remote_size','size','checksum',
+          'expected_checksum','download_seconds','verify_seconds',
+          'lines_read','lines_kept','filter_seconds','rows_loaded',
+          'load_seconds','outputs','error','failures']
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS dumps (
+        kind TEXT NOT NULL,
+        month TEXT NOT NULL,
+        name TEXT NOT NULL,
+        codec TEXT,
+        stage INTEGER NOT NULL DEFAULT 0,
+        path TEXT,
+        remote_size INTEGER,
+        size INTEGER,
+        checksum TEXT,
+        expected_checksum TEXT,
+        download_seconds REAL,
+        verify_seconds REAL,
+        lines_read INTEGER,
+        lines_kept INTEGER,
+        filter_seconds REAL,
+        rows_loaded INTEGER,
+        load_seconds REAL,
+        outputs TEXT,
+        error TEXT,
+        failures INTEGER NOT NULL DEFAULT 0,
+        listed_at REAL,
+        downloaded_at REAL,
+        verified_at REAL,
+        filtered_at REAL,
+        loaded_at REAL,
+        updated_at REAL,
+        PRIMARY KEY (kind,month))""",
+    "CREATE INDEX IF NOT EXISTS dumps_queue ON dumps (stage,month,kind)"
+]
+
+
+def configure(path=MANIFEST_FILE):
+    """turns the manifest on (or off) for this process and the worker
+    processes it starts afterwards, creating the file if missing.
+
+    KWARGS:
+        path: string or None.
+            SQLite manifest file.  Default `MANIFEST_FILE`; None turns the
+            manifest off.
+    """
+    if path is None:
+        os.environ.pop(MANIFEST_ENV,None)
+        return
+    os.environ[MANIFEST_ENV] = os.path.abspath(path)
+    conn = _connect()
+    with conn:
+        for query in _SCHEMA:
+            conn.execute(query)
+    conn.close()
+
+
+def enabled():
+    """True if a manifest is configured.
+    """
+    return bool(os.environ.get(MANIFEST_ENV))
+
+
+def _connect():
+    conn = sqlite3.connect(os.environ[MANIFEST_ENV],timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def _key(filename):
+    """(kind,month) of a dump, raw or scraped file name or path.
+    """
+    key = g.dump_key(filename)
+    if key is None:
+        raise ValueError("not a dump filename: {}".format(filename))
+    return key
+
+
+def list_files(files,checksums=None):
+    """records dumps offered for download.  A month already in the manifest
+    keeps its progress; if it has not been downloaded yet, its name is
+    updated to the newly listed one (e.g. a zstd re-release).
+
+    ARGS:
+        files: iterable.
+            relative links, as output by `get_files.list_files`.
+
+    KWARGS:
+        checksums: dict or None.
+            map of file basename to expected SHA-256 hex digest, see
+            `get_files.list_checksums`.  Default None.
+    """
+    if not enabled():
+        return
+    checksums = checksums or {}
+    now = time.time()
+    rows = []
+    for file in files:
+        kind,month = _key(file)
+        rows.append((kind,month,file,_codec(file),
+                     checksums.get(os.path.basename(file)),now,now))
+    conn = _connect()
+    with conn:
+        conn.executemany(
+            "INSERT INTO dumps (kind,month,name,codec,expected_checksum,"
+            "listed_at,updated_at) VALUES (?,?,?,?,?,?,?) "
+            "ON CONFLICT(kind,month) DO UPDATE SET "
+            "name=CASE WHEN stage=0 THEN excluded.name ELSE name END, "
+            "codec=CASE WHEN stage=0 THEN excluded.codec ELSE codec END, "
+            "expected_checksum=CASE WHEN stage=0 THEN "
+            "excluded.expected_checksum ELSE expected_checksum END, "
+            "updated_at=excluded.updated_at",rows)
+    conn.close()
+
+
+def _codec(filename):
+    ext = os.path.splitext(filename)[1]
+    return ext[1:] if ext in g.DUMP_EXTENSIONS else None
+
+
+def mark(filename,stage=None,**fields):
+    """records progress on a dump.  The dump's stage becomes the one given,
+    even if it is an earlier one (e.g. a loaded dump filtered again, whose
+    new output has not been loaded).
+
+    ARGS:
+        filename: string.
+            name or path of the dump, or of one of its scraped outputs.
+
+    KWARGS:
+        stage: string or None.
+            stage reached, one of `STAGES`; its timestamp is set and any
+            earlier error is cleared.  Default None, fields only.
+        **fields:
+            values for `FIELDS`, e.g. `size=...`.
+    """
+    if not enabled():
+        return
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError("unknown manifest fields {}".format(sorted(unknown)))
+
+    kind,month = _key(filename)
+    now = time.time()
+    values = dict(fields)
+    values['updated_at'] = now
+    assignments = ["{}=?".format(field) for field in values]
+    args = list(values.values())
+    if stage is not None:
+        assignments += ["stage=?","{}_at=?".format(stage),
+                        "error=NULL"]
+        args += [STAGES.index(stage),now]
+
+    conn = _connect()
+    with conn:
+        # named as by `list_files`, so the name can be downloaded
+        conn.execute("INSERT OR IGNORE INTO dumps (kind,month,name,codec,"
+                     "listed_at,updated_at) VALUES (?,?,?,?,?,?)",
+                     (kind,month,'./'+os.path.basename(filename),
+                      _codec(filename),now,now))
+        conn.execute("UPDATE dumps SET {} WHERE kind=? AND month=?"
+                     .format(', '.join(assignments)),args+[kind,month])
+    conn.close()
+
+
+def fail(filename,error):
+    """records a failed attempt at a dump's next stage.  Its stage is kept, so
+    the next run retries it.
+    """
+    if not enabled():
+        return
+    kind,month = _key(filename)
+    conn = _connect()
+    with conn:
+        conn.execute("UPDATE dumps SET error=?, failures=failures+1, "
+                     "updated_at=? WHERE kind=? AND month=?",
+                     (str(error),time.time(),kind,month))
+    conn.close()
+
+
+def queue(before='filtered',since=None,max_failures=None):
+    """dumps still short of a stage, oldest month first, in one query over
+    the manifest index.
+
+    KWARGS:
+        before: string.
+            stage the dumps have not reached.  Default 'filtered'.
+        since: datetime.date, string or None.
+            earliest month to include, as a date or 'YYYY-MM'.  Default None.
+        max_failures: int or None.
+            skip dumps that have failed more often than this.  Default None.
+
+    RETURNS:
+        dumps: list.
+            list of dicts of the manifest columns, including 'stage' as a
+            name.
+    """
+    query = "SELECT * FROM dumps WHERE stage < ?"
+    args = [STAGES.index(before)]
+    if since is not None:
+        query += " AND month >= ?"
+        args.append(since if isinstance(since,str)
+                    else since.strftime('%Y-%m'))
+    if max_failures is not None:
+        query += " AND failures <= ?"
+        args.append(max_failures)
+    query += " ORDER BY stage, month, kind"
+    return _rows(query,args)
+
+
+def failed():
+    """dumps whose last attempt at a stage failed, oldest month first.
+
+    RETURNS:
+        dumps: list.
+            list of dicts of the manifest columns, see `queue`.
+    """
+    return _rows("SELECT * FROM dumps WHERE error IS NOT NULL "
+                 "ORDER BY month, kind",[])
+
+
+def status(filename):
+    """manifest row of a dump as a dict, or None if it is not recorded.
+    """
+    rows = _rows("SELECT * FROM dumps WHERE kind=? AND month=?",
+                 list(_key(filename)))
+    return rows[0] if rows else None
+
+
+def summary():
+    """number of dumps at each stage, plus those with an outstanding error.
+
+    RETURNS:
+        counts: dict.
+            map of stage name (and 'failed') to number of dumps.
+    """
+    counts = dict((stage,0) for stage in STAGES)
+    conn = _connect()
+    for stage,count in conn.execute("SELECT stage,COUNT(*) FROM dumps "
+                                    "GROUP BY stage"):
+        counts[STAGES[stage]] = count
+    counts['failed'] = conn.execute("SELECT COUNT(*) FROM dumps WHERE "
+                                    "error IS NOT NULL").fetchone()[0]
+    conn.close()
+    return counts
+
+
+def _rows(query,args):
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    rows = [dict(row) for row in conn.execute(query,args)]
+    conn.close()
+    for row in rows:
+        row['stage'] = STAGES[row['stage']]
+    return rows
+
+
+def checksum(filepath,chunk_size=g.CHUNK_SIZE):
+    """SHA-256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(filepath,'rb') as readfile:
+        for chunk in iter(lambda: readfile.read(chunk_size),b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify(filename,filepath):
+    """checks a downloaded dump against its listed size and checksum, and
+    marks it verified.  A dump with no expected checksum is verified on size
+    alone, recording its checksum for reference.
+
+    ARGS:
+        filename: string.
+            name of the dump, as listed.
+        filepath: string.
+            downloaded path.
+
+    RETURNS:
+        ok: boolean.
+            False on a mismatch, which is recorded with `fail`.
+    """
+    start = time.time()
+    size = os.path.getsize(filepath)
+    digest = checksum(filepath)
+    row = status(filename) if enabled() else None
+    expected_size = row['remote_size'] if row else None
+    expected = row['expected_checksum'] if row else None
+
+    if expected_size and size != expected_size:
+        fail(filename,"size {} != listed {}".format(size,expected_size))
+        return False
+    if expected and digest != expected:
+        fail(filename,"checksum mismatch")
+        return False
+    mark(filename,'verified',size=size,checksum=digest,
+         verify_seconds=time.time()-start)
+    return True
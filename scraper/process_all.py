@@ -2,98 +2,380 @@
 """
 
 import os
+import multiprocessing as mp
 from joblib import Parallel, delayed
-import itertools
 import read_json as r
 import get_files as g
+from reddit_common import metrics as mx
+import manifest as mf
+import time
 import datetime as dt
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor, 
+                                wait, FIRST_COMPLETED)
 
 
-def process_all(dl_dir,subreddits,n_jobs=8):
+def process_all(dl_dir,subreddits,n_jobs=8,decompress_jobs=1,output='json'):
     """process all zipped files in target dir.
 
     ARGS:
         dl_dir: string.
             path to directory containing zipped files.
-        subreddits: iterable.
-            list of strings storing the target subreddit names.
-            passed to `read_json.process`.
+        subreddits: iterable or dict.
+            list of strings storing the target subreddit names, or a dict of 
+            output name to such lists to write several groups in one pass.
+            passed to `read_json.process_zip`.
+
+    KWARGS:
+        n_jobs: int.
+            number of files processed in parallel.
+        decompress_jobs: int.
+            number of processes decoding each file, passed to 
+            `read_json.process_zip`.  Use with a low `n_jobs` when a few 
+            large months dominate.  Default 1.
+        output: string.
+            scraped output format, 'json' or 'parquet', passed to 
+            `read_json.process_zip`.  Default 'json'.
     """
     files = os.listdir(dl_dir)
-    files = [file for file in files if file[-3:] == 'bz2']
+    files = [file for file in files if r.dump_codec(file) is not None]
     files = [dl_dir+'/'+file for file in files]
 
-    Parallel(n_jobs=n_jobs,verbose=5)(delayed(r.process_zip)(file,subreddits) 
-                                 for file in files)
+    Parallel(n_jobs=n_jobs,verbose=5)(delayed(r.process_zip)(
+        file,subreddits,decompress_jobs=decompress_jobs,output=output) 
+        for file in files)
 
 
-def download_set(files):
+def download_set(files,n_jobs=g.DOWNLOAD_JOBS):
     """download all of the files specified in the input.
 
     ARGS:
         files: iterable.
             set or list of filenames as output by `get_files.list_files`.
             list allows for downloading subsets.
+
+    KWARGS:
+        n_jobs: int.
+            number of concurrent downloads.
+    """
+    count = len(files)
+    results = g.download_many(files,n_jobs=n_jobs,on_fail=_on_fail())
+    for i,(file,filepath,elapsed) in enumerate(results):
+        status = "downloaded" if filepath is not None else "failed"
+        print("{}/{} {} {}: time {:.1f}s".format(i+1,count,status,file,elapsed))
+
+
+def _on_fail():
+    """download failure callback -- records the error in the dump manifest 
+    if it is on, or None to note the file in failed_downloads.log.
     """
-    for i,file in enumerate(files):
-        count = len(files)
-        now = dt.datetime.now()
-        g.download(file)
-        then = dt.datetime.now()
-        time = then - now
-        print("{}/{} downloaded {}: time {}".format(i+1,count,file,time))
+    return mf.fail if mf.enabled() else None
+
+
+def _fetch_dump(file,dl_dir,base_url,session):
+    """download-pool job -- downloads a dump and, with the manifest on, 
+    verifies it.  A raw file left on disk by an earlier run, as recorded in 
+    the manifest, is reused rather than downloaded again.
+
+    RETURNS:
+        filepath: string or None.
+            path of the raw file, or None if it could not be fetched or 
+            failed verification.
+    """
+    row = mf.status(file) if mf.enabled() else None
+    if (row is not None and row['stage'] in ('downloaded','verified') and 
+            row['path'] and os.path.exists(row['path'])):
+        filepath = row['path']
+        if row['stage'] == 'verified':
+            return filepath
+    else:
+        start = time.time()
+        filepath = g.download(file,dl_dir=dl_dir,base_url=base_url,
+                              session=session,on_fail=_on_fail())
+        if filepath is None:
+            return None
+        mf.mark(file,'downloaded',path=filepath,
+                size=os.path.getsize(filepath),
+                download_seconds=time.time()-start)
+
+    if mf.enabled() and not mf.verify(file,filepath):
+        print("{} failed verification".format(file))
+        os.remove(filepath)
+        return None
+    return filepath
 
 
-def run_all(subreddits,n=10,n_jobs=8):
-    """wrapper function for processing.  Gets download file list, breaks into 
-    chunks to avoid storage-space hogging.  Downloads each chunk, then 
-    processes it (renders down to the scraped dataset and deletes the original 
-    to free up space).
+def run_pipeline(files,subreddits,dl_dir=g.DOWNLOAD_DIR,n=10,n_jobs=8,
+                 dl_jobs=g.DOWNLOAD_JOBS,disk_budget=50*1024**3,
+                 base_url=g.BASE_URL,decompress_jobs=1,output='json'):
+    """overlapped download/process pipeline.  Files are downloaded 
+    concurrently and each one is handed to the processing pool as soon as 
+    it lands, so network and CPU stay busy together.  New downloads wait 
+    while raw files on disk (downloading or awaiting processing) would exceed 
+    `disk_budget` bytes or `n` files; `process_zip` deletes each raw file once 
+    it has been filtered, freeing its share of the budget.  With the dump 
+    manifest on (see `manifest`), each download is verified before it is 
+    processed, and raw files left by an interrupted run are reused.
 
     ARGS:
-        subreddits: iterable.
-            list of strings storing target subreddit names.  
-            passed to `read_json.process`.
+        files: iterable.
+            filenames as output by `get_files.list_files`.
+        subreddits: iterable or dict.
+            list of strings storing target subreddit names, or a dict of 
+            output name to such lists, see `read_json.process_zip`.
 
     KWARGS:
+        dl_dir: string.
+            download directory.  Default `get_files.DOWNLOAD_DIR`.
         n: int.
-            size of chunks to break down downloads.
+            max raw files on disk at once.  Default 10.
         n_jobs: int.
-            number of parallel jobs for process_all.
+            number of processing jobs.  Default 8.
+        dl_jobs: int.
+            number of concurrent downloads.  Default `get_files.DOWNLOAD_JOBS`.
+        disk_budget: int.
+            max bytes of raw files on disk at once.  A file larger than the 
+            whole budget is still run, alone.  Default 50 GB.
+        base_url: string.
+            root of the dump listings.  Default `get_files.BASE_URL`.
+        decompress_jobs, output:
+            passed to `read_json.process_zip`.
     """
-    coms,subs = g.list_files()
-    files = coms | subs     # merge sets
-    files = g.restrict_files(subreddits,files)
-    files = g.restrict_files_to_db(files)
-    files = g.restrict_files_to_dir(files,
-                                    '/Users/john/python/reddit_scraper/raw/')
-    groups = grouper(n,files)
-    n_groups = len(groups)
+    queue = sorted(files)
+    count = len(queue)
+    session = g.get_session(dl_jobs)
 
-    print("running {} targets in batches of {}\n".format(len(files),n))
+    sizes = {}
+    on_disk = 0
+    downloads = {}
+    processes = {}
+    n_done = 0
+    start = time.time()
 
-    for i,group in enumerate(groups):
-        print("group {} of {}".format(i+1,n_groups))
-        group = [file for file in group if file is not None]
-        download_set(group)
-        process_all('raw',subreddits,n_jobs=n_jobs)
+    # processing workers come from a forkserver, never forked from this 
+    # process while a download thread holds a manifest connection (SQLite 
+    # locks do not survive a fork)
+    with ThreadPoolExecutor(max_workers=dl_jobs) as dl_pool, \
+            ProcessPoolExecutor(max_workers=n_jobs,
+                                mp_context=mp.get_context('forkserver')
+                                ) as proc_pool:
+        while queue or downloads or processes:
+            # start downloads while the budget allows
+            while queue and len(downloads) < dl_jobs:
+                file = queue[0]
+                if file not in sizes:
+                    sizes[file] = g.remote_size(file,base_url=base_url,
+                                                session=session) or 0
+                    if sizes[file]:
+                        mf.mark(file,remote_size=sizes[file])
+                n_raw = len(downloads) + len(processes)
+                if n_raw and (n_raw >= n or 
+                              on_disk + sizes[file] > disk_budget):
+                    break
+                queue.pop(0)
+                on_disk += sizes[file]
+                future = dl_pool.submit(_fetch_dump,file,dl_dir,base_url,
+                                        session)
+                downloads[future] = (file,time.time())
 
+            mx.gauge('pipeline',queued=len(queue),downloading=len(downloads),
+                     processing=len(processes),raw_bytes_on_disk=on_disk)
+            done,_ = wait(list(downloads) + list(processes),
+                          return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    file,began = downloads.pop(future)
+                    filepath = future.result()
+                    if filepath is None:
+                        on_disk -= sizes[file]
+                        n_done += 1
+                        print("{}/{} failed to download {}"
+                              .format(n_done,count,file))
+                        continue
+                    print("downloaded {}: time {:.1f}s"
+                          .format(file,time.time()-began))
+                    processes[proc_pool.submit(
+                        r.process_zip,filepath,subreddits,
+                        decompress_jobs=decompress_jobs,
+                        output=output)] = (file,time.time())
+                else:
+                    file,began = processes.pop(future)
+                    future.result()
+                    on_disk -= sizes[file]
+                    n_done += 1
+                    print("{}/{} processed {}: time {:.1f}s, {:.1f} GB raw "
+                          "on disk".format(n_done,count,file,
+                                           time.time()-began,on_disk/1024**3))
 
-def grouper(n, iterable, fillvalue=None):
-    """helper function to unflatten iterables.  For example,
+    print("pipeline finished in {:.1f}s".format(time.time()-start))
 
-    grouper(3, 'ABCDEFG', 'x') --> [[ABC], [DEF], [Gxx]]
+
+def stream_file(file,subreddits,dl_dir=g.DOWNLOAD_DIR,base_url=g.BASE_URL,
+                output='json'):
+    """processes one dump by streaming it straight from HTTP with 
+    `read_json.process_url`, so only the filtered output touches disk.  If 
+    the stream fails, falls back to downloading the file and running 
+    `read_json.process_zip` on it.
 
     ARGS:
-        n: int or float.
-            size of sublists to return.
-        iterable: iterable.
-            flattened iterable.
+        file: string.
+            filename as output by `get_files.list_files`.
+        subreddits: iterable or dict.
+            list of strings storing target subreddit names, or a dict of 
+            output name to such lists, see `read_json.process_zip`.
 
     KWARGS:
-        fillvalue:
-            filler value to pad out lists.  Default None.
+        dl_dir: string.
+            output (and fallback download) directory.  
+            Default `get_files.DOWNLOAD_DIR`.
+        base_url: string.
+            root of the dump listings.  Default `get_files.BASE_URL`.
+        output: string.
+            passed to `read_json.process_zip`.  Default 'json'.
+
+    RETURNS:
+        streamed: boolean.
+            True if streamed, False if the fallback path was used.
     """
-    args = [iter(iterable)] * n
-    groups = list(itertools.zip_longest(fillvalue=fillvalue, *args))
-    return [list(el) for el in groups]
\ No newline at end of file
+    session = g.get_session(1)
+    writefilepath = os.path.join(dl_dir,os.path.basename(file).split('.')[0]+
+                                 '_scraped_{}'
+                                 .format(dt.datetime.now()))
+    if r.process_url(g.file_url(file,base_url),subreddits,writefilepath,
+                     session=session,output=output):
+        return True
+
+    filepath = g.download(file,dl_dir=dl_dir,base_url=base_url,
+                          session=session,on_fail=_on_fail())
+    if filepath is not None:
+        r.process_zip(filepath,subreddits,output=output)
+    return False
+
+
+def stream_all(files,subreddits,dl_dir=g.DOWNLOAD_DIR,n_jobs=8,
+               base_url=g.BASE_URL,output='json'):
+    """runs `stream_file` over many files in parallel.
+
+    ARGS:
+        files: iterable.
+            filenames as output by `get_files.list_files`.
+        subreddits: iterable or dict.
+            list of strings storing target subreddit names, or a dict of 
+            output name to such lists, see `read_json.process_zip`.
+
+    KWARGS:
+        dl_dir, base_url, output:
+            passed to `stream_file`.
+        n_jobs: int.
+            number of files streamed at once.  Default 8.
+    """
+    Parallel(n_jobs=n_jobs,verbose=5)(delayed(stream_file)(
+        file,subreddits,dl_dir=dl_dir,base_url=base_url,output=output) 
+        for file in sorted(files))
+
+
+def run_all(subreddits,n=10,n_jobs=8,dl_jobs=g.DOWNLOAD_JOBS,
+            disk_budget=50*1024**3,decompress_jobs=1,output='json',
+            stream=False,metrics=None,profile=None,
+            manifest=mf.MANIFEST_FILE):
+    """wrapper function for processing.  Gets download file list and runs it 
+    through `run_pipeline`, which downloads and processes (renders down to 
+    the scraped dataset and deletes the original to free up space) files 
+    concurrently, within a disk-space budget.
+
+    The listing is recorded in the dump manifest, and the work queue is every 
+    dump from the subreddits' first month on that has not been filtered yet, 
+    read from the manifest in one query.  Dumps finished before a crash are 
+    never redone.  A new manifest is seeded from the posts tables and the 
+    download directory.
+
+    ARGS:
+        subreddits: iterable or dict.
+            list of strings storing target subreddit names, or a dict of 
+            output name to such lists.  passed to `read_json.process_zip`.
+
+    KWARGS:
+        n: int.
+            max raw files on disk at once.
+        n_jobs: int.
+            number of parallel processing jobs.
+        dl_jobs: int.
+            number of concurrent downloads.
+        disk_budget: int.
+            max bytes of raw files on disk at once.
+        decompress_jobs, output:
+            passed to `read_json.process_zip`.
+        stream: boolean.
+            stream each dump from HTTP through the filter instead of 
+            downloading it first, see `stream_all`.  Default False.
+        metrics: string or None.
+            JSON-lines file to record stage metrics in ('download', 'filter' 
+            and queue depths under 'pipeline'), see `metrics.configure`.  
+            Default None, leaves the current setting.
+        profile: iterable or None.
+            stage names to profile, see `metrics.configure`.  Default None, 
+            leaves the current setting.
+        manifest: string or None.
+            dump manifest file, see `manifest.configure`.  Default 
+            `manifest.MANIFEST_FILE`.  None works from the directory listing 
+            and the posts tables instead.
+    """
+    if metrics is not None or profile is not None:
+        mx.configure(path=metrics,profile=profile)
+
+    coms,subs = g.list_files()
+    files = coms | subs     # merge sets
+    if manifest is not None:
+        mf.configure(manifest)
+        fresh = not any(mf.summary()[stage] for stage in mf.STAGES)
+        mf.list_files(files,checksums=g.list_checksums())
+        if fresh:
+            _seed_manifest(files)
+        since = g.earliest_month(r.all_subreddits(subreddits))
+        files = [row['name'] for row in mf.queue(before='filtered',
+                                                 since=since)]
+    else:
+        files = g.restrict_files(r.all_subreddits(subreddits),files)
+        files = g.restrict_files_to_db(files)
+        files = g.restrict_files_to_dir(files,g.DOWNLOAD_DIR)
+
+    print("running {} targets\n".format(len(files)))
+
+    if stream:
+        stream_all(files,subreddits,n_jobs=n_jobs,output=output)
+        return
+
+    run_pipeline(files,subreddits,n=n,n_jobs=n_jobs,dl_jobs=dl_jobs,
+                 disk_budget=disk_budget,decompress_jobs=decompress_jobs,
+                 output=output)
+
+
+def _seed_manifest(files):
+    """marks dumps an earlier run got through without a manifest -- months 
+    already in the posts tables as loaded, months with scraped outputs in the 
+    download directory as filtered, and complete raw archives there as 
+    downloaded, to be verified and filtered.  A raw archive beside a scraped 
+    output means its filtering was interrupted, so it counts as downloaded.  
+    Partial '.part' downloads are left to be resumed.
+    """
+    pending = g.restrict_files_to_db(files)
+    for file in set(files) - set(pending):
+        mf.mark(file,'loaded')
+
+    names = dict((g.dump_key(file),file) for file in pending)
+    raw = {}
+    scraped = set()
+    for file in os.listdir(g.DOWNLOAD_DIR):
+        key = g.dump_key(file)
+        if key not in names:
+            continue
+        if r.dump_codec(file) is not None:
+            raw[key] = os.path.join(g.DOWNLOAD_DIR,file)
+        elif '_scraped' in file:
+            scraped.add(key)
+
+    for key,filepath in raw.items():
+        mf.mark(names[key],'downloaded',path=filepath,
+                size=os.path.getsize(filepath))
+    for key in scraped - set(raw):
+        mf.mark(names[key],'filtered')
+
@@ -2,118 +2,1140 @@
 """
 
 import json
+import re
 import datetime as dt
 import os
+import itertools
 import bz2
-import pymysql as pms
-from collections import OrderedDict
+import lzma
+import io
+import tempfile
+import time
+from joblib import Parallel, delayed
+from reddit_common import storage as st
+import requests
+from reddit_common import metrics as mx
+import manifest as mf
+import get_files as g
 import warnings
 warnings.simplefilter('ignore')
 
 
-def process_zip(filepath,subreddits):
+# fixed columnar schemas for scraped output, mirroring the Comments and 
+# Submissions tables.  Fields of mixed type in the dumps (e.g. `edited`, which 
+# is either False or a timestamp) are stored as strings.
+COMMENT_FIELDS = [
+    ('id','string'),
+    ('author','string'),
+    ('subreddit','string'),
+    ('subreddit_id','string'),
+    ('link_id','string'),
+    ('parent_id','string'),
+    ('body','string'),
+    ('score','int64'),
+    ('gilded','int64'),
+    ('controversiality','int64'),
+    ('distinguished','string'),
+    ('edited','string'),
+    ('stickied','bool'),
+    ('created_utc','int64'),
+    ('retrieved_on','int64')
+]
+
+SUBMISSION_FIELDS = [
+    ('id','string'),
+    ('author','string'),
+    ('subreddit','string'),
+    ('subreddit_id','string'),
+    ('title','string'),
+    ('selftext','string'),
+    ('url','string'),
+    ('domain','string'),
+    ('permalink','string'),
+    ('score','int64'),
+    ('num_comments','int64'),
+    ('gilded','int64'),
+    ('over_18','bool'),
+    ('is_self','bool'),
+    ('distinguished','string'),
+    ('edited','string'),
+    ('stickied','bool'),
+    ('created_utc','int64'),
+    ('retrieved_on','int64')
+]
+
+
+def process_zip(filepath,subreddits,decompress_jobs=1,output='json'):
     """all-in-one processor for zipped files.
 
     ARGS:
         filepath: string.
-            path to zipped file to be processed.
-        subreddits: iterable.
-            list of strings containing names of target subreddits to be saved.
+            path to zipped file to be processed, compressed with bzip2 
+            (.bz2), xz (.xz) or zstd (.zst), see `open_dump`.
+        subreddits: iterable or dict.
+            list of strings containing names of target subreddits to be saved, 
+            or a dict mapping output names to such lists.  With a dict, every 
+            group is written to its own output (named with the group name 
+            before '_scraped') in the same decompression pass, and a line is 
+            written to each group that wants its subreddit.
+
+    KWARGS:
+        decompress_jobs: int.
+            number of processes decoding this one file.  Above 1, a bzip2 
+            archive of at least `_SPLIT_MIN_SIZE` bytes is split into its 
+            blocks, which are decompressed and filtered in parallel; falls 
+            back to a single stream if the split fails.  Splitting costs 
+            about 10% more CPU time than one stream, plus a few seconds 
+            starting the workers, so it only pays off with idle cores.  
+            Smaller bzip2 files and xz and zstd files are always read as one 
+            stream.  Default 1.
+        output: string.
+            'json' to write saved entries as their original raw lines, or 
+            'parquet' to write them as a zstd-compressed Parquet file with 
+            the fixed `COMMENT_FIELDS`/`SUBMISSION_FIELDS` schema (requires 
+            pyarrow).  Default 'json'.
     """
     entries_read = 0
     entries_saved = 0
-    writefilepath = (filepath.split('.')[0]+'_scraped_{}'
-                     .format(dt.datetime.now()))
-
-    subreddits = set([sub.lower() for sub in subreddits])
+    groups = subreddit_groups(subreddits)
+    stamp = dt.datetime.now()
+    paths = dict([(name,filepath.split('.')[0]+
+                   ('_'+name if name is not None else '')+
+                   '_scraped_{}'.format(stamp))
+                  for name in groups])
 
     try:
         start = dt.datetime.now()
-        with bz2.BZ2File(filepath,'r') as file:
-            with open(writefilepath,'w') as writefile:
-                for line in file:
-                    data = json.loads(line.decode())
-                    entries_read += 1
-
-                    sub = data.get('subreddit','').lower()
-                    if sub in subreddits:
-                        entries_saved += 1
-                        json.dump(data,writefile)
-                        writefile.write('\n')
-        end = dt.datetime.now()
+        writefile = _open_fanout(groups,paths,output,
+                                 'RC' in os.path.basename(filepath))
+        with mx.Stage('filter',file=filepath,
+                      codec=dump_codec(filepath)) as stage:
+            try:
+                counts = None
+                if (decompress_jobs > 1 and dump_codec(filepath) == 'bz2'
+                        and os.path.getsize(filepath) >= _SPLIT_MIN_SIZE):
+                    try:
+                        counts = _process_blocks(filepath,
+                                                 set(writefile.routes),
+                                                 writefile,decompress_jobs)
+                    except (OSError,EOFError) as e:
+                        print("parallel decode of {} failed ({}), reading "
+                              "as one stream".format(filepath,e))
+                        writefile.reset()
 
-        with open('read_json.log','a') as logfile:
-            logfile.write("reading file {}\n".format(filepath))
-            logfile.write("read started at {}\n".format(start))
-            logfile.write("read {} JSON objects, saved {} "
-                      "JSON objects ({:.2f}% saved)\n"
-                      .format(entries_read,entries_saved,
-                              entries_saved/entries_read*100.))
-            logfile.write("read finished at {}\n".format(end))
-            logfile.write("read duration: {}\n".format(end-start))
-            logfile.write('\n')
+                if counts is None:
+                    counts = _process_stream(filepath,set(writefile.routes),
+                                             writefile)
+                entries_read,entries_saved,size = counts
+            finally:
+                writefile.close()
+            stage.add(bytes_in=os.path.getsize(filepath),bytes_out=size,
+                      lines_read=entries_read,lines_kept=entries_saved)
+        end = dt.datetime.now()
+        _log_read(filepath,start,end,entries_read,entries_saved,
+                  writefile.saved)
+        mf.mark(filepath,'filtered',lines_read=entries_read,
+                lines_kept=entries_saved,
+                filter_seconds=(end-start).total_seconds(),
+                outputs=json.dumps(sorted(
+                    sink.path for sink in writefile.sinks.values())))
 
     except:
-        with open('read_json.log','a') as logfile:
-            logfile.write('read file {} failed at {}\n'
-                          .format(filepath,dt.datetime.now()))
-            logfile.write('\n')
-        with open('failed_downloads.log','a') as failedfile:
-            failedfile.write(filepath)
-            failedfile.write('\n')
+        _log_failure(filepath)
+        mf.fail(filepath,"filter failed, see read_json.log")
+        if not mf.enabled():
+            with open('failed_downloads.log','a') as failedfile:
+                failedfile.write(filepath)
+                failedfile.write('\n')
 
     os.remove(filepath)
 
 
-def read_to_sql(file, conn):
+def process_url(url,subreddits,writefilepath,session=None,output='json',
+                timeout=60):
+    """streams a dump straight from HTTP through the decompressor and 
+    subreddit filter, without writing the raw archive to disk.  The codec is 
+    taken from the extension of `url`.
+
+    ARGS:
+        url: string.
+            full URL of the zipped dump.
+        subreddits: iterable or dict.
+            list of strings containing names of target subreddits to be saved, 
+            or a dict of output name to such lists, see `process_zip`.
+        writefilepath: string.
+            output path for saved entries (without extension for Parquet).  
+            With a dict of groups, each group's output is this path with 
+            '_' and the group name appended.
+
+    KWARGS:
+        session: requests.Session or None.
+            session to fetch with.  Default None, makes one.
+        output: string.
+            'json' or 'parquet', see `process_zip`.  Default 'json'.
+        timeout: float.
+            connect/read timeout in seconds.  Default 60.
+
+    RETURNS:
+        success: boolean.
+            True if the whole stream was read.  On failure any partial 
+            output is removed, so the caller can fall back to downloading.
+    """
+    if session is None:
+        session = requests.Session()
+    groups = subreddit_groups(subreddits)
+    paths = dict([(name,writefilepath+('_'+name if name is not None else ''))
+                  for name in groups])
+    name = url.split('/')[-1]
+
+    start = dt.datetime.now()
+    writefile = _open_fanout(groups,paths,output,'RC' in name)
+    try:
+        with mx.Stage('filter',file=url,codec=dump_codec(name)) as stage, \
+                session.get(url,stream=True,timeout=timeout,
+                            headers={'Accept-Encoding': 'identity'}) as r:
+            r.raise_for_status()
+            entries_read,entries_saved,size = _process_stream(
+                r.raw,set(writefile.routes),writefile,codec=dump_codec(name))
+            stage.add(bytes_in=r.raw.tell(),bytes_out=size,
+                      lines_read=entries_read,lines_kept=entries_saved)
+        writefile.close()
+    except Exception as e:
+        writefile.close()
+        writefile.remove()
+        print("streaming {} failed: {}".format(url,e))
+        _log_failure(url)
+        mf.fail(name,"stream failed: {!r}".format(e))
+        return False
+
+    end = dt.datetime.now()
+    _log_read(url,start,end,entries_read,entries_saved,writefile.saved)
+    mf.mark(name,'filtered',lines_read=entries_read,lines_kept=entries_saved,
+            filter_seconds=(end-start).total_seconds(),
+            outputs=json.dumps(sorted(
+                sink.path for sink in writefile.sinks.values())))
+    return True
+
+
+def subreddit_groups(subreddits):
+    """normalizes target subreddits into named groups.
+
+    ARGS:
+        subreddits: iterable or dict.
+            list of subreddit names, or a dict of output name to such lists.
+
+    RETURNS:
+        groups: dict.
+            dict of output name to set of lower-case subreddit names.  A plain 
+            list becomes the single group None.
+    """
+    if not isinstance(subreddits,dict):
+        subreddits = {None: subreddits}
+    return dict([(name,set([sub.lower() for sub in subs]))
+                 for name,subs in subreddits.items()])
+
+
+def all_subreddits(subreddits):
+    """every target subreddit, across groups.
+
+    ARGS:
+        subreddits: iterable or dict.
+            as for `subreddit_groups`.
+
+    RETURNS:
+        subreddits: set.
+            lower-case subreddit names.
+    """
+    return set().union(*subreddit_groups(subreddits).values())
+
+
+def _log_read(filepath,start,end,entries_read,entries_saved,saved=None):
+    """appends a successful read to read_json.log, with the count saved by 
+    each named group in `saved` (dict of group name to count).  An empty 
+    dump logs 0% saved.
+    """
+    def share(count):
+        return count/entries_read*100. if entries_read else 0.
+
+    with open('read_json.log','a') as logfile:
+        logfile.write("reading file {}\n".format(filepath))
+        logfile.write("read started at {}\n".format(start))
+        logfile.write("read {} JSON objects, saved {} "
+                  "JSON objects ({:.2f}% saved)\n"
+                  .format(entries_read,entries_saved,share(entries_saved)))
+        for name in sorted(name for name in (saved or {}) if name is not None):
+            logfile.write("group {}: saved {} JSON objects "
+                          "({:.2f}% saved)\n"
+                          .format(name,saved[name],share(saved[name])))
+        logfile.write("read finished at {}\n".format(end))
+        logfile.write("read duration: {}\n".format(end-start))
+        logfile.write('\n')
+
+
+def _log_failure(filepath):
+    """appends a failed read to read_json.log.
+    """
+    with open('read_json.log','a') as logfile:
+        logfile.write('read file {} failed at {}\n'
+                      .format(filepath,dt.datetime.now()))
+        logfile.write('\n')
+
+
+def _open_sink(writefilepath,output,comments):
+    """opens the output for saved lines.
+
+    ARGS:
+        writefilepath: string.
+            output path, without extension.
+        output: string.
+            'json' or 'parquet', see `process_zip`.
+        comments: boolean.
+            True for a comment dump, False for submissions.
+
+    RETURNS:
+        sink: _LineSink or _ParquetSink.
+            open output.
+    """
+    if output == 'json':
+        return _LineSink(writefilepath)
+    elif output == 'parquet':
+        fields = COMMENT_FIELDS if comments else SUBMISSION_FIELDS
+        return _ParquetSink(writefilepath+'.parquet',fields)
+    raise ValueError("unknown output format {}".format(output))
+
+
+def _open_fanout(groups,paths,output,comments):
+    """opens one output per group, see `_open_sink`.
+
+    ARGS:
+        groups: dict.
+            dict of group name to set of lower-case subreddit names.
+        paths: dict.
+            dict of group name to output path, without extension.
+        output: string.
+            'json' or 'parquet', see `process_zip`.
+        comments: boolean.
+            True for a comment dump, False for submissions.
+
+    RETURNS:
+        fanout: _Fanout.
+            open outputs, routed by subreddit.
+    """
+    sinks = {}
+    try:
+        for name in groups:
+            sinks[name] = _open_sink(paths[name],output,comments)
+    except:
+        for sink in sinks.values():
+            sink.close()
+        raise
+    return _Fanout(groups,sinks)
+
+
+class _Fanout(object):
+    """saved-line output for several subreddit groups at once.  Each target 
+    subreddit maps straight to the outputs of the groups that want it, so a 
+    saved line costs one lookup however many groups there are.
+    """
+    def __init__(self,groups,sinks):
+        self.sinks = sinks
+        self.saved = dict.fromkeys(sinks,0)
+        self.routes = {}
+        for name,subs in groups.items():
+            for sub in subs:
+                self.routes.setdefault(sub,[]).append((name,sinks[name]))
+
+    def write(self,line,subreddit):
+        for name,sink in self.routes[subreddit]:
+            sink.write(line)
+            self.saved[name] += 1
+
+    def reset(self):
+        """discards everything written so far.
+        """
+        for name,sink in self.sinks.items():
+            sink.reset()
+            self.saved[name] = 0
+
+    def close(self):
+        for sink in self.sinks.values():
+            sink.close()
+
+    def remove(self):
+        """deletes the (closed) outputs.
+        """
+        for sink in self.sinks.values():
+            if os.path.exists(sink.path):
+                os.remove(sink.path)
+
+
+class _LineSink(object):
+    """newline-delimited output of saved lines, written as raw bytes.
+    """
+    def __init__(self,path):
+        self.path = path
+        self.file = open(path,'wb')
+
+    def write(self,line):
+        self.file.write(line)
+        if not line.endswith(b'\n'):
+            self.file.write(b'\n')
+
+    def reset(self):
+        """discards everything written so far.
+        """
+        self.file.seek(0)
+        self.file.truncate()
+
+    def close(self):
+        self.file.close()
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def _to_bool(value):
+    if isinstance(value,str):
+        return value.strip().lower() not in ('','0','false')
+    return bool(value)
+
+
+def _to_string(value):
+    # booleans as the SQL drivers store them, so a loaded `edited` of False 
+    # reads '0' from either output format
+    if value is True or value is False:
+        return str(int(value))
+    return str(value)
+
+
+_CONVERTERS = {'string': _to_string, 'int64': _to_int, 'bool': _to_bool}
+
+
+class _ParquetSink(object):
+    """columnar output of saved lines.  Lines are parsed and buffered into 
+    row groups against a fixed schema; fields missing from a line are null.
+
+    ARGS:
+        path: string.
+            output path.
+        fields: list.
+            list of (name,type) tuples, type one of 'string', 'int64', 'bool'.
+
+    KWARGS:
+        row_group_size: int.
+            rows buffered per row group.  Default 100000.
+    """
+    def __init__(self,path,fields,row_group_size=100000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self._pq = pq
+
+        self.path = path
+        self.fields = fields
+        self.row_group_size = row_group_size
+        types = {'string': pa.string(), 'int64': pa.int64(), 
+                 'bool': pa.bool_()}
+        self.schema = pa.schema([(name,types[kind]) for name,kind in fields])
+        self._open()
+
+    def _open(self):
+        self.writer = self._pq.ParquetWriter(self.path,self.schema,
+                                             compression='zstd')
+        self.columns = [[] for _ in self.fields]
+
+    def write(self,line):
+        data = json.loads(line.decode())
+        for column,(name,kind) in zip(self.columns,self.fields):
+            value = data.get(name,None)
+            if value is not None:
+                value = _CONVERTERS[kind](value)
+            column.append(value)
+        if len(self.columns[0]) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if self.columns[0]:
+            table = self._pa.Table.from_arrays(
+                [self._pa.array(c,type=f.type) 
+                 for c,f in zip(self.columns,self.schema)],
+                schema=self.schema)
+            self.writer.write_table(table)
+            self.columns = [[] for _ in self.fields]
+
+    def reset(self):
+        """discards everything written so far.
+        """
+        self.writer.close()
+        self._open()
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+# "subreddit" keys in a raw line.  Inside JSON strings quotes are escaped, so 
+# this only matches real keys -- the top-level one, plus any in nested objects 
+# such as crossposts.
+_SUBREDDIT_FIELD = re.compile(rb'"subreddit"\s*:\s*"([^"]*)"')
+
+
+def _line_subreddit(line,subreddits):
+    """checks one raw line of a dump against the target subreddits.  Lines 
+    with no candidate "subreddit" value in the raw bytes are rejected without 
+    parsing; the rest are parsed and checked exactly as before.
+
+    ARGS:
+        line: bytes.
+            raw JSON line.
+        subreddits: set.
+            lower-case target subreddit names.
+
+    RETURNS:
+        subreddit: string or None.
+            lower-case subreddit of the line if it is to be saved, else None.
+    """
+    for name in _SUBREDDIT_FIELD.findall(line):
+        if name.lower().decode() in subreddits:
+            break
+    else:
+        return None
+
+    data = json.loads(line.decode())
+    subreddit = data.get('subreddit','').lower()
+    return subreddit if subreddit in subreddits else None
+
+
+# largest zstd window accepted.  Newer dumps are written with --long=31, 
+# past the decoder's default limit.
+_ZSTD_MAX_WINDOW = 2**31
+
+
+def dump_codec(filepath):
+    """compression codec of a dump, from its extension.
+
+    ARGS:
+        filepath: string.
+            path, URL or filename of the dump.
+
+    RETURNS:
+        codec: string or None.
+            'bz2', 'xz' or 'zst', or None if not a known dump format.
+    """
+    for ext in g.DUMP_EXTENSIONS:
+        if filepath.endswith(ext):
+            return ext[1:]
+    return None
+
+
+def open_dump(filepath,codec=None):
+    """opens a compressed dump for reading decoded lines.
+
+    ARGS:
+        filepath: string or file object.
+            path to the dump, or an open binary file object (such as an HTTP 
+            response body).
+
+    KWARGS:
+        codec: string or None.
+            'bz2', 'xz' or 'zst'.  Default None, taken from the extension of 
+            `filepath`.  zstd requires the zstandard package.
+
+    RETURNS:
+        file: file object.
+            binary file object yielding decompressed lines.
+    """
+    if codec is None:
+        codec = dump_codec(filepath)
+    if codec == 'bz2':
+        return bz2.BZ2File(filepath,'r')
+    elif codec == 'xz':
+        return lzma.LZMAFile(filepath,'r')
+    elif codec == 'zst':
+        import zstandard
+        fileobj = open(filepath,'rb') if isinstance(filepath,str) else filepath
+        dctx = zstandard.ZstdDecompressor(max_window_size=_ZSTD_MAX_WINDOW)
+        reader = dctx.stream_reader(fileobj,read_across_frames=True,
+                                    closefd=fileobj is not filepath)
+        return io.BufferedReader(reader,buffer_size=1024*1024)
+    raise ValueError("unknown dump format {}".format(filepath))
+
+
+def _process_stream(filepath,subreddits,writefile,codec=None):
+    """filters a dump as a single stream.  `filepath` may also be an open 
+    binary file object, such as an HTTP response body, in which case `codec` 
+    must be given.
+
+    RETURNS:
+        counts: tuple.
+            tuple of (entries read, entries saved, decompressed bytes).
+    """
+    entries_read = 0
+    entries_saved = 0
+    with open_dump(filepath,codec) as file:
+        for line in file:
+            entries_read += 1
+            subreddit = _line_subreddit(line,subreddits)
+            if subreddit is not None:
+                entries_saved += 1
+                writefile.write(line,subreddit)
+        size = file.tell()
+    return (entries_read,entries_saved,size)
+
+
+# compression levels for `benchmark_codecs`, matching how the dumps are made
+_BENCH_LEVELS = {'bz2': 9, 'xz': 6, 'zst': 19}
+
+
+class _NullSink(object):
+    """output that discards saved lines, for timing the filter alone.
+    """
+    def write(self,line,subreddit=None):
+        pass
+
+    def reset(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _compress_to(source,path,codec,level):
+    """writes the decompressed file `source` to `path` compressed with 
+    `codec` at `level`.  zstd frames use long-distance matching, as the 
+    newer dumps do.
+    """
+    with open(source,'rb') as readfile:
+        if codec == 'bz2':
+            writefile = bz2.BZ2File(path,'w',compresslevel=level)
+        elif codec == 'xz':
+            writefile = lzma.LZMAFile(path,'w',preset=level)
+        elif codec == 'zst':
+            import zstandard
+            params = zstandard.ZstdCompressionParameters.from_level(
+                level,window_log=27,enable_ldm=True)
+            cctx = zstandard.ZstdCompressor(compression_params=params)
+            writefile = cctx.stream_writer(open(path,'wb'))
+        else:
+            raise ValueError("unknown codec {}".format(codec))
+        with writefile:
+            while True:
+                chunk = readfile.read(1024*1024)
+                if not chunk:
+                    break
+                writefile.write(chunk)
+
+
+def benchmark_codecs(filepath,subreddits=(),codecs=('bz2','xz','zst'),
+                     levels=None,repeat=3,tmp_dir=None):
+    """compares decode throughput of the dump codecs.  The sample dump is 
+    decompressed once, recompressed with each codec, and each copy is run 
+    through the same stream filter as `process_zip` (output discarded), 
+    keeping the best of `repeat` timings.
+
+    ARGS:
+        filepath: string.
+            sample dump in any supported format.  A small month, or the 
+            head of a large one, keeps recompression time down.
+
+    KWARGS:
+        subreddits: iterable.
+            subreddit names to filter on.  Default empty, which still runs 
+            the pre-filter over every line.
+        codecs: iterable.
+            codecs to compare.  Default all of 'bz2', 'xz' and 'zst'.
+        levels: dict or None.
+            compression level by codec.  Default None, uses `_BENCH_LEVELS`.
+        repeat: int.
+            timed runs per codec.  Default 3.
+        tmp_dir: string or None.
+            directory for the recompressed copies.  Default None, the 
+            system temp directory.
+
+    RETURNS:
+        results: dict.
+            for each codec, a dict of compressed 'size' in bytes, 'ratio' 
+            (raw/compressed), decode 'seconds' and raw 'mb_per_sec'.
+    """
+    levels = dict(_BENCH_LEVELS,**(levels or {}))
+    subreddits = set([sub.lower() for sub in subreddits])
+    results = {}
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as workdir:
+        raw = os.path.join(workdir,'sample.json')
+        with open_dump(filepath) as readfile, open(raw,'wb') as writefile:
+            while True:
+                chunk = readfile.read(1024*1024)
+                if not chunk:
+                    break
+                writefile.write(chunk)
+        raw_size = os.path.getsize(raw)
+
+        for codec in codecs:
+            path = os.path.join(workdir,'sample.'+codec)
+            _compress_to(raw,path,codec,levels[codec])
+            timings = []
+            for _ in range(repeat):
+                start = time.time()
+                _process_stream(path,subreddits,_NullSink())
+                timings.append(time.time()-start)
+            seconds = min(timings)
+            size = os.path.getsize(path)
+            results[codec] = {'size': size,
+                              'ratio': raw_size/size,
+                              'seconds': seconds,
+                              'mb_per_sec': raw_size/1024**2/seconds}
+            print("{}: {:.1f} MB compressed ({:.2f}x), decoded in {:.2f}s, "
+                  "{:.1f} MB/s".format(codec,size/1024**2,
+                                       results[codec]['ratio'],seconds,
+                                       results[codec]['mb_per_sec']))
+
+    return results
+
+
+# bzip2 block-start and end-of-stream markers.  Both are 48-bit values with no 
+# byte alignment in the compressed stream.
+_BLOCK_MAGIC = 0x314159265359
+_EOS_MAGIC = 0x177245385090
+
+# blocks (up to 900kB of text each) decoded per parallel job
+_BLOCKS_PER_JOB = 16
+
+# bytes of compressed file scanned for markers at a time
+_SCAN_SEGMENT = 64*1024*1024
+
+# smallest bzip2 file split into blocks.  Below this, worker startup costs 
+# more than parallel decoding saves.
+_SPLIT_MIN_SIZE = 64*1024*1024
+
+
+def _magic_needles(magic):
+    """byte patterns for finding `magic` at each of the 8 possible bit 
+    alignments.  At bit offset s into a 7-byte window, bytes 1-5 of the window 
+    are fully determined by the marker.
+
+    RETURNS:
+        needles: list.
+            list of (shift,pattern bytes).
+    """
+    needles = []
+    for shift in range(8):
+        window = (magic << (8 - shift)).to_bytes(7,'big')
+        needles.append((shift,window[1:6]))
+    return needles
+
+
+def _read_bits(data,start,nbits,offset=0):
+    """reads `nbits` bits from `data` as an integer, starting at bit `start` 
+    (relative to a buffer beginning at byte `offset` of the file).
+    """
+    start -= offset*8
+    first = start//8
+    last = (start + nbits + 7)//8
+    value = int.from_bytes(data[first:last],'big')
+    value >>= last*8 - (start + nbits)
+    return value & ((1 << nbits) - 1)
+
+
+def _find_markers(filepath):
+    """scans a bzip2 file for block and end-of-stream markers.
+
+    YIELDS:
+        marker: tuple.
+            tuple of (bit offset,is block start), in file order.
+    """
+    needles = ([(s,n,_BLOCK_MAGIC,True) for s,n in _magic_needles(_BLOCK_MAGIC)]
+               + [(s,n,_EOS_MAGIC,False) for s,n in _magic_needles(_EOS_MAGIC)])
+
+    with open(filepath,'rb') as file:
+        base = 0
+        data = b''
+        while True:
+            segment = file.read(_SCAN_SEGMENT)
+            if not segment:
+                break
+            # carry the last 6 bytes over, so a marker window cut off at the 
+            # end of one segment is found whole in the next
+            keep = data[-6:]
+            base += len(data) - len(keep)
+            data = keep + segment
+
+            found = []
+            for shift,needle,magic,is_block in needles:
+                i = data.find(needle,1)
+                while i != -1:
+                    if i + 6 <= len(data):
+                        bit = (base + i - 1)*8 + shift
+                        if _read_bits(data,bit,48,base) == magic:
+                            found.append((bit,is_block))
+                    i = data.find(needle,i+1)
+
+            for marker in sorted(found):
+                yield marker
+
+
+def _block_jobs(filepath):
+    """groups the blocks of a bzip2 file into parallel jobs.
+
+    YIELDS:
+        ranges: list.
+            list of up to `_BLOCKS_PER_JOB` (start bit,end bit) block ranges.
+    """
+    ranges = []
+    previous = None
+    for bit,is_block in _find_markers(filepath):
+        if previous is not None:
+            ranges.append((previous,bit))
+            if len(ranges) == _BLOCKS_PER_JOB:
+                yield ranges
+                ranges = []
+        previous = bit if is_block else None
+    if ranges:
+        yield ranges
+
+
+def _decode_blocks(filepath,ranges,level,subreddits):
+    """parallel job -- decompresses a run of bzip2 blocks and filters the 
+    complete lines in it.  Each block is rewrapped as a standalone one-block 
+    stream, whose stream CRC is just the block CRC.
+
+    ARGS:
+        filepath: string.
+            path to zipped file.
+        ranges: list.
+            list of (start bit,end bit) block ranges, from `_block_jobs`.
+        level: bytes.
+            block-size level byte from the file header.
+        subreddits: set.
+            lower-case target subreddit names.
+
+    RETURNS:
+        result: tuple.
+            tuple of (head,saved,tail,read,size).  `head` and `tail` are the 
+            partial lines before the first and after the last newline, 
+            `saved` the (subreddit,raw line) pairs kept from the complete 
+            lines between them, `read` the number of complete lines and 
+            `size` the number of decompressed bytes.  If the text holds no 
+            newline, returns (text,[],None,0,size).
+    """
+    first = ranges[0][0]//8
+    last = (ranges[-1][1] + 7)//8
+    with open(filepath,'rb') as file:
+        file.seek(first)
+        data = file.read(last - first)
+
+    pieces = []
+    for start,end in ranges:
+        nbits = end - start
+        block = _read_bits(data,start,nbits,first)
+        crc = _read_bits(data,start+48,32,first)
+        value = (((block << 48) | _EOS_MAGIC) << 32) | crc
+        pad = -(nbits + 80) % 8
+        stream = (b'BZh' + level + 
+                  (value << pad).to_bytes((nbits + 80 + pad)//8,'big'))
+        pieces.append(bz2.decompress(stream))
+    text = b''.join(pieces)
+
+    lines = text.split(b'\n')
+    if len(lines) == 1:
+        return (text,[],None,0,len(text))
+
+    saved = []
+    for line in lines[1:-1]:
+        subreddit = _line_subreddit(line,subreddits)
+        if subreddit is not None:
+            saved.append((subreddit,line))
+    return (lines[0],saved,lines[-1],len(lines)-2,len(text))
+
+
+def _process_blocks(filepath,subreddits,writefile,n_jobs):
+    """filters a dump by decoding its bzip2 blocks in parallel, stitching 
+    lines that span job boundaries back together in order.
+
+    RETURNS:
+        counts: tuple.
+            tuple of (entries read, entries saved, decompressed bytes).
+    """
+    with open(filepath,'rb') as file:
+        header = file.read(4)
+    if header[:3] != b'BZh':
+        raise OSError("{} is not a bzip2 file".format(filepath))
+    # the level only caps block size, so the largest one fits every stream of 
+    # a multi-stream file
+    level = b'9'
+
+    entries_read = 0
+    entries_saved = 0
+    size = 0
+
+    def save(line):
+        subreddit = _line_subreddit(line,subreddits)
+        if subreddit is not None:
+            writefile.write(line,subreddit)
+            return 1
+        return 0
+
+    results = Parallel(n_jobs=n_jobs,return_as='generator')(
+        delayed(_decode_blocks)(filepath,ranges,level,subreddits) 
+        for ranges in _block_jobs(filepath))
+
+    carry = b''
+    for head,saved,tail,read,decoded in results:
+        size += decoded
+        if tail is None:
+            carry += head
+            continue
+
+        line = carry + head
+        if line:
+            entries_read += 1
+            entries_saved += save(line)
+
+        for subreddit,line in saved:
+            writefile.write(line,subreddit)
+        entries_read += read
+        entries_saved += len(saved)
+        carry = tail
+
+    if carry:
+        entries_read += 1
+        entries_saved += save(carry)
+
+    return (entries_read,entries_saved,size)
+
+
+def _read_records(file):
+    """iterates over the records of a scraped file, either newline JSON or 
+    Parquet (by '.parquet' extension).
+
+    YIELDS:
+        data: dict.
+            one scraped post.
+    """
+    if file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(file).iter_batches():
+            for data in batch.to_pylist():
+                yield data
+    else:
+        with open(file,'r') as readfile:
+            for line in readfile:
+                yield json.loads(line)
+
+
+# (backend URL,table name) -> column list, filled by `table_columns`
+_columns = {}
+
+
+def table_columns(conn,table):
+    """column names of `table`, introspected once per backend and cached.
+
+    ARGS:
+        conn: connection.
+            connection from `storage.connect`.
+        table: string.
+            table name.
+
+    RETURNS:
+        columns: list.
+            list of column names, in table order.
+    """
+    key = (st.get_pool().backend.url(),table)
+    if key not in _columns:
+        cur = conn.cursor()
+        cur.execute("SHOW COLUMNS FROM {}".format(table))
+        _columns[key] = [row[0] for row in cur]
+    return _columns[key]
+
+
+def _tsv_field(value):
+    """formats one value for LOAD DATA's default tab-separated format.
+    """
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return '1' if value else '0'
+    value = str(value)
+    return (value.replace('\\','\\\\').replace('\t','\\t')
+            .replace('\n','\\n').replace('\r','\\r'))
+
+
+def _load_infile(cur,table,columns,rows):
+    """writes a batch of rows through a temporary TSV file and 
+    LOAD DATA LOCAL INFILE ... IGNORE, which keeps INSERT IGNORE's handling of 
+    duplicate keys.
+    """
+    with tempfile.NamedTemporaryFile('w',encoding='utf8',suffix='.tsv',
+                                     delete=False) as tsv:
+        for row in rows:
+            tsv.write('\t'.join([_tsv_field(v) for v in row]))
+            tsv.write('\n')
+    try:
+        cur.execute("LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE {} "
+                    "CHARACTER SET utf8mb4 ({});"
+                    .format(table,', '.join(columns)),(tsv.name,))
+    finally:
+        os.remove(tsv.name)
+
+
+def read_to_sql(file, conn, batch_size=1000, commit_every=10, 
+                method='executemany'):
     """wrapper to read scraped JSON files into appropriate SQL table.
 
     ARGS:
         file: string.
-            path to scraped JSON file.
-        conn: pymysql.Connect object.
-            connection to server.
+            path to scraped JSON or Parquet file.
+        conn: connection.
+            connection from `storage.connect`.  Must be opened with 
+            `local_infile=True` for the 'infile' method.
+
+    KWARGS:
+        batch_size: int.
+            rows written per batch.  Default 1000.
+        commit_every: int.
+            commit after this many batches.  Default 10.
+        method: string.
+            'executemany' for multi-row INSERT IGNORE statements, or 'infile' 
+            for LOAD DATA LOCAL INFILE ... IGNORE from a generated TSV.  
+            'infile' is MySQL-only; other backends use 'executemany'.  
+            Default 'executemany'.
+
+    RETURNS:
+        count: int.
+            number of rows read from the file.
     """
     cur = conn.cursor()
+    if method == 'infile' and st.dialect() != 'mysql':
+        method = 'executemany'
 
     if 'RC' in file:
         table = 'Comments'
     else:
         table = 'Submissions'
 
-    with open(file,'r') as readfile:
-        count = 0
-        for line in readfile:
+    columns = table_columns(conn,table)
+    keys = ', '.join(columns)
+    values = ', '.join(['%s'] * len(columns))
+    query = ("INSERT IGNORE INTO {} ({}) VALUES ({});"
+             .format(table,keys,values))
+
+    def write(rows):
+        if method == 'infile':
+            _load_infile(cur,table,columns,rows)
+        else:
+            cur.executemany(query,rows)
+
+    start = time.time()
+    count = 0
+    n_batches = 0
+    rows = []
+    with mx.Stage('sql_load',file=file,table=table,method=method) as stage:
+        for data in _read_records(file):
             count += 1
-            data = json.loads(line)
-            input_data = OrderedDict()
+            rows.append(tuple([data.get(field,None) for field in columns]))
+            if len(rows) >= batch_size:
+                write(rows)
+                rows = []
+                n_batches += 1
+                if n_batches % commit_every == 0:
+                    conn.commit()
+
+        if rows:
+            write(rows)
+        conn.commit()
+        stage.add(rows=count)
+
+    elapsed = time.time() - start
+    print("inserted {} rows in {:.1f}s ({:.0f} rows/sec)"
+          .format(count,elapsed,count/elapsed if elapsed > 0 else 0.))
+    return count
+
+
+def _load_file(file,batch_size,commit_every,method):
+    """parallel job -- loads one scraped file over its own connection.
+
+    RETURNS:
+        result: tuple.
+            tuple of (file,rows read,seconds).
+    """
+    conn = st.connect(local_infile=(method == 'infile'))
+    start = time.time()
+    try:
+        count = read_to_sql(file,conn,batch_size=batch_size,
+                            commit_every=commit_every,method=method)
+    finally:
+        conn.close()
+    return (file,count,time.time()-start)
 
-            cur.execute("SHOW COLUMNS FROM {}".format(table))
-            for row in cur:
-                field = row[0]
-                input_data[field] = data.get(field,None)
 
-            keys = ', '.join(input_data.keys())
-            values = ', '.join(['%s'] * len(input_data))
-            query = ("INSERT IGNORE INTO {} ({}) VALUES ({});"
-                     .format(table,keys,values))
-            cur.execute(query,tuple(input_data.values()))
+def _interleave(files):
+    """orders files alternating between comment and submission dumps, so 
+    parallel loaders write to both tables at once.
+    """
+    coms = [f for f in files if 'RC' in f]
+    subs = [f for f in files if 'RC' not in f]
+    ordered = []
+    for pair in itertools.zip_longest(coms,subs):
+        ordered += [f for f in pair if f is not None]
+    return ordered
 
-    print("inserted {} rows".format(count))
-    conn.commit()
 
+def read_all_to_sql(dl_dir,batch_size=1000,commit_every=10,
+                    method='executemany',n_jobs=1,reload=False):
+    """reads every scraped file in `dl_dir` into SQL, see `read_to_sql`.  
+    With `n_jobs` above 1, files are loaded by parallel worker processes, 
+    each with its own connection, alternating Comments and Submissions files.
+    With the dump manifest on (see `manifest`), each dump is marked loaded 
+    once all of its files are in, and files of dumps already loaded are 
+    skipped.
 
-def read_all_to_sql(dl_dir):
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8mb4',
-                       init_command='SET NAMES UTF8MB4')
+    ARGS:
+        dl_dir: string.
+            path to directory of scraped files.
 
+    KWARGS:
+        batch_size, commit_every, method:
+            passed to `read_to_sql`.
+        n_jobs: int.
+            number of parallel loaders.  Default 1.
+        reload: boolean.
+            load files of dumps the manifest has as loaded, too.  Default 
+            False.
+    """
     files = os.listdir(dl_dir)
-    files = [dl_dir+'/'+f for f in files]
+    if mf.enabled() and not reload:
+        files = [f for f in files if g.dump_key(f) is None or 
+                 (mf.status(f) or {}).get('stage') != 'loaded']
+    files = _interleave([dl_dir+'/'+f for f in files])
     count = len(files)
-    for i,file in enumerate(files):
-        print("{}/{} writing {}".format(i+1,count,file))
-        read_to_sql(file,conn)
\ No newline at end of file
+
+    # files outstanding, and rows and seconds so far, per dump
+    remaining = {}
+    for file in files:
+        loads = remaining.setdefault(g.dump_key(file),[0,0,0.])
+        loads[0] += 1
+
+    start = time.time()
+    total = 0
+    results = Parallel(n_jobs=n_jobs,return_as='generator_unordered')(
+        delayed(_load_file)(file,batch_size,commit_every,method) 
+        for file in files)
+    for i,(file,rows,elapsed) in enumerate(results):
+        total += rows
+        loads = remaining[g.dump_key(file)]
+        loads[0] -= 1
+        loads[1] += rows
+        loads[2] += elapsed
+        if loads[0] == 0 and g.dump_key(file) is not None:
+            mf.mark(file,'loaded',rows_loaded=loads[1],load_seconds=loads[2])
+        print("{}/{} wrote {}: {} rows in {:.1f}s ({:.0f} rows/sec)"
+              .format(i+1,count,file,rows,elapsed,
+                      rows/elapsed if elapsed > 0 else 0.))
+
+    elapsed = time.time() - start
+    print("loaded {} rows from {} files in {:.1f}s ({:.0f} rows/sec)"
+          .format(total,count,elapsed,total/elapsed if elapsed > 0 else 0.))
@@ -3,7 +3,7 @@
 
 
 import json
-import pymysql as pms
+from reddit_common import storage as st
 
 def process(subreddit_file):
     """processes subreddit text file into SQL table.
@@ -12,12 +12,7 @@ def process(subreddit_file):
         subreddit_file: string.
             filepath to subreddit file, a text file of JSONs.
     """
-    conn = pms.connect(host='localhost',
-                       user='root',
-                       passwd='',
-                       db='reddit',
-                       charset='utf8',
-                       init_command='SET NAMES UTF8; SET CHARACTER SET utf8;')
+    conn = st.connect()
     cur = conn.cursor()
 
     with open(subreddit_file,'r') as readfile:
@@ -0,0 +1,98 @@
+"""shared fixtures -- a local HTTP stand-in for files.pushshift.io, serving
+dump files with Range support and scripted faults, and the entity catalog.
+"""
+
+import os
+import bz2
+import json
+import threading
+import http.server
+
+import pytest
+
+import catalog as cat
+
+
+class _DumpHandler(http.server.BaseHTTPRequestHandler):
+    """serves `server.files`, honouring Range requests.  Each GET consumes
+    the next fault queued in `server.faults`:
+
+        'error'         respond 500
+        'truncate'      send half the body, then close the connection
+        'ignore_range'  send the whole file with a 200, whatever the Range
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self,format,*args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        byte_range = self.headers.get('Range')
+        server.requests.append((self.path,byte_range))
+        fault = server.faults.pop(0) if server.faults else None
+
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        if fault == 'error':
+            self.send_error(500)
+            return
+
+        start = 0
+        if byte_range is not None and fault != 'ignore_range':
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range','bytes */{}'.format(len(data)))
+                self.send_header('Content-Length','0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range','bytes {}-{}/{}'.format(
+                start,len(data)-1,len(data)))
+        else:
+            self.send_response(200)
+
+        body = data[start:]
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        if fault == 'truncate':
+            body = body[:len(body)//2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def dump_server():
+    """local dump server.  Add files with `server.files['/comments/...'] =
+    data`, queue faults in `server.faults`, and point code at
+    `server.base_url`.  Requests made are listed in `server.requests` as
+    (path,Range header) tuples.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1',0),_DumpHandler)
+    server.daemon_threads = True
+    server.files = {}
+    server.faults = []
+    server.requests = []
+    server.base_url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever,daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_dump(posts):
+    """bz2-compressed dump of JSON lines, one per dict in `posts`.
+    """
+    lines = ''.join(json.dumps(post) + '\n' for post in posts)
+    return bz2.compress(lines.encode('utf-8'))
+
+
+@pytest.fixture(scope='session')
+def catalog():
+    """entity catalog compiled from the JSON files in entity_index.
+    """
+    return cat.EntityCatalog(os.path.dirname(os.path.abspath(cat.__file__)))
@@ -0,0 +1,50 @@
+"""tests for `clean_fails`, with and without the dump manifest.
+"""
+
+import os
+
+import pytest
+
+import clean_fails as cf
+import manifest as mf
+
+
+@pytest.fixture
+def dl_dir(tmp_path,monkeypatch):
+    """download directory with a failed partial dump and a good one.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv(mf.MANIFEST_ENV,raising=False)
+    os.mkdir('raw')
+    for name in ['RC_2017-01.zst.part','RC_2017-02.zst']:
+        open(os.path.join('raw',name),'w').close()
+    return 'raw'
+
+
+def test_clean_dir_from_log(dl_dir):
+    with open('failed_downloads.log','w') as f:
+        f.write('raw/RC_2017-01.zst\n')
+
+    assert cf.get_fails() == {'raw/RC_2017-01.zst'}
+    cf.clean_dir(dl_dir)
+
+    assert os.listdir(dl_dir) == ['RC_2017-02.zst']
+    assert os.path.getsize('failed_downloads.log') == 0
+    assert not os.path.exists(mf.MANIFEST_FILE)
+
+
+def test_clean_dir_from_manifest(dl_dir,monkeypatch):
+    monkeypatch.setenv(mf.MANIFEST_ENV,'')
+    mf.configure(mf.MANIFEST_FILE)
+    mf.list_files(['./RC_2017-01.zst','./RC_2017-02.zst'])
+    mf.mark('./RC_2017-02.zst','filtered')
+    mf.fail('./RC_2017-01.zst','download failed')
+    mf.configure(None)
+
+    # the default manifest file is picked up
+    cf.clean_dir(dl_dir)
+
+    assert os.listdir(dl_dir) == ['RC_2017-02.zst']
+    row = mf.status('./RC_2017-01.zst')
+    assert (row['stage'],row['error'],row['failures']) == ('listed',None,0)
+    assert mf.status('./RC_2017-02.zst')['stage'] == 'filtered'
@@ -0,0 +1,146 @@
+"""tests for `get_files.download` against a local HTTP stand-in.
+"""
+
+import os
+
+import pytest
+
+import get_files as g
+import manifest as mf
+
+
+DUMP = './RC_2017-01.zst'
+DATA = bytes(range(256)) * 400
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """records retry waits instead of sleeping.
+    """
+    waits = []
+    monkeypatch.setattr(g.time,'sleep',waits.append)
+    return waits
+
+
+def _download(server,tmp_path,**kwargs):
+    return g.download(DUMP,dl_dir=str(tmp_path),base_url=server.base_url,
+                      chunk_size=1024,**kwargs)
+
+
+def test_download(dump_server,tmp_path,sleeps):
+    dump_server.files['/comments/RC_2017-01.zst'] = DATA
+    filepath = _download(dump_server,tmp_path)
+
+    assert filepath == os.path.join(str(tmp_path),'RC_2017-01.zst')
+    with open(filepath,'rb') as f:
+        assert f.read() == DATA
+    assert os.listdir(str(tmp_path)) == ['RC_2017-01.zst']
+    assert dump_server.requests == [('/comments/RC_2017-01.zst',None)]
+    assert sleeps == []
+
+
+def test_download_bare_name(dump_server,tmp_path,sleeps):
+    dump_server.files['/comments/RC_2017-01.zst'] = DATA
+    filepath = g.download('RC_2017-01.zst',dl_dir=str(tmp_path),
+                          base_url=dump_server.base_url)
+
+    assert filepath == os.path.join(str(tmp_path),'RC_2017-01.zst')
+    assert dump_server.requests == [('/comments/RC_2017-01.zst',None)]
+
+
+def test_resumes_part_file(dump_server,tmp_path,sleeps):
+    dump_server.files['/comments/RC_2017-01.zst'] = DATA
+    with open(os.path.join(str(tmp_path),'RC_2017-01.zst.part'),'wb') as f:
+        f.write(DATA[:1000])
+
+    filepath = _download(dump_server,tmp_path)
+
+    with open(filepath,'rb') as f:
+        assert f.read() == DATA
+    assert dump_server.requests == [('/comments/RC_2017-01.zst',
+                                     'bytes=1000-')]
+
+
+def test_restarts_when_range_ignored(dump_server,tmp_path,sleeps):
+    dump_server.files['/comments/RC_2017-01.zst'] = DATA
+    with open(os.path.join(str(tmp_path),'RC_2017-01.zst.part'),'wb') as f:
+        f.write(b'stale')
+    dump_server.faults = ['ignore_range']
+
+    filepath = _download(dump_server,tmp_path)
+
+    with open(filepath,'rb') as f:
+        assert f.read() == DATA
+
+
+def test_416_on_complete_part_file(dump_server,tmp_path,sleeps):
+    dump_server.files['/comments/RC_2017-01.zst'] = DATA
+    with open(os.path.join(str(tmp_path),'RC_2017-01.zst.part'),'wb') as f:
+        f.write(DATA)
+
+    filepath = _download(dump_server,tmp_path)
+
+    with open(filepath,'rb') as f:
+        assert f.read() == DATA
+    assert dump_server.requests == [('/comments/RC_2017-01.zst',
+                                     'bytes={}-'.format(len(DATA)))]
+
+
+def test_416_on_oversized_part_file(dump_server,tmp_path,sleeps):
+    dump_server.files['/comments/RC_2017-01.zst'] = DATA
+    with open(os.path.join(str(tmp_path),'RC_2017-01.zst.part'),'wb') as f:
+        f.write(DATA + b'junk')
+
+    filepath = _download(dump_server,tmp_path)
+
+    # the bad part file is dropped and the retry starts from scratch
+    with open(filepath,'rb') as f:
+        assert f.read() == DATA
+    assert [r for _,r in dump_server.requests] == [
+        'bytes={}-'.format(len(DATA)+4),None]
+    assert sleeps == [2.]
+
+
+def test_retries_with_backoff(dump_server,tmp_path,sleeps):
+    dump_server.files['/comments/RC_2017-01.zst'] = DATA
+    dump_server.faults = ['error','truncate']
+
+    filepath = _download(dump_server,tmp_path,backoff=0.5)
+
+    with open(filepath,'rb') as f:
+        assert f.read() == DATA
+    assert sleeps == [0.5,1.]
+    # the truncated attempt is resumed, not restarted
+    assert dump_server.requests[-1] == ('/comments/RC_2017-01.zst',
+                                        'bytes={}-'.format(len(DATA)//2))
+
+
+def test_failure_leaves_no_file(dump_server,tmp_path,sleeps,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv(mf.MANIFEST_ENV,raising=False)
+    dump_server.files['/comments/RC_2017-01.zst'] = DATA
+    dump_server.faults = ['truncate']*3
+
+    assert _download(dump_server,tmp_path,retries=2) is None
+
+    # only the partial download is kept, never a truncated final file
+    assert not os.path.exists(os.path.join(str(tmp_path),'RC_2017-01.zst'))
+    part = os.path.join(str(tmp_path),'RC_2017-01.zst.part')
+    assert 0 < os.path.getsize(part) < len(DATA)
+    assert sleeps == [2.,4.]
+    with open('failed_downloads.log') as f:
+        assert f.read() == os.path.join(str(tmp_path),'RC_2017-01.zst\n')
+
+
+def test_failure_recorded_in_manifest(dump_server,tmp_path,sleeps,
+                                      monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv(mf.MANIFEST_ENV,'')
+    mf.configure('manifest.sqlite')
+    mf.list_files([DUMP])
+
+    assert _download(dump_server,tmp_path,retries=1,on_fail=mf.fail) is None
+
+    row = mf.status(DUMP)
+    assert row['failures'] == 1 and 'download failed' in row['error']
+    assert not os.path.exists('failed_downloads.log')
@@ -0,0 +1,88 @@
+"""tests that `language_tools.KeywordMatcher` matches as the original
+tokenize-then-filter path of `build_index.find_card_keywords` does.
+"""
+
+import os
+import random
+
+import pytest
+
+import language_tools as lt
+import build_index as b
+
+
+# stopwords that split multi-word entities and shadow keywords
+STOPWORDS = frozenset(['THE','A','AND','OF','FOR','MY','IS','TO','CARD',
+                       'CHASE','GOLD','NO','FEE','CASH'])
+
+TEXTS = [
+    "I love my Chase Sapphire Reserve card",
+    "chase sapphire vs chase sapphire preferred vs CSR vs CSP",
+    "Amex Gold, amex platinum and the American Express Gold card",
+    "no annual fee cash back card with no foreign transaction fee",
+    "the the the of and a for my is to card card",
+    "Citi Double Cash; citi double; double cash; CITI",
+    "annual fee annual fee annual, fee... AF waived?",
+    "barclays arrival plus or barclaycard arrival+ -- which is better",
+    "",
+    "!!! ??? 1234 5/24 chase_sapphire",
+]
+
+
+@pytest.fixture(scope='module')
+def texts(catalog):
+    """`TEXTS`, plus random texts mixing entity tokens, keywords,
+    stopwords and filler words.
+    """
+    vocab = set(['BONUS','POINTS','REWARDS','I','GOT','WITH','5','24'])
+    for mwe in catalog.mwes:
+        vocab.update(mwe)
+    vocab.update(k for k in catalog.keywords if ' ' not in k)
+    vocab = sorted(vocab) + sorted(STOPWORDS)*5
+    rand = random.Random(0)
+    generated = []
+    for _ in range(300):
+        words = [rand.choice(vocab) for _ in range(rand.randint(1,40))]
+        words = [w.lower() if rand.random() < 0.5 else w for w in words]
+        generated.append(' '.join(words))
+    return TEXTS + generated
+
+
+@pytest.fixture(autouse=True)
+def entity_dir(monkeypatch):
+    # the unmatched path reads the entity JSON files from the working
+    # directory
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(lt.__file__)))
+
+
+@pytest.mark.parametrize('stopwords',[None,STOPWORDS])
+def test_matcher_equivalent_to_tokenize(catalog,texts,stopwords):
+    matcher = catalog.matcher(stopwords=stopwords)
+    keys = catalog.keywords
+
+    multi_word = 0
+    for i,text in enumerate(texts):
+        expected = b.find_card_keywords((i,text),keys,stopwords=stopwords)
+        assert b.find_card_keywords((i,text),keys,matcher=matcher) \
+            == expected
+        assert matcher.tokenize(text) == lt.tokenize(text,
+                                                     stopwords=stopwords)
+        if expected is not None:
+            multi_word += any(' ' in k for k in expected[1])
+
+    # the texts exercise multi-word entities, not just single tokens
+    assert multi_word > 20
+
+
+def test_matcher_examples(catalog):
+    matcher = catalog.matcher(stopwords=STOPWORDS)
+
+    # entities merge before stopwords are stripped, longest match first
+    assert matcher.match(TEXTS[1]) == ['CHASE SAPPHIRE','CHASE SAPPHIRE',
+                                       'CSP']
+    assert matcher.match(TEXTS[3]) == ['ANNUAL FEE','CASH BACK',
+                                       'FOREIGN TRANSACTION FEE']
+    assert matcher.match('chase and citi') == ['CITI']
+    assert catalog.matcher().match('chase and citi') == ['CHASE','CITI']
+    assert matcher.match(TEXTS[4]) == []
+    assert catalog.matcher().fingerprint != matcher.fingerprint
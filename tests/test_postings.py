@@ -0,0 +1,124 @@
+"""tests for the on-disk postings index in `postings`.
+"""
+
+import numpy as np
+import pytest
+
+import postings as ps
+
+
+JAN,FEB,MAR = 1483228800,1485907200,1488326400
+
+# (table,[(id,[keywords],created_utc)]) chunks, written as two segments.
+# Comment and submission 'a' share an id; comment 'c' is indexed twice.
+SEGMENTS = [
+    [('Comments',[('a',['CHASE SAPPHIRE','ANNUAL FEE'],JAN),
+                  ('b',['AMEX GOLD'],JAN),
+                  ('c',['CHASE SAPPHIRE'],FEB)])],
+    [('Submissions',[('a',['AMEX GOLD','ANNUAL FEE'],FEB),
+                     ('d',['CASHBACK'],MAR)]),
+     ('Comments',[('c',['CHASE SAPPHIRE'],FEB)])],
+]
+
+
+@pytest.fixture
+def index_dir(tmp_path,catalog):
+    """index directory holding the two segments of `SEGMENTS`.
+    """
+    path = str(tmp_path/'postings')
+    writer = ps.PostingsWriter(path,catalog)
+    for segment in SEGMENTS:
+        for table,posts in segment:
+            results = [(index,keywords) for index,keywords,_ in posts]
+            meta = {(table,index): created for index,_,created in posts}
+            writer.add(results,table,meta)
+        writer.write()
+    return path
+
+
+def _posts(keys):
+    return set(ps.decode_keys(keys))
+
+
+def test_varint_round_trip():
+    values = np.array([0,1,127,128,300,16383,16384,2**35,2**62-1,5],
+                      dtype=np.int64)
+    blob = ps._encode_varints(values)
+
+    assert len(blob) == sum(max(1,(int(v).bit_length()+6)//7)
+                            for v in values)
+    decoded = ps._decode_varints(np.frombuffer(blob,dtype=np.uint8),
+                                 len(values))
+    assert decoded.tolist() == values.tolist()
+    assert ps._encode_varints([]) == b''
+
+
+def test_post_keys_round_trip():
+    posts = [('Comments','d1x9k2a'),('Submissions','d1x9k2a'),
+             ('Comments','0')]
+    keys = [ps.post_key(index,table) for table,index in posts]
+
+    assert len(set(keys)) == 3
+    assert ps.decode_keys(keys) == posts
+
+
+def test_query_across_segments(index_dir,catalog):
+    assert len(ps.segment_files(index_dir)) == 2
+    with ps.PostingsIndex(index_dir,catalog=catalog) as index:
+        keys = index.postings('CHASE_SAPPHIRE')
+        assert keys.tolist() == sorted(set(keys.tolist()))
+        assert ps.decode_keys(keys) == [('Comments','a'),('Comments','c')]
+        # keywords resolve to their column through the catalog
+        assert index.postings('CHASE SAPPHIRE').tolist() == keys.tolist()
+
+        assert _posts(index.postings('ANNUAL_FEE')) == {
+            ('Comments','a'),('Submissions','a')}
+        assert _posts(index.postings('ANNUAL_FEE',start='2017-02')) == {
+            ('Submissions','a')}
+        assert index.months('AMEX_GOLD') == ['2017-01','2017-02']
+
+
+def test_intersect_union_query(index_dir):
+    with ps.PostingsIndex(index_dir) as index:
+        assert _posts(index.intersect(['ANNUAL_FEE','AMEX_GOLD'])) == {
+            ('Submissions','a')}
+        assert _posts(index.intersect(['ANNUAL_FEE','CASHBACK_REWARDS'])) \
+            == set()
+        assert _posts(index.union(['AMEX_GOLD','CASHBACK_REWARDS'])) == {
+            ('Comments','b'),('Submissions','a'),('Submissions','d')}
+        assert _posts(index.union(['AMEX_GOLD'],end=JAN)) == {
+            ('Comments','b')}
+
+        assert _posts(index.query(all_of=['ANNUAL_FEE'],
+                                  none_of=['AMEX_GOLD'])) == {
+            ('Comments','a')}
+        assert _posts(index.query(any_of=['CHASE_SAPPHIRE','AMEX_GOLD'],
+                                  start='2017-02',end='2017-02')) == {
+            ('Comments','c'),('Submissions','a')}
+
+
+def test_counts(index_dir):
+    with ps.PostingsIndex(index_dir) as index:
+        # comment 'c' is in both segments until they are compacted
+        assert index.counts('CHASE_SAPPHIRE') == {'2017-01': 1,'2017-02': 2}
+        assert index.counts('ANNUAL_FEE',start='2017-02') == {'2017-02': 1}
+
+
+def test_compact(index_dir):
+    with ps.PostingsIndex(index_dir) as index:
+        terms = index.terms()
+        before = dict((term,index.postings(term).tolist()) for term in terms)
+        query = index.query(all_of=['ANNUAL_FEE'],any_of=['AMEX_GOLD']) \
+            .tolist()
+
+    filepath = ps.compact(index_dir)
+
+    assert ps.segment_files(index_dir) == [filepath]
+    with ps.PostingsIndex(index_dir) as index:
+        assert index.terms() == terms
+        for term in terms:
+            assert index.postings(term).tolist() == before[term]
+        assert index.query(all_of=['ANNUAL_FEE'],
+                           any_of=['AMEX_GOLD']).tolist() == query
+        assert index.counts('CHASE_SAPPHIRE') == {'2017-01': 1,'2017-02': 1}
+    assert ps.compact(index_dir) == filepath
@@ -0,0 +1,271 @@
+"""tests for streaming dumps with `read_json.process_url`, and the download
+fallback in `process_all.stream_file`, against a local HTTP stand-in.
+"""
+
+import os
+import bz2
+import json
+import random
+import string
+
+import pytest
+
+from reddit_common import storage as st
+import read_json as r
+import process_all as pa
+import manifest as mf
+from conftest import make_dump
+
+
+POSTS = [{'id': 'a{}'.format(i),'subreddit': sub,'body': 'post {}'.format(i)}
+         for i,sub in enumerate(['churning','pics','CreditCards','pics'])]
+TARGETS = ['churning','creditcards']
+URL_PATH = '/comments/RC_2017-01.bz2'
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path,monkeypatch):
+    """runs each test in its own directory (read_json.log is written to the
+    working directory), with the manifest on.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv(mf.MANIFEST_ENV,'')
+    mf.configure('manifest.sqlite')
+    mf.list_files(['./RC_2017-01.bz2'])
+    return tmp_path
+
+
+def _saved(path):
+    with open(path) as f:
+        return [json.loads(line)['id'] for line in f]
+
+
+def test_process_url(dump_server,workdir):
+    dump_server.files[URL_PATH] = make_dump(POSTS)
+    out = str(workdir/'RC_2017-01_scraped')
+
+    assert r.process_url(dump_server.base_url+URL_PATH[1:],TARGETS,out)
+
+    assert _saved(out) == ['a0','a2']
+    row = mf.status('RC_2017-01.bz2')
+    assert row['stage'] == 'filtered'
+    assert (row['lines_read'],row['lines_kept']) == (4,2)
+
+
+def test_process_url_empty_dump(dump_server,workdir):
+    dump_server.files[URL_PATH] = bz2.compress(b'')
+    out = str(workdir/'RC_2017-01_scraped')
+
+    assert r.process_url(dump_server.base_url+URL_PATH[1:],TARGETS,out)
+
+    assert _saved(out) == []
+    assert mf.status('RC_2017-01.bz2')['stage'] == 'filtered'
+
+
+def test_process_url_failure(dump_server,workdir):
+    dump_server.files[URL_PATH] = make_dump(POSTS*100)
+    dump_server.faults = ['truncate']
+    out = str(workdir/'RC_2017-01_scraped')
+
+    assert not r.process_url(dump_server.base_url+URL_PATH[1:],TARGETS,out)
+
+    assert not os.path.exists(out)
+    row = mf.status('RC_2017-01.bz2')
+    assert row['failures'] == 1 and 'stream failed' in row['error']
+
+
+def test_stream_file_falls_back_to_download(dump_server,workdir):
+    dump_server.files[URL_PATH] = make_dump(POSTS*100)
+    dump_server.faults = ['truncate']
+    dl_dir = str(workdir/'raw')
+    os.mkdir(dl_dir)
+
+    streamed = pa.stream_file('./RC_2017-01.bz2',TARGETS,dl_dir=dl_dir,
+                              base_url=dump_server.base_url)
+
+    assert not streamed
+    assert [path for path,_ in dump_server.requests] == [URL_PATH]*2
+    # the raw download is deleted once filtered, leaving one scraped output
+    outputs = os.listdir(dl_dir)
+    assert len(outputs) == 1 and '_scraped_' in outputs[0]
+    assert _saved(os.path.join(dl_dir,outputs[0])) == ['a0','a2']*100
+    assert mf.status('RC_2017-01.bz2')['stage'] == 'filtered'
+
+
+class _Collect(object):
+    """stands in for `read_json._open_fanout`'s writer, keeping saved lines.
+    """
+    def __init__(self,subreddits):
+        self.routes = dict((sub,[None]) for sub in subreddits)
+        self.lines = []
+
+    def write(self,line,subreddit):
+        # the real sinks end every line with one newline
+        self.lines.append((subreddit,line.rstrip(b'\n')))
+
+
+def _body(size,seed):
+    # random letters, which bzip2's run-length stage cannot shrink
+    rand = random.Random(seed)
+    return ''.join(rand.choice(string.ascii_letters+' ') for _ in range(size))
+
+
+def _posts(n,body_size):
+    subs = ['churning','pics','creditcards']
+    return [{'id': 'b{}'.format(i),'subreddit': subs[i%3],
+             'body': _body(body_size+i%50,i)} for i in range(n)]
+
+
+def _compare_decoders(filepath,monkeypatch):
+    """filters `filepath` as one stream and split into blocks, two blocks
+    per job, and checks both save the same lines in the same order.
+    """
+    monkeypatch.setattr(r,'_BLOCKS_PER_JOB',2)
+    serial = _Collect(TARGETS)
+    counts = r._process_stream(filepath,set(TARGETS),serial)
+    parallel = _Collect(TARGETS)
+
+    assert r._process_blocks(filepath,set(TARGETS),parallel,2) == counts
+    assert parallel.lines == serial.lines
+    return counts
+
+
+def _kept(posts):
+    return len([p for p in posts if p['subreddit'] in TARGETS])
+
+
+def test_blocks_multi_block(workdir,monkeypatch):
+    # level 1 compresses in 100kB blocks, so ~1.3MB of lines spans 13 of
+    # them, with lines crossing each block boundary
+    filepath = str(workdir/'RC_2017-01.bz2')
+    posts = _posts(400,3000)
+    data = ''.join(json.dumps(p)+'\n' for p in posts).encode()
+    with open(filepath,'wb') as f:
+        f.write(bz2.compress(data,1))
+    assert sum(len(job) for job in r._block_jobs(filepath)) > 8
+
+    assert _compare_decoders(filepath,monkeypatch) == (
+        len(posts),_kept(posts),len(data))
+
+
+def test_blocks_multistream(workdir,monkeypatch):
+    filepath = str(workdir/'RC_2017-01.bz2')
+    posts = _posts(300,2000)
+    with open(filepath,'wb') as f:
+        for level,part in [(1,posts[:100]),(9,posts[100:150]),
+                           (2,posts[150:])]:
+            f.write(bz2.compress(''.join(json.dumps(p)+'\n'
+                                         for p in part).encode(),level))
+
+    read,saved,_ = _compare_decoders(filepath,monkeypatch)
+
+    assert (read,saved) == (len(posts),_kept(posts))
+
+
+def test_blocks_line_spans_jobs(workdir,monkeypatch):
+    # one line longer than a whole job of blocks, and the last line left
+    # without a newline
+    filepath = str(workdir/'RC_2017-01.bz2')
+    posts = _posts(60,2000)
+    posts[30]['body'] = _body(350000,-1)
+    lines = ''.join(json.dumps(p)+'\n' for p in posts).rstrip('\n')
+    with open(filepath,'wb') as f:
+        f.write(bz2.compress(lines.encode(),1))
+    monkeypatch.setattr(r,'_BLOCKS_PER_JOB',1)
+    results = [r._decode_blocks(filepath,job,b'9',set(TARGETS))
+               for job in r._block_jobs(filepath)]
+    assert any(tail is None for _,_,tail,_,_ in results)
+
+    read,saved,_ = _compare_decoders(filepath,monkeypatch)
+
+    assert (read,saved) == (len(posts),_kept(posts))
+
+
+def test_process_zip_splits_large_files(workdir,monkeypatch):
+    filepath = str(workdir/'RC_2017-01.bz2')
+    with open(filepath,'wb') as f:
+        f.write(make_dump(_posts(300,1000)))
+    calls = []
+    process_blocks = r._process_blocks
+    def spy(*args):
+        calls.append(args[0])
+        return process_blocks(*args)
+    monkeypatch.setattr(r,'_process_blocks',spy)
+
+    # small files are read as one stream, however many jobs are asked for
+    r.process_zip(filepath,TARGETS,decompress_jobs=2)
+    assert calls == []
+
+    # the filtered dump was deleted, so write it again
+    with open(filepath,'wb') as f:
+        f.write(make_dump(_posts(300,1000)))
+    monkeypatch.setattr(r,'_SPLIT_MIN_SIZE',0)
+    r.process_zip(filepath,TARGETS,decompress_jobs=2)
+    assert calls == [filepath]
+
+    outputs = sorted(f for f in os.listdir(str(workdir)) if '_scraped_' in f)
+    assert len(outputs) == 2
+    assert _saved(str(workdir/outputs[0])) == _saved(str(workdir/outputs[1]))
+
+
+@pytest.fixture
+def database(workdir,monkeypatch):
+    """configures a fresh SQLite database with the posts tables.
+    """
+    monkeypatch.setenv(st.BACKEND_ENV,'')
+    monkeypatch.setenv(st.POOL_SIZE_ENV,'')
+    st.configure('sqlite:///'+str(workdir/'posts.sqlite'))
+    st.create_tables(r.COMMENT_FIELDS,r.SUBMISSION_FIELDS)
+
+
+def test_parquet_loads_like_json(workdir,database):
+    posts = [{'id': 's1','subreddit': 'churning','title': 'a',
+              'over_18': False,'is_self': True,'stickied': False,
+              'edited': False,'score': 3,'created_utc': 1483228800},
+             {'id': 's2','subreddit': 'churning','title': 'b',
+              'over_18': True,'is_self': False,'stickied': False,
+              'edited': 1483229000.5,'score': 4,'created_utc': 1483228900},
+             {'id': 's3','subreddit': 'churning','title': 'c'}]
+    loaded = {}
+    for output in ['json','parquet']:
+        filepath = str(workdir/'RS_2017-01.bz2')
+        with open(filepath,'wb') as f:
+            f.write(make_dump(posts))
+        r.process_zip(filepath,TARGETS,output=output)
+        [scraped] = [f for f in os.listdir(str(workdir)) if '_scraped_' in f]
+
+        with st.connect() as conn:
+            r.read_to_sql(str(workdir/scraped),conn)
+            cur = conn.cursor()
+            cur.execute("SELECT id,over_18,is_self,stickied,edited,score "
+                        "FROM Submissions ORDER BY id")
+            loaded[output] = cur.fetchall()
+            cur.execute("DELETE FROM Submissions")
+            conn.commit()
+        os.remove(str(workdir/scraped))
+
+    assert loaded['parquet'] == loaded['json']
+    assert [row[:5] for row in loaded['parquet']] == [
+        ('s1',0,1,0,'0'),('s2',1,0,0,'1483229000.5'),
+        ('s3',None,None,None,None)]
+
+
+def test_parquet_converters():
+    to_bool = r._CONVERTERS['bool']
+    assert [to_bool(v) for v in [True,False,1,0,'true','False','0','']] == [
+        True,False,True,False,True,False,False,False]
+    to_string = r._CONVERTERS['string']
+    assert [to_string(v) for v in [False,True,1483229000,'x']] == [
+        '0','1','1483229000','x']
+
+
+def test_table_columns_per_backend(workdir,database):
+    with st.connect() as conn:
+        assert r.table_columns(conn,'Comments') == [
+            name for name,_ in r.COMMENT_FIELDS]
+
+    st.configure('sqlite:///'+str(workdir/'other.sqlite'))
+    st.create_tables(r.COMMENT_FIELDS[:3],r.SUBMISSION_FIELDS)
+    with st.connect() as conn:
+        assert r.table_columns(conn,'Comments') == ['id','author',
+                                                    'subreddit']